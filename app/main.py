@@ -1,4 +1,7 @@
 import os
+import gc
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
 from contextlib import asynccontextmanager
@@ -7,12 +10,26 @@ from fastapi import FastAPI, Depends, HTTPException, Request
 from app.models.models import PredictReturnParams
 
 from app.utils import (
-    initialize_model,
-    process_project_metadata,
-    create_cosmos_db_client,
+    load_model,
+    share_model_memory,
+    prepare_model,
+    check_parity,
+    InferenceScheduler,
+    InFlightLimiter,
+    read_body,
+    create_prediction_store,
+    WriteBehindQueue,
+    PredictionCache,
+    create_project_source,
+    ProjectRegistry,
+    ProjectRefresher,
 )
 
 from app.routes.predict import predict_endpoint_implementation
+from app.routes.predict_batch import (
+    parse_batch,
+    predict_batch_endpoint_implementation,
+)
 from app.routes.check_database import check_projects_implementation
 
 load_dotenv()
@@ -23,28 +40,233 @@ load_dotenv()
 app_resources = {}
 
 
+def model_settings(name: str) -> dict:
+    """Returns the backend, calibration directory and runtime of the given model (see prepare_model())."""
+    return {
+        "backend": os.getenv(f"{name.upper()}_MODEL_BACKEND", "fp32"),
+        "calibration_directory": os.getenv("CALIBRATION_IMAGES_DIRECTORY"),
+        "runtime": os.getenv(f"{name.upper()}_MODEL_RUNTIME", "eager"),
+    }
+
+
+def load_shared_resources() -> dict:
+    """Loads the models and the resources of all projects. The models are read-only while serving requests, the resources of a project are only ever replaced as a whole (see ProjectRefresher). The models are returned as loaded, i.e. not yet prepared for their backend and runtime (see lifespan())."""
+    resources = {"models": {}, "weights_paths": {}}
+    for name in ["standard", "lightshow"]:
+        model, weights_path = load_model(os.environ[f"{name.upper()}_MODEL_NAME"])
+        resources["models"][name] = model
+        resources["weights_paths"][name] = weights_path
+
+    # Projects are either all built here or, if LAZY_PROJECTS is set, built on
+    # their first request, except for those listed in PRELOAD_PROJECTS
+    lazy = os.getenv("LAZY_PROJECTS", "false").lower() in ["true", "1"]
+    max_megabytes = os.getenv("PROJECT_CACHE_MAX_MB")
+    resources["projects"] = ProjectRegistry(
+        lazy=lazy,
+        max_bytes=(
+            int(float(max_megabytes) * 2**20)
+            if lazy and max_megabytes is not None
+            else None
+        ),
+        missing_ttl_s=float(os.getenv("PROJECT_MISSING_TTL", "30")),
+        geometry_cache_directory=os.getenv("GEOMETRY_CACHE_DIRECTORY"),
+    )
+    preload_projects = [
+        p for p in os.getenv("PRELOAD_PROJECTS", "").split(",") if p
+    ]
+    if not lazy or preload_projects:
+        resources["projects"].preload(
+            [
+                project
+                for project in create_project_source().load_all()
+                if not lazy or project["id"] in preload_projects
+            ],
+            max_workers=int(os.getenv("STARTUP_WORKERS", str(os.cpu_count()))),
+        )
+
+    return resources
+
+
+# With 'gunicorn --preload' (see gunicorn.conf.py), this module is imported
+# once in the master process before the workers are forked. Loading the shared
+# resources here lets all workers attach to the same physical memory instead
+# of loading private copies: model weights are shared through the page cache
+# of their memory-mapped file or, if not mapped, moved to shared memory, and
+# all objects created so far are excluded from garbage collection, which
+# would otherwise write to their pages and thereby copy them into every
+# worker.
+# Preparing models for other backends and runtimes runs them (e.g. int8
+# calibration, TorchScript tracing and ONNX export), which is not safe before
+# forking, as the OpenMP and MKL thread pools started by it do not survive
+# forks. It is done by every worker instead, see lifespan().
+shared_resources = None
+if os.getenv("PRELOAD_RESOURCES", "false").lower() in ["true", "1"]:
+    shared_resources = load_shared_resources()
+    for name, model in shared_resources["models"].items():
+        share_model_memory(model, shared_resources["weights_paths"][name])
+    gc.freeze()
+
+
 def check_api_key(key: str):
     if not key or key != os.environ["API_KEY"]:
         raise HTTPException(status_code=403, detail="Invalid API Key")
     return key
 
 
+def parse_save_predictions(save_predictions: str) -> bool:
+    if save_predictions.lower() in ["true", "1"]:
+        return True
+    if save_predictions.lower() in ["false", "0"]:
+        return False
+    raise HTTPException(
+        status_code=500,
+        detail="Error, invalid value for parameter 'save_predictions' provided.",
+    )
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    app_resources["models"] = {
-        "standard": initialize_model(os.environ["STANDARD_MODEL_NAME"]),
-        "lightshow": initialize_model(os.environ["LIGHTSHOW_MODEL_NAME"]),
-    }
-    app_resources["cosmosdb"] = create_cosmos_db_client("predictions")
+    app_resources.update(
+        shared_resources
+        if shared_resources is not None
+        else load_shared_resources()
+    )
+
+    # Models are prepared for their backend and runtime in every worker, as
+    # running models before workers are forked is not safe. Models prepared
+    # for 'fp32' with 'eager' stay the loaded (and possibly shared) ones.
+    # Models that are not run eagerly must predict the same counts as the
+    # loaded eager model they were prepared from.
+    reference_image = None
+    if os.getenv("PARITY_REFERENCE_IMAGE") is not None:
+        with open(os.environ["PARITY_REFERENCE_IMAGE"], "rb") as f:
+            reference_image = f.read()
+    models = {}
+    for name, model in app_resources["models"].items():
+        settings = model_settings(name)
+        models[name] = prepare_model(
+            model, app_resources["weights_paths"][name], **settings
+        )
+        if settings["runtime"] == "eager":
+            continue
+        error = check_parity(model, models[name], reference_image)
+        if error > float(os.getenv("PARITY_TOLERANCE", "0.001")):
+            raise RuntimeError(
+                f"The {name} model deviates by {error:.2%} from its eager version with runtime '{settings['runtime']}'."
+            )
+    app_resources["models"] = models
+
+    # Optionally batch concurrent forward passes of the same model. Every
+    # caller blocks one of the predict workers until its outputs are ready,
+    # hence a batch of single images can never be larger than their number
+    # and waiting for more would only delay every batch by max_wait_ms
+    predict_workers = int(os.getenv("PREDICT_WORKERS", "2"))
+    max_batch_size = min(
+        int(os.getenv("INFERENCE_MAX_BATCH_SIZE", "1")), predict_workers
+    )
+    if max_batch_size > 1:
+        app_resources["models"] = {
+            name: InferenceScheduler(
+                model=model,
+                max_batch_size=max_batch_size,
+                max_wait_ms=float(os.getenv("INFERENCE_MAX_WAIT_MS", "10")),
+            )
+            for name, model in app_resources["models"].items()
+        }
+    app_resources["prediction_store"] = create_prediction_store()
+
+    # Optionally return cached predictions for resent and, if a window is set,
+    # similar images instead of predicting and saving them again
+    app_resources["prediction_cache"] = None
+    if os.getenv("PREDICTION_CACHE_ENABLED", "false").lower() in ["true", "1"]:
+        similar_window = float(os.getenv("PREDICTION_CACHE_SIMILAR_WINDOW", "0"))
+        app_resources["prediction_cache"] = PredictionCache(
+            ttl_s=float(os.getenv("PREDICTION_CACHE_TTL", "300")),
+            max_entries=int(os.getenv("PREDICTION_CACHE_MAX_ENTRIES", "512")),
+            similar_window_s=similar_window if similar_window > 0 else None,
+            max_hash_distance=int(
+                os.getenv("PREDICTION_CACHE_MAX_HASH_DISTANCE", "8")
+            ),
+        )
 
-    (
-        app_resources["masks"],
-        app_resources["interpolators"],
-        app_resources["gridded_indices"],
-        app_resources["model_schedules"],
-    ) = process_project_metadata()
+    # Optionally keep the project resources up to date with the 'projects'
+    # container instead of requiring a restart after changes. Deleted
+    # projects are only polled for rarely, as that lists all projects.
+    app_resources["project_refresher"] = None
+    refresh_interval = float(os.getenv("PROJECT_REFRESH_INTERVAL", "0"))
+    if refresh_interval > 0:
+        app_resources["project_refresher"] = ProjectRefresher(
+            projects=app_resources["projects"],
+            source=create_project_source(),
+            interval_s=refresh_interval,
+            prediction_cache=app_resources["prediction_cache"],
+            deletion_interval_s=float(
+                os.getenv("PROJECT_DELETION_POLL_INTERVAL", "600")
+            ),
+        )
+        await app_resources["project_refresher"].start()
+
+    # Optionally persist predictions in the background instead of letting
+    # requests wait for blob storage and CosmosDB. Every worker process keeps
+    # its jobs in its own subdirectory of the directory.
+    app_resources["write_behind_queue"] = None
+    if os.getenv("WRITE_BEHIND_ENABLED", "false").lower() in ["true", "1"]:
+        app_resources["write_behind_queue"] = WriteBehindQueue(
+            prediction_store=app_resources["prediction_store"],
+            directory=os.getenv(
+                "WRITE_BEHIND_DIRECTORY",
+                os.path.join(tempfile.gettempdir(), "write_behind_queue"),
+            ),
+            max_size=int(os.getenv("WRITE_BEHIND_MAX_SIZE", "1000")),
+            num_workers=int(os.getenv("WRITE_BEHIND_WORKERS", "4")),
+        )
+        await app_resources["write_behind_queue"].start()
+
+    # CPU-bound prediction stages run on a dedicated pool, and requests beyond
+    # the in-flight limit are rejected instead of piling up
+    app_resources["executor"] = ThreadPoolExecutor(
+        max_workers=predict_workers,
+        thread_name_prefix="predict",
+    )
+    app_resources["limiter"] = InFlightLimiter(
+        max_in_flight=int(os.getenv("PREDICT_MAX_IN_FLIGHT", "8"))
+    )
+
+    # Request bodies beyond these sizes are rejected while they are read
+    app_resources["max_upload_bytes"] = int(
+        float(os.getenv("MAX_UPLOAD_MB", "32")) * 1024**2
+    )
+    app_resources["max_batch_upload_bytes"] = int(
+        float(os.getenv("MAX_BATCH_UPLOAD_MB", "256")) * 1024**2
+    )
+
+    # Batches are limited in their number of images and predicted in forward
+    # passes of limited size
+    app_resources["max_batch_entries"] = int(
+        os.getenv("BATCH_MAX_ENTRIES", "16")
+    )
+    app_resources["batch_forward_size"] = int(
+        os.getenv("BATCH_FORWARD_SIZE", "4")
+    )
+
+    # Optionally skip the black background of images that are not 16:9
+    app_resources["crop_letterbox"] = os.getenv(
+        "LETTERBOX_CROP", "false"
+    ).lower() in ["true", "1"]
 
     yield
+
+    if app_resources["project_refresher"] is not None:
+        await app_resources["project_refresher"].close()
+    app_resources["executor"].shutdown(wait=True)
+    if app_resources["write_behind_queue"] is not None:
+        await app_resources["write_behind_queue"].close(
+            timeout=float(os.getenv("WRITE_BEHIND_FLUSH_TIMEOUT", "30"))
+        )
+    await app_resources["prediction_store"].close()
+    for model in app_resources["models"].values():
+        if isinstance(model, InferenceScheduler):
+            model.close()
     app_resources.clear()
 
 
@@ -65,41 +287,129 @@ def health_check():
 # ------------------------------------------------------------------------------
 # Predict endpoint
 # ------------------------------------------------------------------------------
-@app.post("/predict")
+@app.post("/predict", response_model_exclude_none=True)
 async def predict_endpoint(
     request: Request,
     camera: str,
     project: str,
     position: str = "standard",
     save_predictions: str = "true",
+    return_ground_plane_density: bool = False,
     key: str = Depends(check_api_key),
 ) -> PredictReturnParams:
     """Returns a prediction for the image given in the request body.
     If specified, saves the image, returned predictions and heatmaps to the cloud.
+    If specified, also returns the density per square meter of the ground plane as (x, y, density) entries.
     """
-    if save_predictions.lower() in ["true", "1"]:
-        save_predictions_bool = True
-    elif save_predictions.lower() in ["false", "0"]:
-        save_predictions_bool = False
-    else:
+    save_predictions_bool = parse_save_predictions(save_predictions)
+
+    # Resolved once, so that the whole request uses the same version of the
+    # project even if it is updated in the meantime
+    project_resources = await app_resources["projects"].get(project)
+    if project_resources is None:
+        raise HTTPException(status_code=404, detail=f"Unknown project '{project}'.")
+
+    # Read before taking a slot, so that slow uploads do not hold one
+    image_bytes = await read_body(request, app_resources["max_upload_bytes"])
+
+    with app_resources["limiter"]:
+        return await predict_endpoint_implementation(
+            project=project,
+            camera=camera,
+            position=position,
+            save_predictions=save_predictions_bool,
+            image_bytes=image_bytes,
+            models=app_resources["models"],
+            prediction_store=app_resources["prediction_store"],
+            interpolators=project_resources.interpolators,
+            masks=project_resources.masks,
+            gridded_indices=project_resources.gridded_indices,
+            roi_boxes=project_resources.roi_boxes,
+            model_schedules=project_resources.model_schedules,
+            executor=app_resources["executor"],
+            write_behind_queue=app_resources["write_behind_queue"],
+            prediction_cache=app_resources["prediction_cache"],
+            return_ground_plane_density=return_ground_plane_density,
+            crop_letterbox=app_resources["crop_letterbox"],
+        )
+
+
+# ------------------------------------------------------------------------------
+# Batch predict endpoint
+# ------------------------------------------------------------------------------
+@app.post("/predict/batch", response_model_exclude_none=True)
+async def predict_batch_endpoint(
+    request: Request,
+    project: str,
+    save_predictions: str = "true",
+    return_ground_plane_density: bool = False,
+    key: str = Depends(check_api_key),
+) -> list[PredictReturnParams]:
+    """Returns predictions for all images of one project given in the request body as length-prefixed stream (see parse_batch()).
+    If specified, saves the images, returned predictions and heatmaps to the cloud.
+    If specified, also returns the density per square meter of the ground plane as (x, y, density) entries.
+    """
+    save_predictions_bool = parse_save_predictions(save_predictions)
+
+    try:
+        entries = parse_batch(
+            await read_body(request, app_resources["max_batch_upload_bytes"])
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Error, invalid batch: {e}")
+    if not entries:
+        raise HTTPException(status_code=400, detail="Error, the batch is empty.")
+    if len(entries) > app_resources["max_batch_entries"]:
         raise HTTPException(
-            status_code=500,
-            detail="Error, invalid value for parameter 'save_predictions' provided.",
+            status_code=413,
+            detail=f"Error, a batch can contain at most {app_resources['max_batch_entries']} images.",
         )
 
-    return predict_endpoint_implementation(
-        project=project,
-        camera=camera,
-        position=position,
-        save_predictions=save_predictions_bool,
-        image_bytes=await request.body(),
-        models=app_resources["models"],
-        cosmosdb_client=app_resources["cosmosdb"],
-        interpolators=app_resources["interpolators"][project],
-        masks=app_resources["masks"][project],
-        gridded_indices=app_resources["gridded_indices"][project],
-        model_schedules=app_resources["model_schedules"][project],
-    )
+    # Resolved once, so that the whole request uses the same version of the
+    # project even if it is updated in the meantime
+    project_resources = await app_resources["projects"].get(project)
+    if project_resources is None:
+        raise HTTPException(status_code=404, detail=f"Unknown project '{project}'.")
+
+    # Every image counts as one request in flight
+    with app_resources["limiter"].slots(len(entries)):
+        return await predict_batch_endpoint_implementation(
+            project=project,
+            entries=entries,
+            save_predictions=save_predictions_bool,
+            models=app_resources["models"],
+            prediction_store=app_resources["prediction_store"],
+            interpolators=project_resources.interpolators,
+            masks=project_resources.masks,
+            gridded_indices=project_resources.gridded_indices,
+            roi_boxes=project_resources.roi_boxes,
+            model_schedules=project_resources.model_schedules,
+            executor=app_resources["executor"],
+            write_behind_queue=app_resources["write_behind_queue"],
+            prediction_cache=app_resources["prediction_cache"],
+            return_ground_plane_density=return_ground_plane_density,
+            crop_letterbox=app_resources["crop_letterbox"],
+            max_batch_size=app_resources["batch_forward_size"],
+        )
+
+
+# ------------------------------------------------------------------------------
+# Metrics endpoint
+# ------------------------------------------------------------------------------
+@app.get("/metrics")
+async def metrics(key: str = Depends(check_api_key)) -> dict:
+    """Returns internal metrics of the prediction pipeline."""
+    result = {
+        "in_flight": app_resources["limiter"].in_flight,
+        "projects": app_resources["projects"].metrics(),
+    }
+    if app_resources["write_behind_queue"] is not None:
+        result["write_behind_queue"] = app_resources[
+            "write_behind_queue"
+        ].metrics()
+    if app_resources["prediction_cache"] is not None:
+        result["prediction_cache"] = app_resources["prediction_cache"].metrics()
+    return result
 
 
 # ------------------------------------------------------------------------------
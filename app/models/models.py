@@ -1,11 +1,31 @@
+import numpy as np
+import numpy.typing as npt
 from shapely.geometry import Polygon
 from datetime import time
 from pydantic import BaseModel
 
 
+# ------------------------------------------------------------------------------
+# Density maps are passed between all prediction stages as one contiguous
+# float32 array of shape (density_height, density_width). They are only turned
+# into lists where JSON output requires it.
+DensityMap = npt.NDArray[np.float32]
+
+
+def as_density_map(values) -> DensityMap:
+    """Returns the given values as a density map. Does not copy if they already are a contiguous float32 array."""
+    return np.ascontiguousarray(values, dtype=np.float32)
+
+
 # ------------------------------------------------------------------------------
 class Mask:
-    def __init__(self, name: str, polygon: Polygon, interpolate: bool):
+    def __init__(
+        self,
+        name: str,
+        polygon: Polygon,
+        interpolate: bool,
+        raster: np.ndarray,
+    ):
         if not isinstance(name, str):
             raise ValueError("name must be a string")
 
@@ -17,9 +37,13 @@ class Mask:
         if not isinstance(interpolate, bool):
             raise ValueError("interpolate must be a boolean")
 
+        if not isinstance(raster, np.ndarray) or raster.dtype != bool:
+            raise ValueError("raster must be a boolean numpy array")
+
         self.name = name
         self.interpolate = interpolate
         self.polygon = polygon
+        self.raster = raster
 
 
 # ------------------------------------------------------------------------------
@@ -61,6 +85,9 @@ class PredictReturnParams(BaseModel, extra="forbid"):
     project: str
     timestamp: str
     counts: dict[str, int]
+    ground_plane_density: list[tuple[float, float, float]] | None = None
+    # 'hit', 'similar' or 'miss' if the prediction cache is enabled
+    cache: str | None = None
 
     def to_cosmosdb_entry(self) -> dict:
-        return self.model_dump()
+        return self.model_dump(exclude={"ground_plane_density", "cache"})
@@ -94,6 +94,23 @@ def check_projects_implementation() -> dict:
                             f"Field 'coordinates_3D' of camera {camera} needs to have exactly 3 entries."
                         )
 
+            if "roi_only" in camera_settings.keys():
+                if not isinstance(camera_settings["roi_only"], bool):
+                    project_flaws.append(
+                        f"Field 'roi_only' of camera {camera} needs to be a boolean."
+                    )
+                elif camera_settings["roi_only"] and not any(
+                    [
+                        len(position_settings.get("area_metadata", {})) > 0
+                        for position_settings in camera_settings[
+                            "position_settings"
+                        ].values()
+                    ]
+                ):
+                    project_flaws.append(
+                        f"Camera {camera}: field 'roi_only' requires at least one area in 'area_metadata' of a position."
+                    )
+
             # --- Loop through position settings ---
             for position, position_settings in camera_settings[
                 "position_settings"
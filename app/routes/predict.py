@@ -1,118 +1,300 @@
+import asyncio
+from concurrent.futures import Executor
 from datetime import datetime
+from functools import partial
 from fastapi import HTTPException
 
 from app.models.models import PredictReturnParams
 
 from app.utils.model_prediction.make_prediction import make_prediction
+from app.utils.startup.perspective.transformed_density_helper_functions import (
+    GRIDDED_INDEX_VERSION,
+)
 from app.utils.database_helper_functions import (
-    save_image_to_blob,
-    save_downsized_image_to_blob,
-    prepare_heatmap,
-    save_density_to_blob,
-    save_transformed_density_to_blob,
+    original_image_artifact,
+    prepare_prediction_artifacts,
+)
+from app.utils.prediction_store import PredictionStore
+from app.utils.prediction_cache import (
+    PredictionCache,
+    cached_prediction,
+    cached_results,
 )
+from app.utils.write_behind_queue import WriteBehindQueue
 
 
 # ------------------------------------------------------------------------------
-def predict_endpoint_implementation(
+async def predict_endpoint_implementation(
     camera: str,
     position: str,
     project: str,
     save_predictions: bool,
     image_bytes: bytes,
     models,
-    cosmosdb_client,
+    prediction_store: PredictionStore,
     interpolators,
     masks,
     gridded_indices,
+    roi_boxes,
     model_schedules,
+    executor: Executor,
+    write_behind_queue: WriteBehindQueue | None = None,
+    prediction_cache: PredictionCache | None = None,
+    return_ground_plane_density: bool = False,
+    crop_letterbox: bool = False,
 ) -> PredictReturnParams:
+    """Makes a prediction for the given image and, if requested, saves it. CPU-bound stages run on the given executor and I/O runs asynchronously, so that the event loop is never blocked. Without a write-behind queue, the original image is uploaded while the prediction runs, otherwise saving is left to the background workers of the queue. If a prediction cache is given, resent images return their cached prediction without saving it again, and similar images reuse the cached density (see PredictionCache). If requested and the camera is calibrated, the density per square meter of the ground plane is part of the returned prediction."""
     # --- Preparatory definitions ---
+    loop = asyncio.get_running_loop()
     now = datetime.now()
     camera_pos = f"{camera}_{position}"
     prediction_id = (
         f"{project}-{camera}-{position}-{now.strftime('%Y_%m_%d-%H_%M_%S')}"
     )
+    timestamp = now.strftime("%Y-%m-%dT%H:%M:%SZ")
 
-    # --- Make prediction ---
-    try:
-        # Set up relevant arguments
-        pred_args = {
-            "model": (
-                models[
-                    (
-                        model_schedules[camera].determine_model(now.time())
-                        if camera in model_schedules.keys()
-                        else "standard"
-                    )
-                ]
-            ),
-            "image_bytes": image_bytes,
-        }
+    model_name = (
+        model_schedules[camera].determine_model(now.time())
+        if camera in model_schedules.keys()
+        else "standard"
+    )
 
-        if camera_pos in masks.keys():
-            pred_args["masks"] = masks[camera_pos]
-        if camera_pos in interpolators.keys():
-            pred_args["interpolator"] = interpolators[camera_pos]
+    # --- Look up the image in the prediction cache ---
+    status, cached, in_flight = None, None, []
+    if prediction_cache is not None:
+        fingerprint = await loop.run_in_executor(
+            executor, partial(prediction_cache.fingerprint, image_bytes)
+        )
+        # Retries of an image that is still being predicted wait for it
+        in_flight = [(project, camera_pos, model_name, fingerprint)]
+        await prediction_cache.wait_in_flight(in_flight)
+        status, cached = prediction_cache.lookup(
+            project, camera_pos, model_name, fingerprint
+        )
+        # Resent frames are neither predicted nor saved again
+        if status == "hit" and (cached["saved"] or not save_predictions):
+            return cached_prediction(cached, return_ground_plane_density)
+        # Resent frames that were not saved before are saved as they were
+        # returned
+        if status == "hit":
+            prediction_id = cached["prediction"].id
+            timestamp = cached["prediction"].timestamp
+        prediction_cache.begin(in_flight)
 
-        # Start prediction
-        prediction_results = make_prediction(**pred_args)
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Error while predicting: {e}",
+    try:
+        # The original image is final already, so its upload does not need to
+        # wait for the prediction
+        uploads = start_original_image_uploads(
+            [(prediction_id, image_bytes)] if save_predictions else [],
+            prediction_store,
+            write_behind_queue,
         )
 
-    if save_predictions:
-        # --- Save raw density, original image, heatmap, and, if present,
-        # transformed heatmap to blob storage ---
+        # --- Make prediction ---
         try:
-            save_density_to_blob(
-                density=prediction_results["prediction"],
-                image_name=prediction_id,
-            )
+            if cached is not None:
+                # Reuse the density of the cached image
+                prediction_results = await loop.run_in_executor(
+                    executor,
+                    partial(
+                        cached_results,
+                        cached,
+                        (
+                            image_bytes
+                            if save_predictions and write_behind_queue is None
+                            else None
+                        ),
+                    ),
+                )
+            else:
+                # Set up relevant arguments
+                pred_args = {
+                    "model": models[model_name],
+                    "image_bytes": image_bytes,
+                    "crop_letterbox": crop_letterbox,
+                }
+
+                if camera_pos in masks.keys():
+                    pred_args["masks"] = masks[camera_pos]
+                if camera_pos in interpolators.keys():
+                    pred_args["interpolator"] = interpolators[camera_pos]
+                if camera_pos in gridded_indices.keys():
+                    pred_args["gridded_indices"] = gridded_indices[camera_pos]
+                if camera_pos in roi_boxes.keys():
+                    pred_args["roi"] = roi_boxes[camera_pos]
 
-            save_image_to_blob(
-                image_bytes=image_bytes, image_name=prediction_id
+                # Start prediction
+                prediction_results = await loop.run_in_executor(
+                    executor, partial(make_prediction, **pred_args)
+                )
+        except Exception as e:
+            cancel_uploads(uploads)
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error while predicting: {e}",
             )
 
-            save_downsized_image_to_blob(
-                image_bytes=image_bytes, image_name=prediction_id
+        prediction = PredictReturnParams(
+            id=prediction_id,
+            project=project,
+            camera=camera,
+            position=position,
+            timestamp=timestamp,
+            counts=prediction_results["counts"],
+            ground_plane_density=(
+                prediction_results["transformed_density"].tolist()
+                if return_ground_plane_density
+                and prediction_results["transformed_density"] is not None
+                else None
+            ),
+            cache=status,
+        )
+
+        if save_predictions:
+            await persist_predictions(
+                predictions=[
+                    {
+                        "entry": prediction.to_cosmosdb_entry(),
+                        "image_bytes": image_bytes,
+                        "image": prediction_results["image"],
+                        "density": prediction_results["prediction"],
+                        "transformed_density": prediction_results[
+                            "transformed_density"
+                        ],
+                        "metadata": {
+                            "model": model_name,
+                            "gridded_index_version": GRIDDED_INDEX_VERSION,
+                        },
+                    }
+                ],
+                prediction_store=prediction_store,
+                executor=executor,
+                write_behind_queue=write_behind_queue,
+                uploads=uploads,
             )
 
-            save_image_to_blob(
-                image_bytes=prepare_heatmap(prediction_results["prediction"]),
-                image_name=f"{prediction_id}_heatmap",
+        # Stored once the prediction is persisted, so that failed saves are
+        # retried
+        if prediction_cache is not None:
+            prediction_cache.store(
+                project,
+                camera_pos,
+                model_name,
+                fingerprint,
+                prediction,
+                prediction_results,
+                saved=save_predictions,
+                reused=cached,
             )
 
-            if camera_pos in gridded_indices.keys():
-                save_transformed_density_to_blob(
-                    density=prediction_results["prediction"],
-                    gridded_indices=gridded_indices[camera_pos],
-                    image_name=prediction_id,
-                )
-        except Exception as e:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Error while saving to blob storage: {e}",
+        return prediction
+    finally:
+        if prediction_cache is not None:
+            prediction_cache.finish(in_flight)
+
+
+# ------------------------------------------------------------------------------
+def start_original_image_uploads(
+    images: list[tuple[str, bytes]],
+    prediction_store: PredictionStore,
+    write_behind_queue: WriteBehindQueue | None = None,
+) -> list[asyncio.Task]:
+    """Starts uploading the given (prediction id, original image) pairs to blob storage in the background and returns the tasks. Returns no tasks if a write-behind queue is given, as the images are then persisted together with the other artifacts."""
+    if write_behind_queue is not None:
+        return []
+    return [
+        asyncio.create_task(
+            prediction_store.upload(
+                *original_image_artifact(prediction_id, image_bytes)
             )
+        )
+        for prediction_id, image_bytes in images
+    ]
 
-    # --- Save prediction results to CosmosDB ---
-    prediction = PredictReturnParams(
-        id=prediction_id,
-        project=project,
-        camera=camera,
-        position=position,
-        timestamp=now.strftime("%Y-%m-%dT%H:%M:%SZ"),
-        counts=prediction_results["counts"],
-    )
-    if save_predictions:
-        try:
-            cosmosdb_client.upsert_item(body=prediction.to_cosmosdb_entry())
-        except Exception as e:
+
+# ------------------------------------------------------------------------------
+def cancel_uploads(uploads: list[asyncio.Task]) -> None:
+    """Cancels the given uploads, e.g. because their predictions failed."""
+    for upload in uploads:
+        upload.cancel()
+
+
+# ------------------------------------------------------------------------------
+async def persist_predictions(
+    predictions: list[dict],
+    prediction_store: PredictionStore,
+    executor: Executor,
+    write_behind_queue: WriteBehindQueue | None = None,
+    uploads: list[asyncio.Task] | None = None,
+) -> None:
+    """Hands the given predictions (see WriteBehindQueue, plus the decoded 'image') over to the write-behind queue if present, which prepares their artifacts in the background, responding with status 503 if it does not accept them. The queue accepts either all or none of them. Otherwise prepares the artifacts of all predictions on the given executor, saves them, waits for the given uploads of the original images that were started beforehand and afterwards saves the CosmosDB entries right away, each concurrently."""
+    loop = asyncio.get_running_loop()
+    uploads = uploads if uploads is not None else []
+
+    # --- Hand them over to the write-behind queue if present ---
+    if write_behind_queue is not None:
+        if not await write_behind_queue.put(predictions):
             raise HTTPException(
-                status_code=500,
-                detail=f"Error while saving to CosmosDB: {e}",
+                status_code=503,
+                detail="Error, predictions cannot be saved at the moment, please retry later.",
+                headers={"Retry-After": "1"},
             )
+        return
+
+    # --- Otherwise prepare raw density, original image (unless uploaded
+    # separately), heatmap, and, if present, transformed heatmap for blob
+    # storage ---
+    try:
+        artifacts = await asyncio.gather(
+            *[
+                loop.run_in_executor(
+                    executor,
+                    partial(
+                        prepare_prediction_artifacts,
+                        prediction_id=prediction["entry"]["id"],
+                        image_bytes=(
+                            prediction["image_bytes"] if not uploads else None
+                        ),
+                        image=prediction["image"],
+                        density=prediction["density"],
+                        transformed_density=prediction["transformed_density"],
+                        metadata=prediction["metadata"],
+                    ),
+                )
+                for prediction in predictions
+            ]
+        )
+    except Exception as e:
+        cancel_uploads(uploads)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error while preparing predictions for saving: {e}",
+        )
 
-    return prediction
+    # --- And save them to blob storage and CosmosDB right away ---
+    try:
+        await asyncio.gather(
+            prediction_store.save_artifacts(
+                [artifact for a in artifacts for artifact in a]
+            ),
+            *uploads,
+        )
+    except Exception as e:
+        cancel_uploads(uploads)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error while saving to blob storage: {e}",
+        )
+
+    try:
+        await asyncio.gather(
+            *[
+                prediction_store.upsert(prediction["entry"])
+                for prediction in predictions
+            ]
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error while saving to CosmosDB: {e}",
+        )
@@ -0,0 +1,288 @@
+import json
+import struct
+import asyncio
+from concurrent.futures import Executor
+from datetime import datetime
+from functools import partial
+from fastapi import HTTPException
+
+from app.models.models import PredictReturnParams
+
+from app.routes.predict import (
+    persist_predictions,
+    start_original_image_uploads,
+    cancel_uploads,
+)
+from app.utils.model_prediction.make_prediction import make_batch_prediction
+from app.utils.startup.perspective.transformed_density_helper_functions import (
+    GRIDDED_INDEX_VERSION,
+)
+from app.utils.prediction_store import PredictionStore
+from app.utils.prediction_cache import (
+    PredictionCache,
+    cached_prediction,
+    cached_results,
+)
+from app.utils.write_behind_queue import WriteBehindQueue
+
+
+# ------------------------------------------------------------------------------
+def parse_batch(body: bytes) -> list[tuple[str, str, bytes]]:
+    """Parses a length-prefixed stream of images. Every entry consists of the length of a JSON header as big-endian uint32, the header with the keys 'camera' and, optionally, 'position' (default 'standard'), the length of the image as big-endian uint32 and the image itself. Returns a list of (camera, position, image) tuples. Raises a ValueError if the stream is malformed."""
+    entries = []
+    offset = 0
+    while offset < len(body):
+        fields = []
+        for _ in range(2):
+            if offset + 4 > len(body):
+                raise ValueError(f"Truncated length at byte {offset}.")
+            (length,) = struct.unpack_from(">I", body, offset)
+            offset += 4
+            if offset + length > len(body):
+                raise ValueError(f"Truncated field at byte {offset}.")
+            fields.append(body[offset : offset + length])
+            offset += length
+
+        header = json.loads(fields[0])
+        if not isinstance(header, dict) or not isinstance(
+            header.get("camera"), str
+        ):
+            raise ValueError(f"Entry {len(entries)} has no valid 'camera'.")
+        entries.append(
+            (header["camera"], header.get("position", "standard"), fields[1])
+        )
+
+    return entries
+
+
+# ------------------------------------------------------------------------------
+async def predict_batch_endpoint_implementation(
+    project: str,
+    entries: list[tuple[str, str, bytes]],
+    save_predictions: bool,
+    models,
+    prediction_store: PredictionStore,
+    interpolators,
+    masks,
+    gridded_indices,
+    roi_boxes,
+    model_schedules,
+    executor: Executor,
+    write_behind_queue: WriteBehindQueue | None = None,
+    prediction_cache: PredictionCache | None = None,
+    return_ground_plane_density: bool = False,
+    crop_letterbox: bool = False,
+    max_batch_size: int = 4,
+) -> list[PredictReturnParams]:
+    """Makes predictions for the given (camera, position, image) entries of one project and, if requested, saves them together. Entries are grouped by the model their camera uses at the time of the request, and every group is predicted in batched forward passes of at most max_batch_size images while the original images are uploaded (see predict_endpoint_implementation()). Entries are looked up in the prediction cache if given, like in predict_endpoint_implementation(). Returns the predictions in the order of the entries."""
+    # --- Preparatory definitions ---
+    loop = asyncio.get_running_loop()
+    now = datetime.now()
+    camera_positions = [f"{camera}_{position}" for camera, position, _ in entries]
+    if len(set(camera_positions)) != len(camera_positions):
+        raise HTTPException(
+            status_code=400,
+            detail="Error, every camera and position may only occur once per batch.",
+        )
+    prediction_ids = [
+        f"{project}-{camera}-{position}-{now.strftime('%Y_%m_%d-%H_%M_%S')}"
+        for camera, position, _ in entries
+    ]
+    model_names = [
+        (
+            model_schedules[camera].determine_model(now.time())
+            if camera in model_schedules.keys()
+            else "standard"
+        )
+        for camera, _, _ in entries
+    ]
+
+    # --- Look up the images in the prediction cache ---
+    statuses = [None] * len(entries)
+    cached = [None] * len(entries)
+    images = []
+    if prediction_cache is not None:
+        fingerprints = await asyncio.gather(
+            *[
+                loop.run_in_executor(
+                    executor, partial(prediction_cache.fingerprint, image_bytes)
+                )
+                for _, _, image_bytes in entries
+            ]
+        )
+        # Retries of images that are still being predicted wait for them
+        images = [
+            (project, camera_positions[i], model_names[i], fingerprints[i])
+            for i in range(len(entries))
+        ]
+        await prediction_cache.wait_in_flight(images)
+        for i, fingerprint in enumerate(fingerprints):
+            statuses[i], cached[i] = prediction_cache.lookup(
+                project, camera_positions[i], model_names[i], fingerprint
+            )
+
+    # Resent frames are neither predicted nor saved again, all others are
+    # pending
+    predictions = [
+        (
+            cached_prediction(cached[i], return_ground_plane_density)
+            if statuses[i] == "hit" and (cached[i]["saved"] or not save_predictions)
+            else None
+        )
+        for i in range(len(entries))
+    ]
+    pending = [i for i, prediction in enumerate(predictions) if prediction is None]
+    in_flight = []
+    if prediction_cache is not None:
+        in_flight = [images[i] for i in pending]
+        prediction_cache.begin(in_flight)
+
+    try:
+        # Resent frames that were not saved before are saved as they were
+        # returned
+        timestamps = [now.strftime("%Y-%m-%dT%H:%M:%SZ")] * len(entries)
+        for i in pending:
+            if statuses[i] == "hit":
+                prediction_ids[i] = cached[i]["prediction"].id
+                timestamps[i] = cached[i]["prediction"].timestamp
+
+        uploads = start_original_image_uploads(
+            (
+                [(prediction_ids[i], entries[i][2]) for i in pending]
+                if save_predictions
+                else []
+            ),
+            prediction_store,
+            write_behind_queue,
+        )
+
+        # --- Make predictions ---
+        results = [None] * len(entries)
+        try:
+            # Reuse the densities of cached images and group the others by model
+            reused = [i for i in pending if cached[i] is not None]
+            groups = {}
+            for i in pending:
+                if cached[i] is not None:
+                    continue
+
+                request = {"image_bytes": entries[i][2]}
+                camera_pos = camera_positions[i]
+                if camera_pos in masks.keys():
+                    request["masks"] = masks[camera_pos]
+                if camera_pos in interpolators.keys():
+                    request["interpolator"] = interpolators[camera_pos]
+                if camera_pos in gridded_indices.keys():
+                    request["gridded_indices"] = gridded_indices[camera_pos]
+                if camera_pos in roi_boxes.keys():
+                    request["roi"] = roi_boxes[camera_pos]
+
+                groups.setdefault(model_names[i], []).append((i, request))
+
+            # Decode reused entries and predict every group on worker threads
+            reused_results, group_results = await asyncio.gather(
+                asyncio.gather(
+                    *[
+                        loop.run_in_executor(
+                            executor,
+                            partial(
+                                cached_results,
+                                cached[i],
+                                (
+                                    entries[i][2]
+                                    if save_predictions and write_behind_queue is None
+                                    else None
+                                ),
+                            ),
+                        )
+                        for i in reused
+                    ]
+                ),
+                asyncio.gather(
+                    *[
+                        loop.run_in_executor(
+                            executor,
+                            partial(
+                                make_batch_prediction,
+                                models[model_name],
+                                [request for _, request in group],
+                                crop_letterbox=crop_letterbox,
+                                max_batch_size=max_batch_size,
+                            ),
+                        )
+                        for model_name, group in groups.items()
+                    ]
+                ),
+            )
+        except Exception as e:
+            cancel_uploads(uploads)
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error while predicting: {e}",
+            )
+
+        for i, prediction_results in zip(reused, reused_results):
+            results[i] = prediction_results
+        for group, group_result in zip(groups.values(), group_results):
+            for (i, _), prediction_results in zip(group, group_result):
+                results[i] = prediction_results
+
+        for i in pending:
+            camera, position, _ = entries[i]
+            predictions[i] = PredictReturnParams(
+                id=prediction_ids[i],
+                project=project,
+                camera=camera,
+                position=position,
+                timestamp=timestamps[i],
+                counts=results[i]["counts"],
+                ground_plane_density=(
+                    results[i]["transformed_density"].tolist()
+                    if return_ground_plane_density
+                    and results[i]["transformed_density"] is not None
+                    else None
+                ),
+                cache=statuses[i],
+            )
+
+        if save_predictions and pending:
+            await persist_predictions(
+                predictions=[
+                    {
+                        "entry": predictions[i].to_cosmosdb_entry(),
+                        "image_bytes": entries[i][2],
+                        "image": results[i]["image"],
+                        "density": results[i]["prediction"],
+                        "transformed_density": results[i]["transformed_density"],
+                        "metadata": {
+                            "model": model_names[i],
+                            "gridded_index_version": GRIDDED_INDEX_VERSION,
+                        },
+                    }
+                    for i in pending
+                ],
+                prediction_store=prediction_store,
+                executor=executor,
+                write_behind_queue=write_behind_queue,
+                uploads=uploads,
+            )
+
+        # Stored once the predictions are persisted, so that failed saves are
+        # retried
+        if prediction_cache is not None:
+            for i in pending:
+                prediction_cache.store(
+                    project,
+                    camera_positions[i],
+                    model_names[i],
+                    fingerprints[i],
+                    predictions[i],
+                    results[i],
+                    saved=save_predictions,
+                    reused=cached[i],
+                )
+
+        return predictions
+    finally:
+        if prediction_cache is not None:
+            prediction_cache.finish(in_flight)
@@ -1,3 +1,17 @@
-from app.utils.model_prediction.make_prediction import initialize_model
+from app.utils.model_prediction.make_prediction import (
+    initialize_model,
+    load_model,
+    share_model_memory,
+    prepare_model,
+    check_parity,
+)
 from app.utils.database_helper_functions import create_cosmos_db_client
-from app.utils.startup.process_project_metadata import process_project_metadata
+from app.utils.model_prediction.inference_scheduler import InferenceScheduler
+from app.utils.concurrency import InFlightLimiter
+from app.utils.request_body import read_body
+from app.utils.prediction_store import create_prediction_store
+from app.utils.write_behind_queue import WriteBehindQueue
+from app.utils.prediction_cache import PredictionCache
+from app.utils.startup.project_sources import create_project_source
+from app.utils.startup.project_registry import ProjectRegistry
+from app.utils.startup.project_refresher import ProjectRefresher
@@ -0,0 +1,49 @@
+from contextlib import contextmanager
+
+from fastapi import HTTPException
+
+
+# ------------------------------------------------------------------------------
+class InFlightLimiter:
+    """Limits the number of requests that are processed at the same time. Requests beyond the limit are rejected right away instead of being queued, so that the latency of accepted requests stays bounded under load. Must only be used from the event loop."""
+
+    def __init__(self, max_in_flight: int):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be greater than or equal to 1.")
+
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+
+    # --------------------------------------------------------------------------
+    def __enter__(self):
+        self.__acquire__(1)
+        return self
+
+    # --------------------------------------------------------------------------
+    def __exit__(self, *args) -> None:
+        self.in_flight -= 1
+
+    # --------------------------------------------------------------------------
+    @contextmanager
+    def slots(self, count: int):
+        """Like using the limiter itself, but counts as the given number of requests, e.g. one per image of a batch. Counts beyond max_in_flight are rejected with status 413, as they would never fit."""
+        if count > self.max_in_flight:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Error, at most {self.max_in_flight} images can be processed at a time.",
+            )
+        self.__acquire__(count)
+        try:
+            yield self
+        finally:
+            self.in_flight -= count
+
+    # --------------------------------------------------------------------------
+    def __acquire__(self, count: int) -> None:
+        if self.in_flight + count > self.max_in_flight:
+            raise HTTPException(
+                status_code=503,
+                detail="Server is busy, please retry later.",
+                headers={"Retry-After": "1"},
+            )
+        self.in_flight += count
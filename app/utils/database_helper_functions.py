@@ -1,42 +1,120 @@
 import os
 import json
+import hashlib
+import tempfile
 import numpy as np
 import cv2
+from functools import cache
+from azure.core import MatchConditions
 from azure.storage.blob import BlobServiceClient
 from azure.cosmos import CosmosClient
 from PIL import Image
 import io
 
+from app.models.models import DensityMap
+from app.utils.density_format import (
+    get_density_storage_settings,
+    encode_density,
+)
+
 
 # ------------------------------------------------------------------------------
 # Ancillary definitions
 # ------------------------------------------------------------------------------
-def create_blob_client(blob_name, file_name):
-    blob_service_client = BlobServiceClient.from_connection_string(
+@cache
+def get_blob_service_client() -> BlobServiceClient:
+    """Returns a blob service client that is shared by all callers so that its connection pool is reused."""
+    return BlobServiceClient.from_connection_string(
         os.environ["BLOB_CONNECTION_STRING"]
     )
-    return blob_service_client.get_blob_client(blob_name, file_name)
 
 
 # ------------------------------------------------------------------------------
-def save_json_to_blob(json_data, file_name):
-    blob_client = create_blob_client(
-        blob_name="predictions",
-        file_name=file_name,
-    )
-    json_bytes = json.dumps(json_data).encode("utf-8")
-    blob_client.upload_blob(json_bytes)
+def create_blob_client(blob_name, file_name):
+    return get_blob_service_client().get_blob_client(blob_name, file_name)
 
 
 # ------------------------------------------------------------------------------
 # Helper functions
 # ------------------------------------------------------------------------------
-def download_model(model_name: str):
+def file_md5(file_path: str) -> bytes:
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(8 * 1024 * 1024), b""):
+            md5.update(chunk)
+    return md5.digest()
+
+
+# ------------------------------------------------------------------------------
+def file_state(file_path: str) -> dict:
+    """Returns the size and modification time of the given file, which change whenever it is replaced or written to."""
+    stat = os.stat(file_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+# ------------------------------------------------------------------------------
+def write_json_atomically(path: str, data: dict) -> None:
+    """Writes the given data as JSON to a temporary file and moves it into place, so that concurrent processes never read incomplete files."""
+    with open(f"{path}.{os.getpid()}", "w") as f:
+        json.dump(data, f)
+    os.replace(f"{path}.{os.getpid()}", path)
+
+
+# ------------------------------------------------------------------------------
+def download_model(model_name: str) -> str:
+    """Makes sure that the weights of the given model are in the local model cache (MODEL_CACHE_DIRECTORY) and returns the path to them. The weights are only downloaded if there is no cached copy whose ETag and, if present, MD5 checksum match the blob. The checksum of the cached copy is only computed again if its size or modification time changed since it was last verified. Downloads are streamed to disk."""
+    cache_directory = os.getenv(
+        "MODEL_CACHE_DIRECTORY", os.path.join(tempfile.gettempdir(), "model_cache")
+    )
+    os.makedirs(cache_directory, exist_ok=True)
+    model_path = os.path.join(cache_directory, f"{model_name}.pth")
+    metadata_path = os.path.join(cache_directory, f"{model_name}.json")
+
     blob_client = create_blob_client(
         blob_name="models",
         file_name=f"{model_name}.pth",
     )
-    return blob_client.download_blob().readall()
+    properties = blob_client.get_blob_properties()
+    content_md5 = properties.content_settings.content_md5
+    metadata = {
+        "etag": properties.etag,
+        "size": properties.size,
+        "content_md5": content_md5.hex() if content_md5 else None,
+    }
+
+    # --- Use the cached copy if it is still valid ---
+    if os.path.isfile(model_path) and os.path.isfile(metadata_path):
+        with open(metadata_path) as f:
+            cached_metadata = json.load(f)
+        verified_state = cached_metadata.pop("verified_state", None)
+        state = file_state(model_path)
+        if cached_metadata == metadata and state["size"] == metadata["size"]:
+            if content_md5 is None or verified_state == state:
+                return model_path
+            if file_md5(model_path) == content_md5:
+                write_json_atomically(
+                    metadata_path, metadata | {"verified_state": state}
+                )
+                return model_path
+
+    # --- Otherwise stream the blob to a temporary file and move it into
+    # place, so that concurrent processes never load incomplete weights ---
+    temporary_path = f"{model_path}.{os.getpid()}.download"
+    with open(temporary_path, "wb") as f:
+        blob_client.download_blob(
+            etag=properties.etag, match_condition=MatchConditions.IfNotModified
+        ).readinto(f)
+
+    if content_md5 is not None and file_md5(temporary_path) != content_md5:
+        os.remove(temporary_path)
+        raise ValueError(f"Checksum mismatch for downloaded model {model_name}.")
+
+    os.replace(temporary_path, model_path)
+    write_json_atomically(
+        metadata_path, metadata | {"verified_state": file_state(model_path)}
+    )
+
+    return model_path
 
 
 # ------------------------------------------------------------------------------
@@ -52,17 +130,10 @@ def create_cosmos_db_client(container_name: str):
 
 
 # ------------------------------------------------------------------------------
-def save_image_to_blob(image_bytes, image_name) -> None:
-    blob_client = create_blob_client(blob_name="images", file_name=f"{image_name}.jpg")
-    blob_client.upload_blob(image_bytes)
-
-
-# ------------------------------------------------------------------------------
-def prepare_heatmap(prediction: list[list[float]]):
+def prepare_heatmap(prediction: DensityMap):
     upper_bound = 1.0
 
-    heatmap = np.array(prediction)
-    heatmap[heatmap > upper_bound] = upper_bound
+    heatmap = np.minimum(prediction, upper_bound)
     heatmap = (heatmap / upper_bound * 255).astype(np.uint8)
 
     heatmap = cv2.applyColorMap(cv2.resize(heatmap, (960, 540)), cv2.COLORMAP_JET)
@@ -70,9 +141,7 @@ def prepare_heatmap(prediction: list[list[float]]):
 
 
 # ------------------------------------------------------------------------------
-def save_downsized_image_to_blob(image_bytes, image_name) -> None:
-    image = Image.open(io.BytesIO(image_bytes))
-
+def prepare_downsized_image(image: Image.Image) -> bytes:
     # Resize the image to 540p
     width, height = image.size
     if width > height:
@@ -86,48 +155,59 @@ def save_downsized_image_to_blob(image_bytes, image_name) -> None:
     # Convert the image to JPEG format with 80 quality
     output = io.BytesIO()
     resized_image.save(output, format="JPEG", quality=80)
-    output.seek(0)
-    resized_image_bytes = output.read()
-
-    # Upload the downsized image to blob storage
-    blob_client = create_blob_client(
-        blob_name="images",
-        file_name=f"{image_name}_small.jpg",
-    )
-    blob_client.upload_blob(resized_image_bytes)
+    return output.getvalue()
 
 
 # ------------------------------------------------------------------------------
-def save_density_to_blob(density: list[list[float]], image_name: str) -> None:
-    save_json_to_blob(density, f"{image_name}_density.json")
+def original_image_artifact(
+    prediction_id: str, image_bytes: bytes
+) -> tuple[str, str, bytes]:
+    """Returns the (container, file name, data) tuple of the original image of a prediction."""
+    return ("images", f"{prediction_id}.jpg", image_bytes)
 
 
 # ------------------------------------------------------------------------------
-def save_transformed_density_to_blob(
-    density: list[list[float]],
-    gridded_indices: dict[tuple[float, float], list[int]],
-    image_name: str,
-) -> None:
-    flattened_density = np.array(density).flatten()
-
-    transformed_density = [
+def prepare_prediction_artifacts(
+    prediction_id: str,
+    image_bytes: bytes | None,
+    image: Image.Image,
+    density: DensityMap,
+    transformed_density: np.ndarray | None = None,
+    metadata: dict | None = None,
+) -> list[tuple[str, str, bytes]]:
+    """Encodes everything that is saved to blob storage for a prediction: the raw density, the original image (unless it is None, e.g. because it is uploaded separately), a downsized version of the decoded image, the heatmap and, if given, the transformed density. Densities are saved in the format selected by the environment (see get_density_storage_settings()) and, if the format supports it, together with the given metadata. Returns a list of (container, file name, data) tuples."""
+    metadata = metadata if metadata is not None else {}
+    storage_settings = get_density_storage_settings()
+    extension = storage_settings["storage_format"]
+
+    artifacts = [
         (
-            x,
-            y,
-            np.sum(
-                flattened_density[
-                    np.array(
-                        [
-                            i
-                            for i in gridded_indices[(x, y)][0]
-                            if i < flattened_density.shape[0]
-                        ],
-                        dtype=np.int64,
-                    )
-                ]
-            ),
-        )
-        for x, y in gridded_indices.keys()
+            "predictions",
+            f"{prediction_id}_density.{extension}",
+            encode_density(density, metadata, **storage_settings),
+        ),
+        (
+            "images",
+            f"{prediction_id}_small.jpg",
+            prepare_downsized_image(image),
+        ),
+        ("images", f"{prediction_id}_heatmap.jpg", prepare_heatmap(density)),
     ]
+    if image_bytes is not None:
+        artifacts.append(original_image_artifact(prediction_id, image_bytes))
+
+    if transformed_density is not None:
+        # Real world coordinates need more precision than float16 offers
+        artifacts.append(
+            (
+                "predictions",
+                f"{prediction_id}_transformed_density.{extension}",
+                encode_density(
+                    transformed_density,
+                    metadata,
+                    **(storage_settings | {"dtype": "float32"}),
+                ),
+            )
+        )
 
-    save_json_to_blob(transformed_density, f"{image_name}_transformed_density.json")
+    return artifacts
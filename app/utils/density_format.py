@@ -0,0 +1,115 @@
+import io
+import os
+import json
+import zlib
+import struct
+import numpy as np
+
+# ------------------------------------------------------------------------------
+# Densities are saved in one of the following formats:
+# - "json": nested lists as JSON (compatible with older consumers)
+# - "npy": plain .npy file
+# - "tcd": the magic bytes TCDM, the length of a JSON header as little-endian
+#   uint32, the JSON header (shape, dtype, compression and the metadata given
+#   when encoding, e.g. model name and gridded index version) and the raw,
+#   optionally zlib compressed array data in C order.
+# The formats "npy" and "tcd" store float32 or float16 values.
+# ------------------------------------------------------------------------------
+DENSITY_FORMATS = ["json", "npy", "tcd"]
+DENSITY_DTYPES = ["float32", "float16"]
+DENSITY_COMPRESSIONS = ["none", "zlib"]
+TCD_MAGIC = b"TCDM"
+TCD_HEADER_KEYS = ["shape", "dtype", "compression"]
+
+
+# ------------------------------------------------------------------------------
+def get_density_storage_settings() -> dict:
+    """Returns the storage format, dtype and compression selected by the environment variables DENSITY_STORAGE_FORMAT (default 'json'), DENSITY_STORAGE_DTYPE (default 'float32') and DENSITY_STORAGE_COMPRESSION (default 'zlib', only used by 'tcd')."""
+    settings = {
+        "storage_format": os.getenv("DENSITY_STORAGE_FORMAT", "json"),
+        "dtype": os.getenv("DENSITY_STORAGE_DTYPE", "float32"),
+        "compression": os.getenv("DENSITY_STORAGE_COMPRESSION", "zlib"),
+    }
+
+    if settings["storage_format"] not in DENSITY_FORMATS:
+        raise ValueError(f"storage_format must be one of {DENSITY_FORMATS}.")
+    if settings["dtype"] not in DENSITY_DTYPES:
+        raise ValueError(f"dtype must be one of {DENSITY_DTYPES}.")
+    if settings["compression"] not in DENSITY_COMPRESSIONS:
+        raise ValueError(f"compression must be one of {DENSITY_COMPRESSIONS}.")
+
+    return settings
+
+
+# ------------------------------------------------------------------------------
+def encode_density(
+    array: np.ndarray,
+    metadata: dict,
+    storage_format: str = "json",
+    dtype: str = "float32",
+    compression: str = "zlib",
+) -> bytes:
+    """Encodes the given array in the given storage format. The metadata is only saved in the 'tcd' format, where it must not contain the keys the header describes the array with (see TCD_HEADER_KEYS)."""
+    reserved_keys = [key for key in TCD_HEADER_KEYS if key in metadata]
+    if reserved_keys:
+        raise ValueError(f"The metadata must not contain the keys {reserved_keys}.")
+
+    if storage_format == "json":
+        return json.dumps(array.tolist()).encode("utf-8")
+
+    array = np.ascontiguousarray(array, dtype=dtype)
+    if storage_format == "npy":
+        output = io.BytesIO()
+        np.save(output, array, allow_pickle=False)
+        return output.getvalue()
+
+    header = json.dumps(
+        {
+            "shape": list(array.shape),
+            "dtype": dtype,
+            "compression": compression,
+        }
+        | metadata
+    ).encode("utf-8")
+    payload = (
+        zlib.compress(memoryview(array))
+        if compression == "zlib"
+        else memoryview(array)
+    )
+    return b"".join([TCD_MAGIC, struct.pack("<I", len(header)), header, payload])
+
+
+# ------------------------------------------------------------------------------
+def decode_density(data: bytes) -> tuple[np.ndarray, dict]:
+    """Decodes a density saved in any of the storage formats and returns it together with its metadata (empty for 'json' and 'npy'). Uncompressed binary data is not copied, i.e. the returned array is a read-only view on the given bytes."""
+    if data[:4] == TCD_MAGIC:
+        (header_length,) = struct.unpack_from("<I", data, 4)
+        header = json.loads(bytes(data[8 : 8 + header_length]))
+        payload = memoryview(data)[8 + header_length :]
+        if header["compression"] == "zlib":
+            payload = zlib.decompress(payload)
+        array = np.frombuffer(payload, dtype=header["dtype"]).reshape(
+            header["shape"]
+        )
+        return array, header
+
+    if data[:6] == b"\x93NUMPY":
+        stream = io.BytesIO(data)
+        version = np.lib.format.read_magic(stream)
+        if version not in [(1, 0), (2, 0), (3, 0)]:
+            raise ValueError(f"Unsupported .npy version {version}.")
+        # Version 3.0 only differs from 2.0 in allowing UTF-8 in the header,
+        # which is ASCII for the plain dtypes of densities
+        read_array_header = (
+            np.lib.format.read_array_header_1_0
+            if version == (1, 0)
+            else np.lib.format.read_array_header_2_0
+        )
+        shape, fortran_order, dtype = read_array_header(stream)
+        array = np.frombuffer(data, dtype=dtype, offset=stream.tell())
+        return (
+            array.reshape(shape, order="F" if fortran_order else "C"),
+            {},
+        )
+
+    return np.array(json.loads(data), dtype=np.float32), {}
@@ -0,0 +1,88 @@
+import os
+import json
+import time
+import argparse
+
+from app.utils.model_prediction.backends import MODEL_BACKENDS
+from app.utils.model_prediction.make_prediction import (
+    initialize_model,
+    make_prediction,
+)
+
+
+# ------------------------------------------------------------------------------
+def create_accuracy_report(
+    model_name: str,
+    image_directory: str,
+    backends: list[str] = MODEL_BACKENDS,
+    calibration_directory: str | None = None,
+    max_relative_error: float = 0.02,
+) -> dict[str, dict]:
+    """Runs the given model with every given backend on all images in the given directory and compares the total counts with those of the fp32 backend. Returns a dict with backends as keys and dicts with the mean latency in milliseconds, the speedup over fp32, the mean absolute count error, the maximum relative count error and whether that stays within max_relative_error as values. The calibration directory should not contain the evaluated images."""
+    images = []
+    for file_name in sorted(os.listdir(image_directory)):
+        with open(os.path.join(image_directory, file_name), "rb") as f:
+            images.append(f.read())
+    if not images:
+        raise ValueError("The image directory does not contain any images.")
+
+    def run(backend: str) -> tuple[list[float], float]:
+        model = initialize_model(
+            model_name, backend=backend, calibration_directory=calibration_directory
+        )
+        make_prediction(model, images[0])  # Warm-up
+
+        counts = []
+        start = time.perf_counter()
+        for image_bytes in images:
+            counts.append(float(make_prediction(model, image_bytes)["prediction"].sum()))
+        return counts, 1000 * (time.perf_counter() - start) / len(images)
+
+    reference_counts, reference_latency = run("fp32")
+
+    report = {}
+    for backend in backends:
+        counts, latency = (
+            (reference_counts, reference_latency)
+            if backend == "fp32"
+            else run(backend)
+        )
+        errors = [abs(c - r) for c, r in zip(counts, reference_counts)]
+        relative_errors = [
+            e / max(r, 1) for e, r in zip(errors, reference_counts)
+        ]
+        report[backend] = {
+            "mean_latency_ms": latency,
+            "speedup": reference_latency / latency,
+            "mean_absolute_count_error": sum(errors) / len(errors),
+            "max_relative_count_error": max(relative_errors),
+            "within_tolerance": max(relative_errors) <= max_relative_error,
+        }
+
+    return report
+
+
+# ------------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compares the counts and latencies of the inference backends of a model with fp32."
+    )
+    parser.add_argument("model_name")
+    parser.add_argument("image_directory")
+    parser.add_argument("--backends", nargs="+", default=MODEL_BACKENDS)
+    parser.add_argument("--calibration-directory")
+    parser.add_argument("--max-relative-error", type=float, default=0.02)
+    args = parser.parse_args()
+
+    print(
+        json.dumps(
+            create_accuracy_report(
+                model_name=args.model_name,
+                image_directory=args.image_directory,
+                backends=args.backends,
+                calibration_directory=args.calibration_directory,
+                max_relative_error=args.max_relative_error,
+            ),
+            indent=4,
+        )
+    )
@@ -0,0 +1,93 @@
+import copy
+import logging
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from app.utils.model_prediction.dm_count import DMCount
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+# Backends a DMCount model can be run with on the CPU:
+# - "fp32": the model as it is
+# - "channels_last": fp32 with inputs and weights in NHWC memory format, which
+#   the oneDNN convolutions process without reordering
+# - "bf16": channels_last with convolutions in bfloat16 via autocast, which is
+#   only fast on CPUs with native bf16 support (AVX512-BF16 or AMX)
+# - "int8": static int8 quantization of the VGG19 backbone and the regression
+#   head, calibrated on representative inputs. The final 1x1 convolution stays
+#   in fp32, as small densities would not survive 8 bit quantization.
+# Dynamic quantization is not offered, as it only covers linear and recurrent
+# layers and DMCount consists of convolutions only.
+# ------------------------------------------------------------------------------
+MODEL_BACKENDS = ["fp32", "channels_last", "bf16", "int8"]
+
+
+# ------------------------------------------------------------------------------
+class ChannelsLastModel(nn.Module):
+    """Runs the wrapped model on inputs in channels_last memory format, optionally in bfloat16 autocast. Outputs are returned in fp32."""
+
+    def __init__(self, model: nn.Module, bf16: bool = False):
+        super(ChannelsLastModel, self).__init__()
+        self.model = model.to(memory_format=torch.channels_last)
+        self.bf16 = bf16
+
+    def forward(self, x):
+        x = x.contiguous(memory_format=torch.channels_last)
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=self.bf16):
+            outputs = self.model(x)
+        return outputs.float()
+
+
+# ------------------------------------------------------------------------------
+def quantize_static(
+    model: DMCount, calibration_inputs: list[torch.Tensor] | None
+) -> DMCount:
+    """Returns a copy of the given model with int8 backbone and regression head. Their activation ranges are observed while running the model on the given calibration inputs."""
+    if not calibration_inputs:
+        raise ValueError("int8 quantization needs at least one calibration input.")
+
+    qconfig_mapping = get_default_qconfig_mapping("x86")
+    quantized = copy.deepcopy(model)
+    quantized.features = prepare_fx(
+        quantized.features,
+        qconfig_mapping,
+        example_inputs=(torch.randn(1, 3, 64, 64),),
+    )
+    quantized.reg_layer = prepare_fx(
+        quantized.reg_layer,
+        qconfig_mapping,
+        example_inputs=(torch.randn(1, 512, 8, 8),),
+    )
+
+    with torch.no_grad():
+        for inputs in calibration_inputs:
+            quantized(inputs)
+
+    quantized.features = convert_fx(quantized.features)
+    quantized.reg_layer = convert_fx(quantized.reg_layer)
+    return quantized.eval()
+
+
+# ------------------------------------------------------------------------------
+def prepare_backend(
+    model: DMCount,
+    backend: str = "fp32",
+    calibration_inputs: list[torch.Tensor] | None = None,
+) -> nn.Module:
+    """Returns the given model prepared for the given backend (see MODEL_BACKENDS). The result is called like the given model and returns its outputs in fp32. Calibration inputs are only used by 'int8'."""
+    if backend not in MODEL_BACKENDS:
+        raise ValueError(f"backend must be one of {MODEL_BACKENDS}.")
+
+    if backend == "channels_last":
+        return ChannelsLastModel(model).eval()
+    if backend == "bf16":
+        if not torch.ops.mkldnn._is_mkldnn_bf16_supported():
+            logger.warning("This CPU has no native bf16 support, 'bf16' will be slow.")
+        return ChannelsLastModel(model, bf16=True).eval()
+    if backend == "int8":
+        return quantize_static(model, calibration_inputs)
+    return model
@@ -19,18 +19,14 @@ class DMCount(nn.Module):
         self.density_layer = nn.Sequential(nn.Conv2d(128, 1, 1), nn.ReLU())
 
     def forward(self, x):
-        # Predict density map mu
+        # Predict density map mu. The normalized density map of the original
+        # implementation is only needed for training and therefore left out.
         x = self.features(x)
-        x = nn.functional.upsample_bilinear(x, scale_factor=2)
+        x = nn.functional.interpolate(
+            x, scale_factor=2, mode="bilinear", align_corners=True
+        )
         x = self.reg_layer(x)
-        mu = self.density_layer(x)
-
-        # Normalize density map
-        B, C, H, W = mu.size()
-        mu_sum = mu.view([B, -1]).sum(1).unsqueeze(1).unsqueeze(2).unsqueeze(3)
-        mu_normed = mu / (mu_sum + 1e-6)
-
-        return mu, mu_normed
+        return self.density_layer(x)
 
 
 # ------------------------------------------------------------------------------
@@ -0,0 +1,115 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+
+# ------------------------------------------------------------------------------
+class InferenceScheduler:
+    """Collects preprocessed inputs for one model from concurrent callers and runs them as batched forward passes. A batch is started as soon as max_batch_size inputs are queued or the first queued input has waited for max_wait_ms milliseconds. Instances are called like the wrapped model and return the outputs belonging to the given input only."""
+
+    def __init__(self, model, max_batch_size: int = 4, max_wait_ms: float = 10):
+        """
+        Parameters:
+        model: torch.nn.Module
+            The model to run. Its outputs are either a tensor or a tuple of tensors with the batch dimension first.
+        max_batch_size: int
+            The maximum number of inputs in one forward pass.
+        max_wait_ms: float
+            The maximum time in milliseconds the first input of a batch waits for further inputs.
+        """
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be greater than or equal to 1.")
+        if max_wait_ms < 0:
+            raise ValueError("max_wait_ms must be greater than or equal to 0.")
+
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        # Guards closing, so that no input is queued after the worker has
+        # been told to stop
+        self.lock = threading.Lock()
+        self.closed = False
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(
+            target=self.__process_requests__, daemon=True
+        )
+        self.worker.start()
+
+    # --------------------------------------------------------------------------
+    def __call__(self, inputs: torch.Tensor):
+        """Queues the given inputs and blocks until the outputs for them have been computed."""
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("The inference scheduler has been closed.")
+            self.requests.put((inputs, future))
+        return future.result()
+
+    # --------------------------------------------------------------------------
+    def close(self) -> None:
+        """Runs all inputs that are already queued and stops the worker thread. Inputs given afterwards are rejected with a RuntimeError."""
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.requests.put(None)
+        self.worker.join()
+
+    # --------------------------------------------------------------------------
+    def __process_requests__(self) -> None:
+        stop = False
+        while not stop:
+            request = self.requests.get()
+            if request is None:
+                break
+
+            # Collect further requests until the batch is full or the
+            # deadline of its first request has passed
+            batch = [request]
+            batch_size = request[0].shape[0]
+            deadline = time.monotonic() + self.max_wait
+            while batch_size < self.max_batch_size:
+                try:
+                    request = self.requests.get(
+                        timeout=max(deadline - time.monotonic(), 0)
+                    )
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                batch.append(request)
+                batch_size += request[0].shape[0]
+
+            # Inputs can only be concatenated if they have the same shape
+            shapes = {}
+            for inputs, future in batch:
+                shapes.setdefault(tuple(inputs.shape[1:]), []).append(
+                    (inputs, future)
+                )
+            for requests in shapes.values():
+                self.__run_batch__(requests)
+
+    # --------------------------------------------------------------------------
+    def __run_batch__(self, requests: list[tuple[torch.Tensor, Future]]) -> None:
+        try:
+            # Gradient mode is thread-local, hence it is disabled here as well
+            with torch.no_grad():
+                outputs = self.model(torch.cat([inputs for inputs, _ in requests]))
+        except Exception as e:
+            for _, future in requests:
+                future.set_exception(e)
+            return
+
+        start = 0
+        for inputs, future in requests:
+            end = start + inputs.shape[0]
+            future.set_result(
+                outputs[start:end]
+                if isinstance(outputs, torch.Tensor)
+                else tuple(output[start:end] for output in outputs)
+            )
+            start = end
@@ -1,96 +1,412 @@
 import torch
 import io
+import os
+import math
+import logging
+import threading
+import numpy as np
 from PIL import Image
-from shapely.geometry import Point
-from torchvision.transforms import transforms
 
+from app.models.models import DensityMap, as_density_map
 from app.utils.model_prediction.dm_count import DMCount
+from app.utils.model_prediction.backends import prepare_backend
+from app.utils.model_prediction.runtimes import (
+    prepare_runtime,
+    relative_count_error,
+)
 from app.utils.database_helper_functions import download_model
 
+logger = logging.getLogger(__name__)
+
 # ------------------------------------------------------------------------------
 # Helper definitions and functions
 # ------------------------------------------------------------------------------
 fixed_width, fixed_height = 1920, 1080
+
+# DMCount halves its input four times (VGG19 max pooling, rounding down) and
+# upsamples the result once by a factor of two
+density_width, density_height = 2 * (fixed_width // 16), 2 * (fixed_height // 16)
 device = torch.device("cpu")
 
 # ------------------------------------------------------------------------------
-img_transform = transforms.Compose(
-    [
-        transforms.ToTensor(),
-        transforms.Normalize(
-            mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
-        ),
-    ]
-)
+# Normalization of the ImageNet-pretrained VGG19 backbone, applied to uint8
+# pixel values as value * input_scale - input_shift
+input_mean = torch.tensor([0.485, 0.456, 0.406])
+input_std = torch.tensor([0.229, 0.224, 0.225])
+input_scale = (1 / (255 * input_std)).view(3, 1, 1)
+input_shift = (input_mean / input_std).view(3, 1, 1)
+
+# Every thread normalizes into its own preallocated model input
+input_buffers = threading.local()
 
 
 # ------------------------------------------------------------------------------
-def resize(image: Image):
-    """Resizes the given image to the dimensions defined internally with a black background if it does not have the same aspect ratio. Returns the resized image."""
-    image.thumbnail((fixed_width, fixed_height), Image.LANCZOS)
+def decode_image(image_bytes: bytes) -> Image.Image:
+    """Decodes the given image once for all stages of a request. JPEGs that are larger than fixed_width x fixed_height are decoded at the smallest DCT scale (1/2, 1/4 or 1/8) that is still at least that large, which is much faster and needs less memory than decoding them at full size. Returns an RGB image that must not be modified, as it is shared between stages."""
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft("RGB", (fixed_width, fixed_height))
+    return image.convert("RGB")
 
-    # Fit image into black background of size fixed_width * fixed_height
-    ar_image = Image.new("RGB", (fixed_width, fixed_height))
-    ar_image.paste(
-        image,
-        ((fixed_width - image.width) // 2, (fixed_height - image.height) // 2),
+
+# ------------------------------------------------------------------------------
+def resize(image: Image.Image) -> Image.Image:
+    """Downsizes the given image to fit into the dimensions defined internally while keeping its aspect ratio, like Image.thumbnail() but without modifying the given image. Smaller images are not enlarged. Returns the resized image."""
+    if image.width <= fixed_width and image.height <= fixed_height:
+        return image
+
+    # Round the shorter side to the size closest to the original aspect ratio
+    aspect = image.width / image.height
+    if fixed_width / fixed_height >= aspect:
+        width, height = min(
+            math.floor(fixed_height * aspect),
+            math.ceil(fixed_height * aspect),
+            key=lambda n: abs(aspect - n / fixed_height),
+        ), fixed_height
+    else:
+        width, height = fixed_width, min(
+            math.floor(fixed_width / aspect),
+            math.ceil(fixed_width / aspect),
+            key=lambda n: abs(aspect - fixed_width / n) if n else 0,
+        )
+
+    return image.resize(
+        (max(width, 1), max(height, 1)), Image.LANCZOS, reducing_gap=2.0
+    )
+
+
+# ------------------------------------------------------------------------------
+def preprocess(image: Image.Image) -> tuple[torch.Tensor, tuple[int, int, int, int]]:
+    """Converts the given image to the normalized model input of size fixed_width x fixed_height, with the resized image centered on a black background if it does not have the same aspect ratio. The input is written to a buffer that is reused by the next call in the same thread. Returns the input and the (top, left, bottom, right) box of the image within it."""
+    if not hasattr(input_buffers, "inputs"):
+        input_buffers.inputs = torch.empty(
+            (1, 3, fixed_height, fixed_width), dtype=torch.float32, device=device
+        )
+    inputs = input_buffers.inputs
+
+    resized = resize(image)
+    left = (fixed_width - resized.width) // 2
+    top = (fixed_height - resized.height) // 2
+    right, bottom = left + resized.width, top + resized.height
+
+    # Fill the black background around the image, which is negative after
+    # normalization
+    black = -input_shift
+    inputs[0, :, :top].copy_(black.expand(3, top, fixed_width))
+    inputs[0, :, bottom:].copy_(black.expand(3, fixed_height - bottom, fixed_width))
+    inputs[0, :, top:bottom, :left].copy_(black.expand(3, resized.height, left))
+    inputs[0, :, top:bottom, right:].copy_(
+        black.expand(3, resized.height, fixed_width - right)
+    )
+
+    # Convert the HWC uint8 pixels into the CHW float image region in place
+    image_region = inputs[0, :, top:bottom, left:right]
+    # The decoded pixels are a read-only array, so they are copied through a
+    # numpy view of the input rather than wrapped in a tensor
+    np.copyto(image_region.numpy(), np.asarray(resized).transpose(2, 0, 1))
+    image_region.mul_(input_scale).sub_(input_shift)
+    return inputs, (top, left, bottom, right)
+
+
+# ------------------------------------------------------------------------------
+def crop_to_content(
+    inputs: torch.Tensor, box: tuple[int, int, int, int]
+) -> tuple[torch.Tensor, tuple[int, int]]:
+    """Crops the given model input to the smallest region around the given image box whose edges lie on multiples of 16 pixels (the total downscaling of the VGG19 pooling layers) or on the edges of the input. Density pixels of the cropped input then cover the same pixels as those of the whole input. Returns the cropped input and the (row, column) offset of its density within the density map of the whole input."""
+    top, left, bottom, right = box
+    crop_top, crop_left = top // 16 * 16, left // 16 * 16
+    crop_bottom = min(-(-bottom // 16) * 16, fixed_height)
+    crop_right = min(-(-right // 16) * 16, fixed_width)
+    return (
+        inputs[:, :, crop_top:crop_bottom, crop_left:crop_right],
+        (crop_top // 8, crop_left // 8),
     )
-    return ar_image
 
 
 # ------------------------------------------------------------------------------
-def initialize_model(model_name: str):
-    """Initializes the model and loads the weights from the blob storage. Returns the initialized model."""
+def place_density(density: np.ndarray, offset: tuple[int, int]) -> DensityMap:
+    """Places the given density of a cropped model input at the given offset into an otherwise empty density map of the whole input."""
+    if density.shape == (density_height, density_width):
+        return as_density_map(density)
+
+    density_map = np.zeros((density_height, density_width), dtype=np.float32)
+    row, column = offset
+    density_map[
+        row : row + density.shape[0], column : column + density.shape[1]
+    ] = density
+    return density_map
+
+
+# ------------------------------------------------------------------------------
+def load_calibration_inputs(directory: str) -> list[torch.Tensor]:
+    """Returns the model inputs of all images in the given directory."""
+    calibration_inputs = []
+    for file_name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, file_name), "rb") as f:
+            inputs, _ = preprocess(decode_image(f.read()))
+        # The input buffer is reused by the next call
+        calibration_inputs.append(inputs.clone())
+    return calibration_inputs
+
+
+# ------------------------------------------------------------------------------
+def load_model(model_name: str) -> tuple[DMCount, str]:
+    """Initializes the model and loads the weights from the local model cache, which is updated from the blob storage if necessary. Does not run the model, so that it is safe before forking worker processes. Returns the model in eval mode and the path to its weights."""
     model = DMCount()
     model.to(device)
+
+    # The weights are memory-mapped and assigned to the model as they are,
+    # i.e. they are neither read into memory upfront nor copied
+    weights_path = download_model(model_name)
     model.load_state_dict(
-        torch.load(io.BytesIO(download_model(model_name)), map_location="cpu")
+        torch.load(
+            weights_path,
+            map_location="cpu",
+            mmap=True,
+            weights_only=True,
+        ),
+        assign=True,
     )
     model.eval()
-    return model
+    return model, weights_path
+
+
+# ------------------------------------------------------------------------------
+def memory_mapped_ranges(path: str) -> list[tuple[int, int]]:
+    """Returns the (start, end) address ranges at which the given file is memory-mapped into this process. Returns no ranges where /proc/self/maps is not available."""
+    if not os.path.isfile("/proc/self/maps"):
+        return []
+    path = os.path.realpath(path)
+    ranges = []
+    with open("/proc/self/maps") as f:
+        for line in f:
+            fields = line.split(maxsplit=5)
+            if len(fields) == 6 and fields[5].rstrip("\n") == path:
+                start, end = fields[0].split("-")
+                ranges.append((int(start, 16), int(end, 16)))
+    return ranges
+
+
+# ------------------------------------------------------------------------------
+def share_model_memory(model: DMCount, weights_path: str) -> None:
+    """Moves the parameters and buffers of the given model to shared memory, except for those that are memory-mapped from the given weights file (see load_model()). Forked processes share the pages of these through the page cache already, and moving them would copy them into memory."""
+    mapped_ranges = memory_mapped_ranges(weights_path)
+    for tensor in [*model.parameters(), *model.buffers()]:
+        address = tensor.untyped_storage().data_ptr()
+        if not any(start <= address < end for start, end in mapped_ranges):
+            tensor.share_memory_()
 
 
 # ------------------------------------------------------------------------------
-def make_prediction(model, image_bytes, interpolator=None, masks=[]) -> dict:
-    """Takes a pytorch model, a binary image, an interpolator and potential masks as input. Returns a dict with the predicted density map, the total count of people in the image and (if present) the counts of all masks. The returned dict has the format
+def prepare_model(
+    model: DMCount,
+    weights_path: str,
+    backend: str = "fp32",
+    calibration_directory: str | None = None,
+    runtime: str = "eager",
+):
+    """Prepares the given model (see load_model()) for the given backend (see app.utils.model_prediction.backends), 'int8' being calibrated on the images in the given directory, and for execution by the given runtime (see app.utils.model_prediction.runtimes), which requires the 'fp32' backend unless it is 'eager'. All but 'fp32' with 'eager' run the model, which is not safe before forking worker processes. Returns the prepared model."""
+    if runtime != "eager" and backend != "fp32":
+        raise ValueError(f"The runtime '{runtime}' requires the backend 'fp32'.")
+    if backend == "int8" and calibration_directory is None:
+        raise ValueError("The backend 'int8' needs a calibration directory.")
+
+    if runtime != "eager":
+        return prepare_runtime(model, runtime, weights_path)
+    return prepare_backend(
+        model,
+        backend=backend,
+        calibration_inputs=(
+            load_calibration_inputs(calibration_directory)
+            if backend == "int8"
+            else None
+        ),
+    )
+
+
+# ------------------------------------------------------------------------------
+def initialize_model(
+    model_name: str,
+    backend: str = "fp32",
+    calibration_directory: str | None = None,
+    runtime: str = "eager",
+):
+    """Loads the given model and prepares it for the given backend and runtime, see load_model() and prepare_model(). Returns the initialized model."""
+    model, weights_path = load_model(model_name)
+    return prepare_model(
+        model,
+        weights_path,
+        backend=backend,
+        calibration_directory=calibration_directory,
+        runtime=runtime,
+    )
+
+
+# ------------------------------------------------------------------------------
+def check_parity(
+    reference, model, reference_image: bytes | None = None
+) -> float:
+    """Returns the relative difference between the total counts of the given model and of the given reference, usually the eager fp32 model it was prepared from (see load_model()), for the given reference image. Without an image, a fixed random input is used, which only shows that both compute the same function and is therefore logged as a warning."""
+    if reference_image is not None:
+        inputs, _ = preprocess(decode_image(reference_image))
+    else:
+        logger.warning(
+            "No reference image given, checking parity on random noise instead."
+        )
+        inputs = torch.randn(
+            (1, 3, fixed_height, fixed_width),
+            generator=torch.Generator().manual_seed(0),
+        )
+    return relative_count_error(reference, model, inputs)
+
+
+# ------------------------------------------------------------------------------
+def intersect_boxes(
+    box: tuple[int, int, int, int], other: tuple[int, int, int, int]
+) -> tuple[int, int, int, int] | None:
+    """Returns the intersection of the given (top, left, bottom, right) boxes or None if they do not overlap."""
+    top, left = max(box[0], other[0]), max(box[1], other[1])
+    bottom, right = min(box[2], other[2]), min(box[3], other[3])
+    if top >= bottom or left >= right:
+        return None
+    return top, left, bottom, right
+
+
+# ------------------------------------------------------------------------------
+def prepare_inputs(
+    image_bytes: bytes,
+    crop_letterbox: bool = False,
+    roi: tuple[int, int, int, int] | None = None,
+) -> tuple[Image.Image, torch.Tensor, tuple[int, int]]:
+    """Decodes and preprocesses the given image and, if crop_letterbox is True, crops the model input to the image region (see crop_to_content()). If a region of interest is given, the model input is cropped to its intersection with the image region. Returns the decoded image, the model input, which is only valid until the next call in the same thread, and the offset of its density within the density map."""
+    image = decode_image(image_bytes)
+    inputs, box = preprocess(image)
+    if roi is not None:
+        # Regions of interest outside of the image region cover background
+        # only, which is skipped like with crop_letterbox
+        box = intersect_boxes(box, roi) or box
+    offset = (0, 0)
+    if crop_letterbox or roi is not None:
+        inputs, offset = crop_to_content(inputs, box)
+    return image, inputs, offset
+
+
+# ------------------------------------------------------------------------------
+def evaluate_density(
+    density: np.ndarray,
+    offset: tuple[int, int],
+    image: Image.Image,
+    interpolator=None,
+    masks=[],
+    gridded_indices=None,
+) -> dict:
+    """Places, interpolates, counts and transforms the given model output for one image. Returns a dict in the format of make_prediction()."""
+    density_map: DensityMap = place_density(density, offset)
+    if interpolator != None:
+        density_map = interpolator(density_map, masks)
+
+    # Count by summing over all pixels (total and inside every mask's raster)
+    # and rounding to the nearest integer
+    counts = {"total": round(density_map.sum(dtype=np.float64))} | {
+        mask.name: round(density_map[mask.raster].sum(dtype=np.float64))
+        for mask in masks
+    }
+
+    # Transform density to the real world grid
+    transformed_density = (
+        gridded_indices.transform(density_map)
+        if gridded_indices is not None
+        else None
+    )
+
+    # Return density map, counts and transformed density
+    return {
+        "prediction": density_map,
+        "counts": counts,
+        "transformed_density": transformed_density,
+        "image": image,
+    }
+
+
+# ------------------------------------------------------------------------------
+def make_prediction(
+    model,
+    image_bytes,
+    interpolator=None,
+    masks=[],
+    gridded_indices=None,
+    crop_letterbox=False,
+    roi=None,
+) -> dict:
+    """Takes a pytorch model, a binary image, an interpolator, potential masks and potential gridded indices as input. If crop_letterbox is True, the model only runs on the image region of its input instead of the black background around images that are not 16:9, and the density of the background is zero. Likewise, if a region of interest (see create_roi_boxes()) is given, the model only runs on it and the density outside of it is zero. Returns a dict with the predicted density map, the total count of people in the image, (if present) the counts of all masks and (if gridded indices are given) the density transformed to the real world grid and the decoded image. The returned dict has the format
     {
-        "prediction": list[list[float]],
+        "prediction": DensityMap,
         "counts": {
                     "total": int,
                     "area_1": int,
                     "area_2": int,
                     ...
-                }
+                },
+        "transformed_density": np.ndarray of (x, y, density) rows or None,
+        "image": decoded image (see decode_image())
     }."""
-    # Preprocess given image
-    img = resize(Image.open(io.BytesIO(image_bytes)))
-    inputs = img_transform(img).unsqueeze(0).to(device)
+    # Decode and preprocess given image
+    image, inputs, offset = prepare_inputs(image_bytes, crop_letterbox, roi)
 
-    # Predict and interpolate
+    # Predict
     with torch.no_grad():
-        outputs, _ = model(inputs)
+        outputs = model(inputs)
 
-    density_map = outputs[0, 0].cpu().numpy().tolist()
-    if interpolator != None:
-        density_map = interpolator(density_map, masks)
+    return evaluate_density(
+        outputs[0, 0].cpu().numpy(),
+        offset,
+        image,
+        interpolator=interpolator,
+        masks=masks,
+        gridded_indices=gridded_indices,
+    )
 
-    # Count
-    predicted_count = 0
-    mask_counts = {mask.name: 0 for mask in masks}
-
-    # ... first sum over all pixels (total and inside every mask)
-    for i in range(len(density_map)):
-        for j in range(len(density_map[i])):
-            pixel_density_value = density_map[i][j]
-            predicted_count += pixel_density_value
-            for mask in masks:
-                if mask.polygon.covers(Point(j, i)):
-                    mask_counts[mask.name] += pixel_density_value
-
-    # ...  then round to nearest integer
-    counts = {"total": round(predicted_count)} | {
-        key: round(value) for key, value in mask_counts.items()
-    }
 
-    # Return density map and counts
-    return {"prediction": density_map, "counts": counts}
+# ------------------------------------------------------------------------------
+def make_batch_prediction(
+    model, requests: list[dict], crop_letterbox=False, max_batch_size=4
+) -> list[dict]:
+    """Like make_prediction() for several images and the same model. Every request is a dict with the keyword arguments 'image_bytes', 'interpolator', 'masks', 'gridded_indices' and 'roi' of make_prediction(), of which only 'image_bytes' is required. The requests are processed in chunks of max_batch_size, so that memory does not grow with their number, and images of a chunk whose model inputs have the same shape are predicted in one forward pass. Returns one dict in the format of make_prediction() per request."""
+    if max_batch_size < 1:
+        raise ValueError("max_batch_size must be greater than or equal to 1.")
+
+    results = []
+    for start in range(0, len(requests), max_batch_size):
+        chunk = requests[start : start + max_batch_size]
+
+        prepared = []
+        for request in chunk:
+            image, inputs, offset = prepare_inputs(
+                request["image_bytes"], crop_letterbox, request.get("roi")
+            )
+            # The input buffer is reused by the next call
+            prepared.append((image, inputs.clone(), offset))
+
+        shapes = {}
+        for i, (_, inputs, _) in enumerate(prepared):
+            shapes.setdefault(tuple(inputs.shape), []).append(i)
+
+        densities = [None] * len(prepared)
+        for indices in shapes.values():
+            with torch.no_grad():
+                outputs = model(torch.cat([prepared[i][1] for i in indices]))
+            for output, i in zip(outputs, indices):
+                densities[i] = output[0].cpu().numpy()
+
+        results += [
+            evaluate_density(
+                densities[i],
+                offset,
+                image,
+                interpolator=request.get("interpolator"),
+                masks=request.get("masks", []),
+                gridded_indices=request.get("gridded_indices"),
+            )
+            for i, (request, (image, _, offset)) in enumerate(zip(chunk, prepared))
+        ]
+
+    return results
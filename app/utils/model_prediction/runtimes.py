@@ -0,0 +1,127 @@
+import os
+import fcntl
+import threading
+
+import torch
+
+from app.utils.model_prediction.dm_count import DMCount
+
+# ------------------------------------------------------------------------------
+# Runtimes a DMCount model can be executed with:
+# - "eager": the PyTorch module as it is
+# - "torchscript": a traced, frozen and inference-optimized TorchScript graph,
+#   in which e.g. convolutions and activations are fused
+# - "onnxruntime": an ONNX graph run by the CPU provider of ONNX Runtime with
+#   all graph optimizations enabled (needs the package onnxruntime)
+# Exported graphs are saved next to the weights and rebuilt whenever the
+# weights are newer. Height and width of the inputs are dynamic in both.
+# ------------------------------------------------------------------------------
+MODEL_RUNTIMES = ["eager", "torchscript", "onnxruntime"]
+EXPORT_EXTENSIONS = {"torchscript": "ts", "onnxruntime": "onnx"}
+
+
+# ------------------------------------------------------------------------------
+def export_torchscript(model: DMCount, path: str) -> None:
+    """Exports the given model as frozen TorchScript graph to the given path."""
+    with torch.no_grad():
+        graph = torch.jit.freeze(
+            torch.jit.trace(model.eval(), torch.zeros(1, 3, 256, 256))
+        )
+    torch.jit.save(graph, path)
+
+
+# ------------------------------------------------------------------------------
+def export_onnx(model: DMCount, path: str) -> None:
+    """Exports the given model as ONNX graph with dynamic batch size, height and width to the given path."""
+    with torch.no_grad():
+        torch.onnx.export(
+            model.eval(),
+            torch.zeros(1, 3, 256, 256),
+            path,
+            input_names=["image"],
+            output_names=["density"],
+            dynamic_axes={
+                "image": {0: "batch", 2: "height", 3: "width"},
+                "density": {0: "batch", 2: "height", 3: "width"},
+            },
+            opset_version=17,
+        )
+
+
+# ------------------------------------------------------------------------------
+class OnnxRuntimeModel:
+    """Runs an exported ONNX graph with ONNX Runtime. Instances are called like the exported model. The inference session is created on the first call in every process, as its thread pool does not survive forking (see gunicorn.conf.py), even if an instance was created before forking."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.session = None
+        self.session_pid = None
+        self.lock = threading.Lock()
+
+    # --------------------------------------------------------------------------
+    def __call__(self, inputs: torch.Tensor) -> torch.Tensor:
+        session = self.__get_session__()
+        (outputs,) = session.run(
+            None, {"image": inputs.detach().contiguous().numpy()}
+        )
+        return torch.from_numpy(outputs)
+
+    # --------------------------------------------------------------------------
+    def __get_session__(self):
+        with self.lock:
+            if self.session is None or self.session_pid != os.getpid():
+                import onnxruntime
+
+                options = onnxruntime.SessionOptions()
+                options.graph_optimization_level = (
+                    onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+                )
+                self.session = onnxruntime.InferenceSession(
+                    self.path,
+                    sess_options=options,
+                    providers=["CPUExecutionProvider"],
+                )
+                self.session_pid = os.getpid()
+            return self.session
+
+
+# ------------------------------------------------------------------------------
+def prepare_runtime(model: DMCount, runtime: str, weights_path: str):
+    """Returns the given model for the given runtime (see MODEL_RUNTIMES). Non-eager runtimes export the model next to the given weights if it has not been exported since they changed. Exporting runs the model, so this must not be called before forking worker processes (see app.main)."""
+    if runtime not in MODEL_RUNTIMES:
+        raise ValueError(f"runtime must be one of {MODEL_RUNTIMES}.")
+    if runtime == "eager":
+        return model
+
+    path = f"{weights_path}.{EXPORT_EXTENSIONS[runtime]}"
+
+    # Workers starting at the same time wait for one of them to export, and
+    # the others load its result
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.isfile(path) or os.path.getmtime(
+            path
+        ) < os.path.getmtime(weights_path):
+            # Export to a temporary file first, so that processes that do not
+            # take the lock never load incomplete graphs
+            temporary_path = f"{path}.{os.getpid()}.tmp"
+            if runtime == "torchscript":
+                export_torchscript(model, temporary_path)
+            else:
+                export_onnx(model, temporary_path)
+            os.replace(temporary_path, path)
+
+    if runtime == "torchscript":
+        return torch.jit.optimize_for_inference(torch.jit.load(path))
+    return OnnxRuntimeModel(path)
+
+
+# ------------------------------------------------------------------------------
+def relative_count_error(
+    reference, model, inputs: torch.Tensor
+) -> float:
+    """Returns the relative difference between the total counts the given models predict for the given inputs."""
+    with torch.no_grad():
+        expected = float(reference(inputs).sum())
+        actual = float(model(inputs).sum())
+    return abs(actual - expected) / max(abs(expected), 1e-6)
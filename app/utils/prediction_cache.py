@@ -0,0 +1,237 @@
+import io
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from app.models.models import PredictReturnParams
+from app.utils.model_prediction.make_prediction import decode_image
+
+# ------------------------------------------------------------------------------
+# Predictions are cached per project, camera position and model under the
+# SHA-256 digest of the encoded image, so that resent frames are neither
+# predicted nor saved again. Optionally, frames whose perceptual hash differs
+# from that of the last predicted frame of their camera position in at most
+# max_hash_distance bits reuse its density for similar_window_s seconds after
+# it was predicted, which covers e.g. static scenes at night. The window is not
+# extended by reuse, so slowly changing scenes are predicted again at least
+# once per window. Images that are being predicted are tracked until their
+# entry is stored, so that retries sent while the original request still runs
+# wait for it instead of being predicted and saved a second time.
+# ------------------------------------------------------------------------------
+HASH_SIZE = 16
+
+
+# ------------------------------------------------------------------------------
+def perceptual_hash(image_bytes: bytes) -> int:
+    """Returns the difference hash (dHash) of the given encoded image: it is shrunk to HASH_SIZE + 1 x HASH_SIZE grayscale pixels, and every bit tells whether a pixel is brighter than its left neighbour."""
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft("L", (4 * HASH_SIZE, 4 * HASH_SIZE))
+    pixels = np.asarray(
+        image.convert("L").resize(
+            (HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BILINEAR
+        ),
+        dtype=np.int16,
+    )
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+# ------------------------------------------------------------------------------
+def cached_results(entry: dict, image_bytes: bytes | None = None) -> dict:
+    """Returns the prediction of the given cache entry in the format of make_prediction(). The image is only decoded if given, e.g. because the prediction is saved."""
+    return {
+        "prediction": entry["density"],
+        "counts": entry["prediction"].counts,
+        "transformed_density": entry["transformed_density"],
+        "image": decode_image(image_bytes) if image_bytes is not None else None,
+    }
+
+
+# ------------------------------------------------------------------------------
+def cached_prediction(
+    entry: dict, return_ground_plane_density: bool = False
+) -> PredictReturnParams:
+    """Returns the prediction of the given cache entry as it was returned originally, marked as cache hit."""
+    return entry["prediction"].model_copy(
+        update={
+            "cache": "hit",
+            "ground_plane_density": (
+                entry["transformed_density"].tolist()
+                if return_ground_plane_density
+                and entry["transformed_density"] is not None
+                else None
+            ),
+        }
+    )
+
+
+# ------------------------------------------------------------------------------
+def in_flight_key(image: tuple[str, str, str, tuple]) -> tuple[str, str, str, str]:
+    """Returns the key of the given (project, camera position, model, fingerprint) image, which is the key of its entry."""
+    project, camera_pos, model_name, (digest, _) = image
+    return project, camera_pos, model_name, digest
+
+
+# ------------------------------------------------------------------------------
+class PredictionCache:
+    """Recent predictions, looked up by project, camera position, model and image (see above). Entries expire ttl_s seconds after they were stored and the least recently used ones are evicted beyond max_entries. The perceptual mode is disabled if similar_window_s is None. Must only be used from the event loop, apart from fingerprint()."""
+
+    def __init__(
+        self,
+        ttl_s: float = 300,
+        max_entries: int = 512,
+        similar_window_s: float | None = None,
+        max_hash_distance: int = 8,
+    ):
+        if max_entries < 1:
+            raise ValueError("max_entries must be greater than or equal to 1.")
+
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.similar_window_s = similar_window_s
+        self.max_hash_distance = max_hash_distance
+
+        self.entries = OrderedDict()
+        self.latest = {}
+        self.in_flight = {}
+        self.counters = {
+            "hits": 0,
+            "similar_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "in_flight_waits": 0,
+        }
+
+    # --------------------------------------------------------------------------
+    def fingerprint(self, image_bytes: bytes) -> tuple[str, int | None]:
+        """Returns the digest and, in the perceptual mode, the perceptual hash of the given encoded image. Thread-safe, meant to run on an executor."""
+        return (
+            hashlib.sha256(image_bytes).hexdigest(),
+            (
+                perceptual_hash(image_bytes)
+                if self.similar_window_s is not None
+                else None
+            ),
+        )
+
+    # --------------------------------------------------------------------------
+    async def wait_in_flight(self, images: list[tuple[str, str, str, tuple]]) -> None:
+        """Waits until none of the given (project, camera position, model, fingerprint) images is being predicted by another request (see begin())."""
+        while True:
+            futures = [
+                self.in_flight[key]
+                for key in map(in_flight_key, images)
+                if key in self.in_flight
+            ]
+            if not futures:
+                return
+            self.counters["in_flight_waits"] += 1
+            # Waiting is cancelled together with the request, the futures
+            # stay untouched
+            await asyncio.wait(futures)
+
+    # --------------------------------------------------------------------------
+    def begin(self, images: list[tuple[str, str, str, tuple]]) -> None:
+        """Marks the given images as being predicted, see wait_in_flight(). Must be called right after looking them up, without awaiting anything in between, and be followed by finish(), also if the prediction fails."""
+        loop = asyncio.get_running_loop()
+        for key in map(in_flight_key, images):
+            self.in_flight[key] = loop.create_future()
+
+    # --------------------------------------------------------------------------
+    def finish(self, images: list[tuple[str, str, str, tuple]]) -> None:
+        """Marks the given images as no longer being predicted and wakes up the requests waiting for them, which then look them up again."""
+        for key in map(in_flight_key, images):
+            future = self.in_flight.pop(key, None)
+            if future is not None:
+                future.set_result(None)
+
+    # --------------------------------------------------------------------------
+    def lookup(
+        self,
+        project: str,
+        camera_pos: str,
+        model_name: str,
+        fingerprint: tuple[str, int | None],
+    ) -> tuple[str, dict | None]:
+        """Returns 'hit' and the entry of the same image, 'similar' and the entry of the last predicted similar image or 'miss' and None."""
+        now = time.monotonic()
+        digest, image_hash = fingerprint
+
+        key = (project, camera_pos, model_name, digest)
+        entry = self.entries.get(key)
+        if entry is not None and now - entry["stored_at"] > self.ttl_s:
+            del self.entries[key]
+            entry = None
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return "hit", entry
+
+        latest = self.latest.get((project, camera_pos, model_name))
+        if latest is not None and now - latest["predicted_at"] > self.similar_window_s:
+            del self.latest[(project, camera_pos, model_name)]
+            latest = None
+        if (
+            latest is not None
+            and (latest["hash"] ^ image_hash).bit_count() <= self.max_hash_distance
+        ):
+            self.counters["similar_hits"] += 1
+            return "similar", latest
+
+        self.counters["misses"] += 1
+        return "miss", None
+
+    # --------------------------------------------------------------------------
+    def store(
+        self,
+        project: str,
+        camera_pos: str,
+        model_name: str,
+        fingerprint: tuple[str, int | None],
+        prediction: PredictReturnParams,
+        results: dict,
+        saved: bool,
+        reused: dict | None = None,
+    ) -> None:
+        """Stores the given prediction and its results (see make_prediction()) for the given image. Saved tells whether the prediction has been persisted. Reused is the entry the results were taken from, if any."""
+        now = time.monotonic()
+        digest, image_hash = fingerprint
+
+        entry = {
+            "prediction": prediction.model_copy(
+                update={"cache": None, "ground_plane_density": None}
+            ),
+            "density": results["prediction"],
+            "transformed_density": results["transformed_density"],
+            "saved": saved,
+            "stored_at": now,
+            "predicted_at": reused["predicted_at"] if reused is not None else now,
+            "hash": reused["hash"] if reused is not None else image_hash,
+        }
+
+        key = (project, camera_pos, model_name, digest)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+        # Only predicted frames are references for similar ones
+        if image_hash is not None and reused is None:
+            self.latest[(project, camera_pos, model_name)] = entry
+
+    # --------------------------------------------------------------------------
+    def clear_project(self, project: str) -> None:
+        """Removes all entries of the given project, e.g. because its masks changed."""
+        for key in [key for key in self.entries if key[0] == project]:
+            del self.entries[key]
+        for key in [key for key in self.latest if key[0] == project]:
+            del self.latest[key]
+
+    # --------------------------------------------------------------------------
+    def metrics(self) -> dict:
+        return {"entries": len(self.entries)} | self.counters
@@ -0,0 +1,101 @@
+import os
+import json
+import asyncio
+from azure.storage.blob.aio import BlobServiceClient
+from azure.cosmos.aio import CosmosClient
+
+
+# ------------------------------------------------------------------------------
+class PredictionStore:
+    """Persists prediction artifacts to blob storage and prediction entries to the 'predictions' CosmosDB container. Uses long-lived asynchronous clients whose connection pools are shared by all requests and uploads all artifacts of a prediction concurrently."""
+
+    def __init__(self):
+        self.blob_service_client = BlobServiceClient.from_connection_string(
+            os.environ["BLOB_CONNECTION_STRING"]
+        )
+        self.cosmos_client = CosmosClient(
+            url=os.getenv("COSMOS_DB_ENDPOINT"),
+            credential=os.getenv("COSMOS_DB_PRIMARY_KEY"),
+        )
+        self.container = self.cosmos_client.get_database_client(
+            os.getenv("COSMOS_DB_DATABASE_NAME")
+        ).get_container_client("predictions")
+
+    # --------------------------------------------------------------------------
+    async def save_artifacts(self, artifacts: list[tuple[str, str, bytes]]) -> None:
+        """Uploads the given (container, file name, data) tuples concurrently."""
+        await asyncio.gather(
+            *[
+                self.upload(container, file_name, data)
+                for container, file_name, data in artifacts
+            ]
+        )
+
+    # --------------------------------------------------------------------------
+    async def upload(self, container: str, file_name: str, data: bytes) -> None:
+        blob_client = self.blob_service_client.get_blob_client(
+            container, file_name
+        )
+        # Overwriting makes retries of partially persisted predictions possible
+        await blob_client.upload_blob(data, overwrite=True)
+
+    # --------------------------------------------------------------------------
+    async def upsert(self, entry: dict) -> None:
+        await self.container.upsert_item(body=entry)
+
+    # --------------------------------------------------------------------------
+    async def close(self) -> None:
+        await self.blob_service_client.close()
+        await self.cosmos_client.close()
+
+
+# ------------------------------------------------------------------------------
+class LocalPredictionStore(PredictionStore):
+    """Stand-in for PredictionStore that keeps blobs and CosmosDB entries in memory or, if a directory is given, writes them to '<directory>/<container>/<file name>' and '<directory>/cosmosdb/<id>.json'. Meant for local development and tests."""
+
+    def __init__(self, directory: str | None = None):
+        self.directory = directory
+        self.blobs = {}
+        self.entries = {}
+
+    # --------------------------------------------------------------------------
+    async def upload(self, container: str, file_name: str, data: bytes) -> None:
+        if self.directory is None:
+            self.blobs[(container, file_name)] = bytes(data)
+        else:
+            await asyncio.to_thread(
+                self.__write_file__, container, file_name, data
+            )
+
+    # --------------------------------------------------------------------------
+    async def upsert(self, entry: dict) -> None:
+        if self.directory is None:
+            self.entries[entry["id"]] = entry
+        else:
+            await asyncio.to_thread(
+                self.__write_file__,
+                "cosmosdb",
+                f"{entry['id']}.json",
+                json.dumps(entry).encode("utf-8"),
+            )
+
+    # --------------------------------------------------------------------------
+    async def close(self) -> None:
+        pass
+
+    # --------------------------------------------------------------------------
+    def __write_file__(self, container: str, file_name: str, data: bytes) -> None:
+        os.makedirs(os.path.join(self.directory, container), exist_ok=True)
+        with open(os.path.join(self.directory, container, file_name), "wb") as f:
+            f.write(data)
+
+
+# ------------------------------------------------------------------------------
+def create_prediction_store() -> PredictionStore:
+    """Returns the prediction store selected by the environment variable PREDICTION_STORE, which is either 'azure' (default) or 'local'. The local store writes to LOCAL_STORE_DIRECTORY if it is set and keeps everything in memory otherwise."""
+    store_type = os.getenv("PREDICTION_STORE", "azure")
+    if store_type == "azure":
+        return PredictionStore()
+    if store_type == "local":
+        return LocalPredictionStore(os.getenv("LOCAL_STORE_DIRECTORY"))
+    raise ValueError(f"Unknown prediction store '{store_type}'.")
@@ -0,0 +1,29 @@
+from fastapi import HTTPException, Request
+
+
+# ------------------------------------------------------------------------------
+async def read_body(request: Request, max_bytes: int) -> bytes:
+    """Reads the body of the given request chunk by chunk as it arrives and returns it in one piece, so it takes as much memory as with request.body(). Bodies that are larger than max_bytes are rejected with status 413, based on the Content-Length header before anything is read if the client sends one, and as soon as the limit is exceeded otherwise."""
+    content_length = request.headers.get("content-length")
+    if content_length is not None and content_length.isdigit():
+        if int(content_length) > max_bytes:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Error, the request body exceeds {max_bytes} bytes.",
+            )
+
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Error, the request body exceeds {max_bytes} bytes.",
+            )
+        chunks.append(chunk)
+
+    # The whole body is held in memory like with request.body(), as the
+    # fingerprint, the decoder and the uploads all need it in one piece. Only
+    # oversized bodies are cut short
+    return b"".join(chunks)
@@ -0,0 +1,198 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from shapely import Polygon
+
+from app.models.models import Mask
+from app.utils.startup.create_masks import create_masks, create_roi_boxes
+from app.utils.startup.selective_idw_interpolator import (
+    SIDWInterpolator,
+    create_interpolators,
+)
+from app.utils.startup.perspective.transformed_density_helper_functions import (
+    GRIDDED_INDEX_VERSION,
+    GriddedIndices,
+    calculate_gridded_indices,
+)
+
+# Version of the code that derives geometry from camera settings. It is part
+# of every cache key and needs to be increased whenever masks, interpolators
+# or gridded indices are computed differently.
+GEOMETRY_VERSION = f"2.{GRIDDED_INDEX_VERSION}"
+
+
+# ------------------------------------------------------------------------------
+def compute_camera_geometry(camera_id: str, camera_data: dict) -> dict:
+    """Computes masks, interpolators, gridded indices and regions of interest for all positions of the given camera. Returns a dict with the keys 'masks', 'interpolators', 'gridded_indices' and 'roi_boxes', each holding a dict with camera ids + positions as keys."""
+    cameras = {camera_id: camera_data}
+    masks = create_masks(cameras)
+    interpolators = create_interpolators(cameras)
+    return {
+        "masks": masks,
+        "interpolators": interpolators,
+        "gridded_indices": calculate_gridded_indices(cameras),
+        "roi_boxes": create_roi_boxes(cameras, masks, interpolators),
+    }
+
+
+# ------------------------------------------------------------------------------
+def camera_geometry_key(camera_id: str, camera_data: dict) -> str:
+    """Returns a hash of the given camera settings and the geometry code version."""
+    return hashlib.sha256(
+        json.dumps(
+            {
+                "camera": camera_id,
+                "settings": camera_data,
+                "version": GEOMETRY_VERSION,
+            },
+            sort_keys=True,
+            default=str,
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+# ------------------------------------------------------------------------------
+class GeometryCache:
+    """On-disk cache of the geometry derived from camera settings. Every camera is stored in its own directory, named after the hash of its settings, with one .npy file per array and a manifest. Arrays are loaded as read-only memory maps, so that processes on the same machine share their pages. Only cameras whose settings changed are recomputed."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    # --------------------------------------------------------------------------
+    def get(self, camera_id: str, camera_data: dict) -> dict:
+        """Returns the geometry of the given camera in the format of compute_camera_geometry(). Loads it from the cache if possible and computes and stores it otherwise."""
+        geometry = self.load(camera_id, camera_data)
+        if geometry is None:
+            geometry = compute_camera_geometry(camera_id, camera_data)
+            self.store(camera_id, camera_data, geometry)
+        return geometry
+
+    # --------------------------------------------------------------------------
+    def load(self, camera_id: str, camera_data: dict) -> dict | None:
+        """Returns the cached geometry of the given camera or None if it is not cached."""
+        entry_directory = os.path.join(
+            self.directory, camera_geometry_key(camera_id, camera_data)
+        )
+        if not os.path.isdir(entry_directory):
+            return None
+
+        try:
+            return self.__load__(entry_directory)
+        except Exception:
+            # Damaged entries are replaced by the next store()
+            shutil.rmtree(entry_directory, ignore_errors=True)
+            return None
+
+    # --------------------------------------------------------------------------
+    def store(self, camera_id: str, camera_data: dict, geometry: dict) -> None:
+        """Stores the given geometry of the given camera."""
+        self.__store__(camera_geometry_key(camera_id, camera_data), geometry)
+
+    # --------------------------------------------------------------------------
+    def __store__(self, key: str, geometry: dict) -> None:
+        # Write to a hidden directory first and rename it afterwards, so that
+        # concurrent processes never load incomplete entries
+        temporary_directory = os.path.join(
+            self.directory, f".{key}-{os.getpid()}"
+        )
+        os.makedirs(temporary_directory, exist_ok=True)
+
+        arrays = []
+
+        def save_array(array: np.ndarray) -> str:
+            file_name = f"{len(arrays)}.npy"
+            np.save(os.path.join(temporary_directory, file_name), array)
+            arrays.append(file_name)
+            return file_name
+
+        manifest = {
+            "masks": {
+                camera_pos: [
+                    {
+                        "name": mask.name,
+                        "interpolate": mask.interpolate,
+                        "polygon": list(mask.polygon.exterior.coords),
+                        "raster": save_array(mask.raster),
+                    }
+                    for mask in masks
+                ]
+                for camera_pos, masks in geometry["masks"].items()
+            },
+            "interpolators": {
+                camera_pos: {
+                    "proximity_weights": save_array(
+                        interpolator.proximity_weights
+                    ),
+                    "interpolation_threshold": interpolator.interpolation_threshold,
+                }
+                for camera_pos, interpolator in geometry["interpolators"].items()
+            },
+            "gridded_indices": {
+                camera_pos: {
+                    "cell_centers": save_array(indices.cell_centers),
+                    "pixel_indices": save_array(indices.pixel_indices),
+                    "offsets": save_array(indices.offsets),
+                }
+                for camera_pos, indices in geometry["gridded_indices"].items()
+            },
+            "roi_boxes": geometry["roi_boxes"],
+        }
+        with open(os.path.join(temporary_directory, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+
+        try:
+            os.rename(temporary_directory, os.path.join(self.directory, key))
+        except OSError:
+            # Another process stored the same entry in the meantime
+            shutil.rmtree(temporary_directory, ignore_errors=True)
+
+    # --------------------------------------------------------------------------
+    def __load__(self, entry_directory: str) -> dict:
+        with open(os.path.join(entry_directory, "manifest.json")) as f:
+            manifest = json.load(f)
+
+        def load_array(file_name: str) -> np.ndarray:
+            return np.load(
+                os.path.join(entry_directory, file_name), mmap_mode="r"
+            )
+
+        return {
+            "masks": {
+                camera_pos: [
+                    Mask(
+                        name=mask["name"],
+                        interpolate=mask["interpolate"],
+                        polygon=Polygon(mask["polygon"]),
+                        raster=load_array(mask["raster"]),
+                    )
+                    for mask in masks
+                ]
+                for camera_pos, masks in manifest["masks"].items()
+            },
+            "interpolators": {
+                camera_pos: SIDWInterpolator.from_proximity_weights(
+                    proximity_weights=load_array(
+                        interpolator["proximity_weights"]
+                    ),
+                    interpolation_threshold=interpolator[
+                        "interpolation_threshold"
+                    ],
+                )
+                for camera_pos, interpolator in manifest["interpolators"].items()
+            },
+            "gridded_indices": {
+                camera_pos: GriddedIndices(
+                    cell_centers=load_array(indices["cell_centers"]),
+                    pixel_indices=load_array(indices["pixel_indices"]),
+                    offsets=load_array(indices["offsets"]),
+                )
+                for camera_pos, indices in manifest["gridded_indices"].items()
+            },
+            "roi_boxes": {
+                camera_pos: tuple(box)
+                for camera_pos, box in manifest["roi_boxes"].items()
+            },
+        }
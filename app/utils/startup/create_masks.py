@@ -1,8 +1,27 @@
-from shapely import Polygon
+import numpy as np
+from shapely import Polygon, covers, points
 
 from app.models.models import Mask
+from app.utils.startup.selective_idw_interpolator import SIDWInterpolator
 
-from app.utils.model_prediction.make_prediction import fixed_width, fixed_height
+from app.utils.model_prediction.make_prediction import (
+    fixed_width,
+    fixed_height,
+    density_width,
+    density_height,
+)
+
+# Margin in density pixels that is kept around the masks of cameras in
+# roi_only mode, so that people at the edges of masks are still seen with
+# their surroundings by the model (12 density pixels are 96 input pixels)
+ROI_MARGIN = 12
+
+
+# ------------------------------------------------------------------------------
+def rasterize_polygon(polygon: Polygon) -> np.ndarray:
+    """Returns a boolean array with the dimensions of the density map that is True for every pixel whose point (column, row) is covered by the given polygon, including pixels on its boundary."""
+    rows, columns = np.indices((density_height, density_width))
+    return covers(polygon, points(columns, rows))
 
 
 # ------------------------------------------------------------------------------
@@ -32,30 +51,78 @@ def create_masks(cameras: dict) -> dict[str, list[Mask]]:
             w_offset = 0.5 * (fixed_width - scaling_factor * width)
             h_offset = 0.5 * (fixed_height - scaling_factor * height)
 
-            # Scale edges and convert to Polygon
-            result[f"{camera}_{position}"] = [
-                Mask(
-                    name=area,
-                    interpolate=area_metadata["interpolate"],
-                    polygon=Polygon(
-                        [
-                            (
-                                int(
-                                    vgg19_factor
-                                    * (scaling_factor * edge[0] + w_offset)
-                                ),
-                                int(
-                                    vgg19_factor
-                                    * (scaling_factor * edge[1] + h_offset)
-                                ),
-                            )
-                            for edge in area_metadata["edges"]
-                        ]
-                    ),
+            # Scale edges, convert them to a Polygon and rasterize it once
+            # so that counting at request time is a plain array reduction
+            result[f"{camera}_{position}"] = []
+            for area, area_metadata in cameras[camera]["position_settings"][
+                position
+            ]["area_metadata"].items():
+                polygon = Polygon(
+                    [
+                        (
+                            int(
+                                vgg19_factor
+                                * (scaling_factor * edge[0] + w_offset)
+                            ),
+                            int(
+                                vgg19_factor
+                                * (scaling_factor * edge[1] + h_offset)
+                            ),
+                        )
+                        for edge in area_metadata["edges"]
+                    ]
+                )
+                result[f"{camera}_{position}"].append(
+                    Mask(
+                        name=area,
+                        interpolate=area_metadata["interpolate"],
+                        polygon=polygon,
+                        raster=rasterize_polygon(polygon),
+                    )
+                )
+
+    return result
+
+
+# ------------------------------------------------------------------------------
+def create_roi_boxes(
+    cameras: dict,
+    masks: dict[str, list[Mask]],
+    interpolators: dict[str, SIDWInterpolator],
+) -> dict[str, tuple[int, int, int, int]]:
+    """Determines the region of interest of every position of cameras with 'roi_only' enabled: the bounding box of all its masks, widened by ROI_MARGIN and at least by the interpolation radius, so that interpolation inside the masks sees the same neighbourhood. Returns a dictionary of (top, left, bottom, right) boxes in model input pixels with camera ids + positions as keys. Positions without masks have no region of interest."""
+    result = {}
+    for camera in cameras.keys():
+        if not cameras[camera].get("roi_only", False):
+            continue
+
+        for position in cameras[camera]["position_settings"].keys():
+            camera_pos = f"{camera}_{position}"
+            if not masks.get(camera_pos):
+                continue
+
+            covered = np.logical_or.reduce(
+                [mask.raster for mask in masks[camera_pos]]
+            )
+            rows = np.flatnonzero(covered.any(axis=1))
+            columns = np.flatnonzero(covered.any(axis=0))
+            if len(rows) == 0:
+                continue
+
+            margin = ROI_MARGIN
+            if camera_pos in interpolators.keys():
+                margin = max(
+                    margin,
+                    interpolators[camera_pos].proximity_weights.shape[0] // 2,
                 )
-                for area, area_metadata in cameras[camera]["position_settings"][
-                    position
-                ]["area_metadata"].items()
-            ]
+
+            # Density pixel (row, column) covers input pixels from
+            # (8 * row, 8 * column) on
+            result[camera_pos] = (
+                max(8 * (int(rows[0]) - margin), 0),
+                max(8 * (int(columns[0]) - margin), 0),
+                min(8 * (int(rows[-1]) + 1 + margin), fixed_height),
+                min(8 * (int(columns[-1]) + 1 + margin), fixed_width),
+            )
 
     return result
@@ -35,15 +35,41 @@ class PerspectiveTransformer:
         """
         input_is_tuple = isinstance(camera_points, tuple)
         input_points = [camera_points] if input_is_tuple else camera_points
-        result = []
 
-        for point in input_points:
-            rho, tau = self.__calculate_solver_system__(point)
-            ground_coordinates = np.linalg.solve(rho, tau)
-            result.append((ground_coordinates[0], ground_coordinates[1]))
+        result = [
+            tuple(ground_coordinates)
+            for ground_coordinates in self.transform_points_to_ground_plane(
+                np.array(input_points, dtype="double").reshape(-1, 2)
+            ).tolist()
+        ]
 
         return result[0] if input_is_tuple else result
 
+    # --------------------------------------------------------------------------
+    def transform_points_to_ground_plane(
+        self, camera_points: np.ndarray
+    ) -> np.ndarray:
+        """
+        Takes an (N, 2) array of points in the camera plane and transforms all of them at once to the y=0 plane in external coordinates. Returns an (N, 2) array.
+        """
+        rho, tau = self.__calculate_solver_system__(camera_points)
+
+        # Solve all 2x2 systems rho * ground_coordinates = tau by inversion
+        determinant = rho[:, 0, 0] * rho[:, 1, 1] - rho[:, 0, 1] * rho[:, 1, 0]
+        if np.any(determinant == 0):
+            raise np.linalg.LinAlgError("Singular matrix")
+
+        return (
+            np.stack(
+                [
+                    rho[:, 1, 1] * tau[:, 0] - rho[:, 0, 1] * tau[:, 1],
+                    rho[:, 0, 0] * tau[:, 1] - rho[:, 1, 0] * tau[:, 0],
+                ],
+                axis=1,
+            )
+            / determinant[:, np.newaxis]
+        )
+
     # --------------------------------------------------------------------------
     def __calculate_rotation_and_translation__(
         self, cam_position: np.array, cam_center_plane: np.array
@@ -86,37 +112,28 @@ class PerspectiveTransformer:
 
     # --------------------------------------------------------------------------
     def __calculate_solver_system__(
-        self, camera_point: tuple[float, float]
+        self, camera_points: np.ndarray
     ) -> tuple[np.array, np.array]:
         """
-        Calculates the solver system for the transformation of a point in the camera plane to the y=0 plane as
-            rho * ground_coordinates = tau,
-        where rho is a 2x2 matrix and tau is a 2x1 vector. The function returns both rho and tau.
+        Calculates the solver systems for the transformation of an (N, 2) array of points in the camera plane to the y=0 plane as
+            rho[n] * ground_coordinates[n] = tau[n],
+        where rho is an (N, 2, 2) array of matrices and tau is an (N, 2) array of vectors. The function returns both rho and tau.
         """
-        rho = np.array(
-            [
-                [
-                    self.rot_mat[0, 0]
-                    - camera_point[0] / self.focal_length * self.rot_mat[2, 0],
-                    self.rot_mat[0, 2]
-                    - camera_point[0] / self.focal_length * self.rot_mat[2, 2],
-                ],
-                [
-                    self.rot_mat[1, 0]
-                    - camera_point[1] / self.focal_length * self.rot_mat[2, 0],
-                    self.rot_mat[1, 2]
-                    - camera_point[1] / self.focal_length * self.rot_mat[2, 2],
-                ],
-            ]
-        )
+        u = camera_points[:, 0] / self.focal_length
+        v = camera_points[:, 1] / self.focal_length
 
-        tau = np.array(
+        rho = np.empty((camera_points.shape[0], 2, 2), dtype="double")
+        rho[:, 0, 0] = self.rot_mat[0, 0] - u * self.rot_mat[2, 0]
+        rho[:, 0, 1] = self.rot_mat[0, 2] - u * self.rot_mat[2, 2]
+        rho[:, 1, 0] = self.rot_mat[1, 0] - v * self.rot_mat[2, 0]
+        rho[:, 1, 1] = self.rot_mat[1, 2] - v * self.rot_mat[2, 2]
+
+        tau = np.stack(
             [
-                camera_point[0] / self.focal_length * self.transl_vec[2]
-                - self.transl_vec[0],
-                camera_point[1] / self.focal_length * self.transl_vec[2]
-                - self.transl_vec[1],
-            ]
+                u * self.transl_vec[2] - self.transl_vec[0],
+                v * self.transl_vec[2] - self.transl_vec[1],
+            ],
+            axis=1,
         )
 
         return rho, tau
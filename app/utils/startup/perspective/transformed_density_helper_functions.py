@@ -1,17 +1,63 @@
 import numpy as np
+from scipy.sparse import csr_matrix
 
+from app.models.models import DensityMap
 from app.utils.startup.perspective.perspective_transformer import (
     PerspectiveTransformer,
 )
-from app.utils.model_prediction.make_prediction import fixed_width, fixed_height
+from app.utils.model_prediction.make_prediction import (
+    fixed_width,
+    fixed_height,
+    density_width,
+    density_height,
+)
+
+# Version of the layout of the gridded indices. It is saved together with
+# binary transformed densities and needs to be increased whenever the
+# assignment of density pixels to real world grid cells changes.
+GRIDDED_INDEX_VERSION = 2
 
 
 # ------------------------------------------------------------------------------
-def calculate_gridded_indices(
-    camera_data,
-) -> dict[str, dict[tuple[float, float], list[int]]]:
+class GriddedIndices:
+    """Assignment of the pixels of the flattened density map to real world grid cells. The pixels inside the cell with center cell_centers[i] are pixel_indices[offsets[i]:offsets[i + 1]]. Only cells that contain at least one pixel are stored. The assignment is compiled into a sparse projection matrix, so that transforming a density map is a single matrix-vector product."""
+
+    def __init__(
+        self,
+        cell_centers: np.ndarray,
+        pixel_indices: np.ndarray,
+        offsets: np.ndarray,
+    ):
+        if cell_centers.ndim != 2 or cell_centers.shape[1] != 2:
+            raise ValueError("cell_centers must be an (N, 2) array")
+
+        if offsets.shape != (cell_centers.shape[0] + 1,):
+            raise ValueError("offsets must have one entry more than cell_centers")
+
+        self.cell_centers = cell_centers
+        self.pixel_indices = pixel_indices
+        self.offsets = offsets
+
+        # Row i of the projection matrix has a one in every column that
+        # belongs to a pixel inside cell i
+        self.projection = csr_matrix(
+            (np.ones(pixel_indices.shape[0]), pixel_indices, offsets),
+            shape=(cell_centers.shape[0], density_width * density_height),
+        )
+
+    # --------------------------------------------------------------------------
+    def transform(self, density: DensityMap) -> np.ndarray:
+        """Sums up the density inside every grid cell. Returns an array with one (x, y, density) row per grid cell."""
+        result = np.empty((self.cell_centers.shape[0], 3), dtype=np.float64)
+        result[:, :2] = self.cell_centers
+        result[:, 2] = self.projection @ density.ravel()
+        return result
+
+
+# ------------------------------------------------------------------------------
+def calculate_gridded_indices(camera_data) -> dict[str, GriddedIndices]:
     """
-    For every camera and position, this function calculates the indices of the transformed and flattened density grid that correspond to the real world coordinates of the grid points. I returns dictionaries with real world grid cell centers as keys and the corresponding indices as values.
+    For every camera and position, this function calculates the indices of the transformed and flattened density grid that correspond to the real world coordinates of the grid points. It returns GriddedIndices with camera ids + positions as keys.
     """
     step_size_rw = 1  # in m
     vgg19_factor = 0.125  # vgg19 downscales input images by a factor of 8
@@ -40,7 +86,7 @@ def calculate_gridded_indices(
                 round(vgg19_factor * fixed_height),
             )
             xx_cam, yy_cam = np.meshgrid(x_coords_cam, y_coords_cam)
-            camera_plane_coords = list(zip(xx_cam.flatten(), yy_cam.flatten()))
+            camera_plane_coords = np.column_stack((xx_cam.ravel(), yy_cam.ravel()))
 
             # Calculate real world coordinates of every pixel
             transformer = PerspectiveTransformer(
@@ -48,36 +94,37 @@ def calculate_gridded_indices(
                 cam_position=data["coordinates_3D"],
                 cam_center=settings["center_ground_plane"],
             )
-            real_world_coords = transformer.transform_to_ground_plane(
+            real_world_coords = transformer.transform_points_to_ground_plane(
                 camera_plane_coords
             )
 
-            x_coords_real_world, y_coords_real_world = zip(*real_world_coords)
-            x_coords_real_world = np.array(x_coords_real_world)
-            y_coords_real_world = np.array(y_coords_real_world)
-
-            x_min_rw = round(np.floor(x_coords_real_world.min()))
-            x_max_rw = round(np.ceil(x_coords_real_world.max()))
-            y_min_rw = round(np.floor(y_coords_real_world.min()))
-            y_max_rw = round(np.ceil(y_coords_real_world.max()))
-
-            # For every step_size_rw x step_size_rw grid cell in the real world,
-            # find the indices of original density pixels that are inside the cell
-            indices_dict = {}
-            for x in np.arange(x_min_rw, x_max_rw, step_size_rw):
-                for y in np.arange(y_min_rw, y_max_rw, step_size_rw):
-                    indices = np.where(
-                        (x_coords_real_world >= x)
-                        & (x_coords_real_world < x + step_size_rw)
-                        & (y_coords_real_world >= y)
-                        & (y_coords_real_world < y + step_size_rw)
-                    )
-
-                    if len(indices) > 0:
-                        indices_dict[
-                            (x + 0.5 * step_size_rw, y + 0.5 * step_size_rw)
-                        ] = indices
-
-            result[f"{camera_id}_{position}"] = indices_dict
+            # Only pixels that exist in the density map and have a finite
+            # real world position are assigned to grid cells
+            pixel_indices = np.arange(real_world_coords.shape[0])
+            valid = (pixel_indices < density_width * density_height) & np.all(
+                np.isfinite(real_world_coords), axis=1
+            )
+            pixel_indices = pixel_indices[valid]
+
+            # Bin every pixel into the step_size_rw x step_size_rw real world
+            # grid cell it lies in and group the pixels by cell
+            cells, pixel_cells = np.unique(
+                np.floor(real_world_coords[valid] / step_size_rw).astype(np.int64),
+                axis=0,
+                return_inverse=True,
+            )
+            pixel_cells = pixel_cells.ravel()
+
+            # Indices are stored as int32, which scipy.sparse uses without
+            # copying them
+            result[f"{camera_id}_{position}"] = GriddedIndices(
+                cell_centers=(cells + 0.5) * step_size_rw,
+                pixel_indices=pixel_indices[
+                    np.argsort(pixel_cells, kind="stable")
+                ].astype(np.int32),
+                offsets=np.concatenate(
+                    ([0], np.cumsum(np.bincount(pixel_cells, minlength=len(cells))))
+                ).astype(np.int32),
+            )
 
     return result
@@ -1,37 +1,208 @@
-from app.utils.database_helper_functions import create_cosmos_db_client
-from app.utils.startup.create_masks import create_masks
-from app.utils.startup.selective_idw_interpolator import (
-    create_interpolators,
-)
-from app.utils.startup.perspective.transformed_density_helper_functions import (
-    calculate_gridded_indices,
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from app.utils.startup.camera_geometry import (
+    GeometryCache,
+    camera_geometry_key,
+    compute_camera_geometry,
 )
 from app.models.models import ModelSchedule
 
+logger = logging.getLogger(__name__)
+
+
+# ------------------------------------------------------------------------------
+class ProjectResources:
+    """Masks, interpolators, gridded indices, regions of interest and model schedules of one project. Also keeps the geometry of every camera together with the hash of the settings it was computed from (see camera_geometry_key()), so that unchanged cameras can be reused when the project is updated, and the errors of cameras whose settings could not be processed."""
+
+    def __init__(
+        self,
+        camera_geometry: dict[str, tuple[str, dict]],
+        model_schedules: dict[str, ModelSchedule],
+        camera_errors: dict[str, str] | None = None,
+    ):
+        self.camera_geometry = camera_geometry
+        self.model_schedules = model_schedules
+        self.camera_errors = camera_errors if camera_errors is not None else {}
+
+        self.masks = {}
+        self.interpolators = {}
+        self.gridded_indices = {}
+        self.roi_boxes = {}
+        for _, geometry in camera_geometry.values():
+            self.masks |= geometry["masks"]
+            self.interpolators |= geometry["interpolators"]
+            self.gridded_indices |= geometry["gridded_indices"]
+            self.roi_boxes |= geometry["roi_boxes"]
+
+    # --------------------------------------------------------------------------
+    def geometry_keys(self) -> dict[str, str]:
+        """Returns the settings hash of every camera."""
+        return {camera_id: key for camera_id, (key, _) in self.camera_geometry.items()}
+
+    # --------------------------------------------------------------------------
+    def nbytes(self) -> int:
+        """Returns the number of bytes used by the arrays of all cameras."""
+        arrays = [
+            mask.raster for masks in self.masks.values() for mask in masks
+        ]
+        arrays += [i.proximity_weights for i in self.interpolators.values()]
+        for indices in self.gridded_indices.values():
+            arrays += [
+                indices.cell_centers,
+                indices.pixel_indices,
+                indices.offsets,
+                indices.projection.data,
+                indices.projection.indices,
+                indices.projection.indptr,
+            ]
+        return sum(array.nbytes for array in arrays)
+
 
 # ------------------------------------------------------------------------------
-def process_project_metadata() -> tuple[dict, dict]:
-    """Creates masks and gridded indices for all projects defined in the corresponding CosmosDB container."""
-    projects_client = create_cosmos_db_client("projects")
-    projects = projects_client.query_items(
-        query="SELECT * FROM c", enable_cross_partition_query=True
+def build_camera_geometry(
+    camera_id: str,
+    camera_data: dict,
+    geometry_cache_directory: str | None = None,
+) -> tuple[dict | None, float]:
+    """Computes the geometry of the given camera and returns it together with the time it took in seconds. If a cache directory is given, the geometry is stored there and None is returned instead, so that it is loaded as memory maps rather than copied between processes."""
+    start = time.perf_counter()
+    geometry = compute_camera_geometry(camera_id, camera_data)
+    if geometry_cache_directory is not None:
+        GeometryCache(geometry_cache_directory).store(
+            camera_id, camera_data, geometry
+        )
+        geometry = None
+    return geometry, time.perf_counter() - start
+
+
+# ------------------------------------------------------------------------------
+def process_projects(
+    projects: list[dict],
+    geometry_cache: GeometryCache | None = None,
+    previous: dict[str, ProjectResources] | None = None,
+    max_workers: int = 1,
+) -> dict[str, ProjectResources]:
+    """Creates the resources of the given entries of the 'projects' CosmosDB container and returns them with project ids as keys. The geometry of cameras whose settings did not change compared to the previous resources is reused and the geometry of cached cameras is loaded. The geometry of all other cameras is computed in one task per camera, which run in parallel on up to max_workers processes. Cameras whose settings cannot be processed are logged and left out of their project, see ProjectResources.camera_errors."""
+    previous = previous if previous is not None else {}
+    camera_geometry = {project["id"]: {} for project in projects}
+    camera_errors = {project["id"]: {} for project in projects}
+    model_schedules = {project["id"]: {} for project in projects}
+
+    tasks = []
+    for project in projects:
+        project_id = project["id"]
+        for camera_id, camera_data in project["cameras"].items():
+            try:
+                if "model_schedule" in camera_data.keys():
+                    model_schedules[project_id][camera_id] = (
+                        ModelSchedule.from_cosmosdb_entry(
+                            camera_data["model_schedule"]
+                        )
+                    )
+
+                key = camera_geometry_key(camera_id, camera_data)
+                reusable = (
+                    previous[project_id].camera_geometry.get(camera_id)
+                    if project_id in previous
+                    else None
+                )
+                if reusable is not None and reusable[0] == key:
+                    camera_geometry[project_id][camera_id] = reusable
+                    continue
+
+                geometry = (
+                    geometry_cache.load(camera_id, camera_data)
+                    if geometry_cache is not None
+                    else None
+                )
+                if geometry is not None:
+                    camera_geometry[project_id][camera_id] = (key, geometry)
+                    continue
+            except Exception as e:
+                camera_errors[project_id][camera_id] = str(e)
+                logger.error(
+                    f"Could not process camera {camera_id} of project {project_id}: {e}"
+                )
+                continue
+
+            tasks.append((project_id, camera_id, camera_data, key))
+
+    # Computed geometry is passed back through the cache if there is one
+    geometry_cache_directory = (
+        geometry_cache.directory if geometry_cache is not None else None
     )
 
-    masks = {}
-    interpolators = {}
-    gridded_indices = {}
-    model_schedules = {}
-    for p in projects:
-        masks[p["id"]] = create_masks(p["cameras"])
+    def finish(task: tuple, compute) -> None:
+        project_id, camera_id, camera_data, key = task
+        try:
+            geometry, duration = compute()
+            if geometry is None:
+                geometry = geometry_cache.load(camera_id, camera_data)
+            camera_geometry[project_id][camera_id] = (key, geometry)
+            logger.info(
+                f"Computed geometry of camera {camera_id} of project {project_id} in {duration:.2f} s."
+            )
+        except Exception as e:
+            camera_errors[project_id][camera_id] = str(e)
+            logger.error(
+                f"Could not compute geometry of camera {camera_id} of project {project_id}: {e}"
+            )
 
-        interpolators[p["id"]] = create_interpolators(p["cameras"])
+    if max_workers > 1 and len(tasks) > 1:
+        # Worker processes are forked from a fresh server process rather than
+        # from this one, as forking a process whose torch thread pools are
+        # already running is not safe. The server imports this module once
+        # for all workers, which imports torch as well (through app.utils and
+        # the model dimensions in make_prediction), but never runs it, so
+        # that forking it is safe and workers do not import torch again.
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__])
+        with ProcessPoolExecutor(
+            max_workers=min(max_workers, len(tasks)),
+            mp_context=context,
+        ) as pool:
+            futures = {
+                pool.submit(
+                    build_camera_geometry,
+                    camera_id,
+                    camera_data,
+                    geometry_cache_directory,
+                ): (project_id, camera_id, camera_data, key)
+                for project_id, camera_id, camera_data, key in tasks
+            }
+            for future in as_completed(futures):
+                finish(futures[future], future.result)
+    else:
+        for task in tasks:
+            finish(
+                task,
+                lambda: build_camera_geometry(
+                    task[1], task[2], geometry_cache_directory
+                ),
+            )
 
-        gridded_indices[p["id"]] = calculate_gridded_indices(p["cameras"])
+    return {
+        project["id"]: ProjectResources(
+            camera_geometry=camera_geometry[project["id"]],
+            model_schedules=model_schedules[project["id"]],
+            camera_errors=camera_errors[project["id"]],
+        )
+        for project in projects
+    }
 
-        model_schedules[p["id"]] = {
-            cam_id: ModelSchedule.from_cosmosdb_entry(data["model_schedule"])
-            for cam_id, data in p["cameras"].items()
-            if "model_schedule" in data.keys()
-        }
 
-    return masks, interpolators, gridded_indices, model_schedules
+# ------------------------------------------------------------------------------
+def process_project(
+    project: dict,
+    geometry_cache: GeometryCache | None = None,
+    previous: ProjectResources | None = None,
+) -> ProjectResources:
+    """Creates the resources of the given entry of the 'projects' CosmosDB container in the current process, see process_projects()."""
+    return process_projects(
+        [project],
+        geometry_cache=geometry_cache,
+        previous={project["id"]: previous} if previous is not None else {},
+    )[project["id"]]
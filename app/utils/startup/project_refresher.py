@@ -0,0 +1,116 @@
+import time
+import asyncio
+import logging
+
+from app.utils.startup.project_sources import (
+    CosmosProjectSource,
+    LocalProjectSource,
+)
+from app.utils.startup.project_registry import ProjectRegistry
+from app.utils.startup.process_project_metadata import process_project
+from app.utils.prediction_cache import PredictionCache
+
+logger = logging.getLogger(__name__)
+
+
+# ------------------------------------------------------------------------------
+class ProjectRefresher:
+    """Background task that polls the given source every interval_s seconds, replaces the resources of changed projects in the given registry and removes deleted projects from it. Deletions can only be detected by listing all projects, hence they are polled every deletion_interval_s seconds only. Projects that are not loaded by a lazy registry are skipped, they are built from their latest entry on their first request anyway. The resources of a changed project are rebuilt in a separate thread, only recomputing the geometry of cameras whose settings changed, and swapped in as a whole afterwards. Requests therefore either see the old or the new resources of a project, but never a mix of both. Cached predictions of changed projects are removed from the given prediction cache."""
+
+    def __init__(
+        self,
+        projects: ProjectRegistry,
+        source: CosmosProjectSource | LocalProjectSource,
+        interval_s: float = 60,
+        prediction_cache: PredictionCache | None = None,
+        deletion_interval_s: float = 600,
+    ):
+        if interval_s <= 0:
+            raise ValueError("interval_s must be greater than 0.")
+        if deletion_interval_s <= 0:
+            raise ValueError("deletion_interval_s must be greater than 0.")
+
+        self.projects = projects
+        self.source = source
+        self.interval_s = interval_s
+        self.deletion_interval_s = deletion_interval_s
+        self.prediction_cache = prediction_cache
+        self.task = None
+
+    # --------------------------------------------------------------------------
+    async def start(self) -> None:
+        """Starts polling. All projects are compared once first, to catch changes made since the given projects were loaded."""
+        projects = await asyncio.to_thread(self.source.load_all)
+        self.task = asyncio.create_task(self.__run__(projects))
+
+    # --------------------------------------------------------------------------
+    async def close(self) -> None:
+        """Stops polling."""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    # --------------------------------------------------------------------------
+    async def __run__(self, projects: list[dict]) -> None:
+        next_deletion_poll = time.monotonic() + self.deletion_interval_s
+        while True:
+            for project in projects:
+                try:
+                    await self.__update__(project)
+                except Exception as e:
+                    logger.error(f"Could not update project {project.get('id')}: {e}")
+
+            await asyncio.sleep(self.interval_s)
+            try:
+                projects = await asyncio.to_thread(self.source.poll_changes)
+            except Exception as e:
+                logger.error(f"Could not poll for changed projects: {e}")
+                projects = []
+
+            if time.monotonic() >= next_deletion_poll:
+                next_deletion_poll = time.monotonic() + self.deletion_interval_s
+                await self.__remove_deleted__()
+
+    # --------------------------------------------------------------------------
+    async def __remove_deleted__(self) -> None:
+        try:
+            deleted = await asyncio.to_thread(self.source.poll_deletions)
+        except Exception as e:
+            logger.error(f"Could not poll for deleted projects: {e}")
+            return
+        for project_id in deleted:
+            self.projects.remove(project_id)
+            self.__clear_cache__(project_id)
+            logger.info(f"Removed deleted project {project_id}.")
+
+    # --------------------------------------------------------------------------
+    async def __update__(self, project: dict) -> None:
+        previous = self.projects.loaded(project["id"])
+        if previous is None and self.projects.lazy:
+            # The project may still have cached predictions from before it
+            # was evicted
+            self.__clear_cache__(project["id"])
+            return
+
+        resources = await asyncio.to_thread(
+            process_project, project, self.projects.geometry_cache, previous
+        )
+
+        if previous is not None and (
+            resources.geometry_keys() == previous.geometry_keys()
+            and resources.model_schedules == previous.model_schedules
+        ):
+            return
+
+        self.projects.replace(project["id"], resources)
+        self.__clear_cache__(project["id"])
+        logger.info(f"Updated project {project['id']}.")
+
+    # --------------------------------------------------------------------------
+    def __clear_cache__(self, project_id: str) -> None:
+        if self.prediction_cache is not None:
+            self.prediction_cache.clear_project(project_id)
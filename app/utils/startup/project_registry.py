@@ -0,0 +1,170 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Callable
+
+from app.utils.startup.camera_geometry import GeometryCache
+from app.utils.startup.project_sources import (
+    CosmosProjectSource,
+    LocalProjectSource,
+    create_project_source,
+)
+from app.utils.startup.process_project_metadata import (
+    ProjectResources,
+    process_project,
+    process_projects,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# ------------------------------------------------------------------------------
+class ProjectRegistry:
+    """Resources of the projects that predictions can be made for. Projects given to preload() are pinned, i.e. kept for the lifetime of the registry. If lazy is True, all other projects are loaded from the source created by source_factory on their first request, with concurrent first requests waiting for a single load, and evicted in least recently used order once the arrays of all projects use more than max_bytes (no limit if None). Project ids that do not exist in the source are remembered for missing_ttl_s seconds, so that repeated requests for them do not query the source every time."""
+
+    def __init__(
+        self,
+        lazy: bool = False,
+        max_bytes: int | None = None,
+        missing_ttl_s: float = 30,
+        geometry_cache_directory: str | None = None,
+        source_factory: Callable[
+            [], CosmosProjectSource | LocalProjectSource
+        ] = create_project_source,
+    ):
+        self.lazy = lazy
+        self.max_bytes = max_bytes
+        self.missing_ttl_s = missing_ttl_s
+        self.geometry_cache = (
+            GeometryCache(geometry_cache_directory)
+            if geometry_cache_directory is not None
+            else None
+        )
+        # The source is created on first use, so that every worker process
+        # uses its own connections
+        self.source_factory = source_factory
+        self.source = None
+
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.pinned = set()
+        self.locks = {}
+        self.missing = {}
+        self.counters = {"loads": 0, "evictions": 0}
+
+    # --------------------------------------------------------------------------
+    def preload(self, projects: list[dict], max_workers: int = 1) -> None:
+        """Builds the resources of the given entries of the 'projects' container on up to max_workers processes and pins them."""
+        for project_id, resources in process_projects(
+            projects, self.geometry_cache, max_workers=max_workers
+        ).items():
+            self.pinned.add(project_id)
+            self.replace(project_id, resources)
+
+    # --------------------------------------------------------------------------
+    async def get(self, project_id: str) -> ProjectResources | None:
+        """Returns the resources of the given project, loading them if necessary. Returns None if the project does not exist."""
+        if project_id in self.entries:
+            self.entries.move_to_end(project_id)
+            return self.entries[project_id]
+        if not self.lazy or self.__is_missing__(project_id):
+            return None
+
+        lock = self.locks.setdefault(project_id, asyncio.Lock())
+        async with lock:
+            # Another request may have loaded the project or found it missing
+            # in the meantime
+            if project_id in self.entries:
+                return self.entries[project_id]
+            if self.__is_missing__(project_id):
+                return None
+
+            try:
+                resources = await asyncio.to_thread(self.__load__, project_id)
+            finally:
+                # Requests that are already waiting hold the lock themselves,
+                # later ones find the result above
+                if self.locks.get(project_id) is lock:
+                    del self.locks[project_id]
+
+            if resources is None:
+                self.missing[project_id] = time.monotonic()
+            else:
+                self.counters["loads"] += 1
+                self.replace(project_id, resources)
+            return resources
+
+    # --------------------------------------------------------------------------
+    def loaded(self, project_id: str) -> ProjectResources | None:
+        """Returns the resources of the given project if they are loaded and None otherwise."""
+        return self.entries.get(project_id)
+
+    # --------------------------------------------------------------------------
+    def replace(self, project_id: str, resources: ProjectResources) -> None:
+        """Sets the resources of the given project. Requests that already hold the previous resources finish with them."""
+        self.entries[project_id] = resources
+        self.entries.move_to_end(project_id)
+        self.sizes[project_id] = resources.nbytes()
+        self.__evict__()
+
+    # --------------------------------------------------------------------------
+    def remove(self, project_id: str) -> None:
+        """Removes the resources of the given project, e.g. because it was deleted. Requests that already hold them finish with them."""
+        self.entries.pop(project_id, None)
+        self.sizes.pop(project_id, None)
+        self.pinned.discard(project_id)
+
+    # --------------------------------------------------------------------------
+    def metrics(self) -> dict:
+        """Returns the number of loaded projects, the bytes used by their arrays, the counters of loads and evictions and the errors of cameras that could not be processed."""
+        return {
+            "loaded": len(self.entries),
+            "bytes": sum(self.sizes.values()),
+            "camera_errors": {
+                project_id: resources.camera_errors
+                for project_id, resources in self.entries.items()
+                if resources.camera_errors
+            },
+        } | self.counters
+
+    # --------------------------------------------------------------------------
+    def __load__(self, project_id: str) -> ProjectResources | None:
+        if self.source is None:
+            self.source = self.source_factory()
+
+        project = self.source.load(project_id)
+        if project is None:
+            return None
+
+        logger.info(f"Loading project {project_id}.")
+        return process_project(project, self.geometry_cache)
+
+    # --------------------------------------------------------------------------
+    def __is_missing__(self, project_id: str) -> bool:
+        # Entries are in the order they were added, so expired ones come first
+        now = time.monotonic()
+        while self.missing:
+            oldest = next(iter(self.missing))
+            if now - self.missing[oldest] <= self.missing_ttl_s:
+                break
+            del self.missing[oldest]
+        return project_id in self.missing
+
+    # --------------------------------------------------------------------------
+    def __evict__(self) -> None:
+        if self.max_bytes is None:
+            return
+
+        # The most recently used project is kept even if it exceeds the limit
+        # on its own
+        for project_id in list(self.entries)[:-1]:
+            if sum(self.sizes.values()) <= self.max_bytes:
+                break
+            if project_id in self.pinned:
+                continue
+
+            del self.entries[project_id]
+            del self.sizes[project_id]
+            self.counters["evictions"] += 1
+            logger.info(f"Evicted project {project_id}.")
@@ -0,0 +1,140 @@
+import os
+import json
+
+from app.utils.database_helper_functions import create_cosmos_db_client
+
+
+# ------------------------------------------------------------------------------
+class CosmosProjectSource:
+    """Reads the entries of the 'projects' CosmosDB container, the entries that changed since the last call and the ids of deleted entries. Changes are found by their modification time (_ts) rather than the change feed, whose continuation is per partition key range, and versions that were already returned are recognized by their _etag."""
+
+    def __init__(self):
+        self.container = create_cosmos_db_client("projects")
+        self.since = 0
+        self.etags = {}
+
+    # --------------------------------------------------------------------------
+    def load_all(self) -> list[dict]:
+        """Returns all entries. Changes made afterwards are returned by poll_changes()."""
+        projects = list(
+            self.container.query_items(
+                query="SELECT * FROM c", enable_cross_partition_query=True
+            )
+        )
+        self.etags = {project["id"]: project["_etag"] for project in projects}
+        self.since = max([project["_ts"] for project in projects], default=0)
+        return projects
+
+    # --------------------------------------------------------------------------
+    def load(self, project_id: str) -> dict | None:
+        """Returns the entry of the given project or None if it does not exist."""
+        entries = list(
+            self.container.query_items(
+                query="SELECT * FROM c WHERE c.id = @id",
+                parameters=[{"name": "@id", "value": project_id}],
+                enable_cross_partition_query=True,
+            )
+        )
+        return entries[0] if entries else None
+
+    # --------------------------------------------------------------------------
+    def poll_changes(self) -> list[dict]:
+        """Returns the latest version of all entries that changed since the last call."""
+        # _ts has a resolution of one second, so entries of the last second
+        # are queried again and skipped if their version was returned already
+        candidates = self.container.query_items(
+            query="SELECT * FROM c WHERE c._ts >= @since",
+            parameters=[{"name": "@since", "value": self.since}],
+            enable_cross_partition_query=True,
+        )
+
+        changes = []
+        for project in candidates:
+            self.since = max(self.since, project["_ts"])
+            if self.etags.get(project["id"]) != project["_etag"]:
+                self.etags[project["id"]] = project["_etag"]
+                changes.append(project)
+        return changes
+
+    # --------------------------------------------------------------------------
+    def poll_deletions(self) -> list[str]:
+        """Returns the ids of all entries that were deleted since the last call. Lists the ids of all entries across partitions, hence it is called less often than poll_changes() (see ProjectRefresher)."""
+        existing = set(
+            self.container.query_items(
+                query="SELECT VALUE c.id FROM c", enable_cross_partition_query=True
+            )
+        )
+        deleted = [
+            project_id for project_id in self.etags if project_id not in existing
+        ]
+        for project_id in deleted:
+            del self.etags[project_id]
+        return deleted
+
+
+# ------------------------------------------------------------------------------
+class LocalProjectSource:
+    """Local stand-in for CosmosProjectSource that reads one project entry per .json file in the given directory. Files that were modified since the last call count as changed, files that were removed as deleted."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.modification_times = {}
+        self.project_ids = {}
+
+    # --------------------------------------------------------------------------
+    def load_all(self) -> list[dict]:
+        """Returns all entries. Changes made afterwards are returned by poll_changes()."""
+        self.modification_times = {}
+        self.project_ids = {}
+        return self.poll_changes()
+
+    # --------------------------------------------------------------------------
+    def load(self, project_id: str) -> dict | None:
+        """Returns the entry of the given project or None if it does not exist."""
+        for file_name in sorted(os.listdir(self.directory)):
+            if file_name.endswith(".json"):
+                with open(os.path.join(self.directory, file_name)) as f:
+                    project = json.load(f)
+                if project.get("id") == project_id:
+                    return project
+        return None
+
+    # --------------------------------------------------------------------------
+    def poll_changes(self) -> list[dict]:
+        """Returns all entries whose files were created or modified since the last call."""
+        changes = []
+        for file_name in sorted(os.listdir(self.directory)):
+            if not file_name.endswith(".json"):
+                continue
+
+            path = os.path.join(self.directory, file_name)
+            modification_time = os.stat(path).st_mtime_ns
+            if self.modification_times.get(file_name) == modification_time:
+                continue
+
+            with open(path) as f:
+                changes.append(json.load(f))
+            self.modification_times[file_name] = modification_time
+            self.project_ids[file_name] = changes[-1].get("id")
+
+        return changes
+
+    # --------------------------------------------------------------------------
+    def poll_deletions(self) -> list[str]:
+        """Returns the ids of all entries whose files were removed since the last call."""
+        existing = set(os.listdir(self.directory))
+        removed = [f for f in self.modification_times if f not in existing]
+        for file_name in removed:
+            del self.modification_times[file_name]
+        return [self.project_ids.pop(file_name) for file_name in removed]
+
+
+# ------------------------------------------------------------------------------
+def create_project_source() -> CosmosProjectSource | LocalProjectSource:
+    """Returns the source of project entries selected by the environment variable PROJECTS_SOURCE: 'cosmosdb' (default) or 'local', which reads the directory given by LOCAL_PROJECTS_DIRECTORY."""
+    source = os.getenv("PROJECTS_SOURCE", "cosmosdb")
+    if source == "cosmosdb":
+        return CosmosProjectSource()
+    if source == "local":
+        return LocalProjectSource(os.environ["LOCAL_PROJECTS_DIRECTORY"])
+    raise ValueError("PROJECTS_SOURCE must be one of ['cosmosdb', 'local'].")
@@ -1,8 +1,7 @@
-from shapely.geometry import Point
 import numpy as np
-from joblib import Parallel, delayed
+from scipy.ndimage import correlate
 
-from app.models.models import Mask
+from app.models.models import Mask, DensityMap, as_density_map
 
 
 # ------------------------------------------------------------------------------
@@ -36,97 +35,66 @@ class SIDWInterpolator:
         self.proximity_weights = self.__compute_proximity_weights__(radius, p)
         self.interpolation_threshold = interpolation_threshold
 
+    # --------------------------------------------------------------------------
+    @classmethod
+    def from_proximity_weights(
+        cls, proximity_weights: np.ndarray, interpolation_threshold: float
+    ):
+        """Creates an interpolator from already computed proximity weights."""
+        interpolator = cls.__new__(cls)
+        interpolator.proximity_weights = proximity_weights
+        interpolator.interpolation_threshold = interpolation_threshold
+        return interpolator
+
     # --------------------------------------------------------------------------
     def __call__(
-        self, density_map: list[list[float]], masks: list[Mask]
-    ) -> list[list[float]]:
+        self, density_map: DensityMap, masks: list[Mask]
+    ) -> DensityMap:
         """Interpolates the given density map using the SIDW algorithm. The masks parameter is used to specify regions of points. If no mask with enabled interpolation is given, the interpolation is done for no points."""
         relevant_masks = [mask for mask in masks if mask.interpolate]
-
-        return (
-            Parallel(n_jobs=-1)(
-                delayed(self.__interpolate_density_row__)(
-                    i=i,
-                    density_map=density_map,
-                    masks=relevant_masks,
-                )
-                for i in range(len(density_map))
-            )
-            if len(relevant_masks) > 0
-            else density_map
+        if len(relevant_masks) == 0:
+            return density_map
+
+        # Points are interpolated if their value is below the interpolation
+        # threshold and they are covered by a mask that requires interpolation
+        interpolation_points = (
+            density_map <= self.interpolation_threshold
+        ) & np.logical_or.reduce([mask.raster for mask in relevant_masks])
+
+        # Weighted sum of all nonzero values in the proximity of every point
+        # and the sum of the corresponding weights. Points outside of the
+        # density map do not contribute to either of them.
+        values = density_map.astype(np.float64)
+        weighted_value_sums = correlate(
+            values, self.proximity_weights, mode="constant", cval=0.0
+        )
+        weight_sums = correlate(
+            (values != 0).astype(np.float64),
+            self.proximity_weights,
+            mode="constant",
+            cval=0.0,
         )
 
-    # --------------------------------------------------------------------------
-    def __interpolate_density_row__(
-        self,
-        i: int,
-        density_map: list[list[float]],
-        masks: list[Mask],
-    ) -> list[float]:
-        original_row = density_map[i]
-        result = original_row.copy()
-
-        for j in range(len(original_row)):
-            # Check if the interpolation criteria are met, i.e. the value at
-            # the point is below the interpolation threshold and the point
-            # is covered by a mask that requires interpolation
-            if original_row[j] <= self.interpolation_threshold:
-                if any(mask.polygon.covers(Point(j, i)) for mask in masks):
-                    result[j] = self.__interpolate_density_point__(
-                        x_center=j,
-                        y_center=i,
-                        density_map=density_map,
-                    )
-
-        return result
-
-    # --------------------------------------------------------------------------
-    def __interpolate_density_point__(
-        self,
-        x_center: int,
-        y_center: int,
-        density_map: list[list[float]],
-    ) -> float:
-        # Collect all points in the proximity mask that are within the
-        # image bounds and fulfill the summation threshold
-        valid_weights, valid_values = [], []
-        for proximity_point, weight in self.proximity_weights.items():
-            x = x_center + int(proximity_point[0])
-            y = y_center + int(proximity_point[1])
-
-            try:
-                density_value = density_map[y][x]
-            except IndexError:
-                continue
-            if density_value == 0:
-                continue
-
-            valid_weights.append(weight)
-            valid_values.append(density_value)
-
-        # Apply the SIDW formula
-        result = density_map[y_center][x_center]
-        if len(valid_weights) > 0:
-            valid_weights = np.array(valid_weights)
-            valid_values = np.array(valid_values)
-            result = max(
-                density_value,
-                np.sum(valid_weights * valid_values) / np.sum(valid_weights),
-            )
+        # Apply the SIDW formula where at least one valid point is in proximity
+        interpolation_points &= weight_sums > 0
+        result = values.copy()
+        result[interpolation_points] = np.maximum(
+            values[interpolation_points],
+            weighted_value_sums[interpolation_points]
+            / weight_sums[interpolation_points],
+        )
 
-        return result
+        return as_density_map(result)
 
     # --------------------------------------------------------------------------
-    def __compute_proximity_weights__(
-        self, radius: int, p: float
-    ) -> dict[Point, float]:
-        """Collects all points with maximum distance of the given radius to the center. The weights are computed using the inverse distance weighting formula with the given exponent p. The center itself is excluded from the mask."""
-        result = {}
-        for i in range(-radius, radius + 1):
-            for j in range(-radius, radius + 1):
-                distance = Point(i, j).distance(Point(0, 0))
-                if 0 < distance <= radius:
-                    result[(i, j)] = 1 / distance**p
+    def __compute_proximity_weights__(self, radius: int, p: float) -> np.ndarray:
+        """Computes a (2 * radius + 1) x (2 * radius + 1) kernel that holds the inverse distance weight (with the given exponent p) of every point with maximum distance of the given radius to the center. The center itself and all points further away have weight 0."""
+        offsets = np.arange(-radius, radius + 1)
+        distances = np.hypot(*np.meshgrid(offsets, offsets))
+
+        result = np.zeros_like(distances)
+        in_proximity = (distances > 0) & (distances <= radius)
+        result[in_proximity] = 1 / distances[in_proximity] ** p
         return result
 
 
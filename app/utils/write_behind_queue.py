@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import asyncio
+import logging
+import numpy as np
+
+from app.utils.prediction_store import PredictionStore
+from app.utils.database_helper_functions import prepare_prediction_artifacts
+from app.utils.model_prediction.make_prediction import decode_image
+
+logger = logging.getLogger(__name__)
+
+
+# ------------------------------------------------------------------------------
+class WriteBehindQueue:
+    """Bounded queue of predictions that are persisted by background workers with retries and exponential backoff. Every prediction is a dict with the CosmosDB 'entry', the original 'image_bytes', the 'density', the 'transformed_density' (or None) and the density 'metadata'. Its artifacts are only prepared by the workers (see prepare_prediction_artifacts()), so that requests do not wait for them. Every job is written to its own directory before it is accepted, so that pending jobs survive restarts. Every process writes to its own subdirectory of the given directory, which it locks while running, and on start() takes over the jobs of subdirectories whose process is gone. Jobs that do not fit into the queue or cannot be written to disk are dropped and counted. Jobs that still fail after all retries are moved to the subdirectory 'failed'."""
+
+    def __init__(
+        self,
+        prediction_store: PredictionStore,
+        directory: str,
+        max_size: int = 1000,
+        num_workers: int = 4,
+        max_retries: int = 5,
+        initial_backoff_s: float = 1.0,
+    ):
+        if max_size < 1:
+            raise ValueError("max_size must be greater than or equal to 1.")
+        if num_workers < 1:
+            raise ValueError("num_workers must be greater than or equal to 1.")
+
+        self.prediction_store = prediction_store
+        self.directory = directory
+        self.failed_directory = os.path.join(directory, "failed")
+        self.worker_directory = None
+        self.lock_file = None
+        self.max_size = max_size
+        self.num_workers = num_workers
+        self.max_retries = max_retries
+        self.initial_backoff_s = initial_backoff_s
+
+        self.jobs = asyncio.Queue()
+        self.reserved = 0
+        self.workers = []
+        self.accepting = False
+        self.counters = {"persisted": 0, "dropped": 0, "failed": 0, "retries": 0}
+
+    # --------------------------------------------------------------------------
+    async def start(self) -> None:
+        """Creates and locks the directory of this process, takes over the jobs left over by processes that are gone, enqueues them and starts the workers."""
+        os.makedirs(self.failed_directory, exist_ok=True)
+
+        # The directory is locked before it gets its visible name, so that
+        # other processes never take it over while it is in use
+        name = f"worker-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        hidden_directory = os.path.join(self.directory, f".{name}")
+        os.makedirs(hidden_directory)
+        self.lock_file = open(os.path.join(hidden_directory, ".lock"), "w")
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.worker_directory = os.path.join(self.directory, name)
+        os.rename(hidden_directory, self.worker_directory)
+
+        for other in sorted(os.listdir(self.directory)):
+            if other.startswith("worker-") and other != name:
+                self.__take_over__(os.path.join(self.directory, other))
+
+        for job_id in sorted(os.listdir(self.worker_directory)):
+            if not job_id.startswith("."):
+                self.jobs.put_nowait(job_id)
+
+        self.accepting = True
+        self.workers = [
+            asyncio.create_task(self.__work__()) for _ in range(self.num_workers)
+        ]
+
+    # --------------------------------------------------------------------------
+    async def put(self, predictions: list[dict]) -> bool:
+        """Writes the given predictions (see above) to disk and enqueues them, one job per prediction. Either all or none of them are accepted, so that clients can retry a rejected batch as a whole. Returns False if they were dropped because the queue is full or closed or writing them failed."""
+        # Jobs that are still being written count towards the size, so that
+        # concurrent calls cannot exceed it
+        ids = ", ".join(prediction["entry"]["id"] for prediction in predictions)
+        if (
+            not self.accepting
+            or self.jobs.qsize() + self.reserved + len(predictions) > self.max_size
+        ):
+            self.counters["dropped"] += len(predictions)
+            logger.warning(f"Dropped predictions {ids} from write-behind queue.")
+            return False
+
+        job_ids = [f"{time.time_ns()}-{uuid.uuid4().hex}" for _ in predictions]
+        self.reserved += len(predictions)
+        try:
+            await asyncio.to_thread(self.__write_jobs__, job_ids, predictions)
+        except OSError as e:
+            self.counters["dropped"] += len(predictions)
+            logger.error(f"Could not write predictions {ids} to disk: {e}")
+            return False
+        finally:
+            self.reserved -= len(predictions)
+
+        for job_id in job_ids:
+            self.jobs.put_nowait(job_id)
+        return True
+
+    # --------------------------------------------------------------------------
+    async def close(self, timeout: float = 30) -> None:
+        """Stops accepting jobs and waits up to timeout seconds for the queue to be drained. Jobs that are not persisted by then stay on disk and are taken over by the next process that starts."""
+        self.accepting = False
+        try:
+            await asyncio.wait_for(self.jobs.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Write-behind queue not drained, {self.jobs.qsize()} jobs left on disk."
+            )
+
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+        if self.worker_directory is not None:
+            if self.jobs.empty():
+                shutil.rmtree(self.worker_directory, ignore_errors=True)
+            self.lock_file.close()
+
+    # --------------------------------------------------------------------------
+    def metrics(self) -> dict:
+        return {"depth": self.jobs.qsize()} | self.counters
+
+    # --------------------------------------------------------------------------
+    def __take_over__(self, directory: str) -> None:
+        """Moves the jobs of the given directory of another process into the directory of this process if that process is gone, i.e. does not hold its lock anymore, and removes it. Moving every job is atomic, so that concurrently starting processes never process the same job."""
+        try:
+            lock_file = open(os.path.join(directory, ".lock"), "a")
+        except FileNotFoundError:
+            # Taken over by another process in the meantime
+            return
+
+        with lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            try:
+                job_ids = os.listdir(directory)
+            except FileNotFoundError:
+                return
+            for job_id in job_ids:
+                # Hidden jobs were incomplete when their process died
+                if not job_id.startswith("."):
+                    os.rename(
+                        os.path.join(directory, job_id),
+                        os.path.join(self.worker_directory, job_id),
+                    )
+            shutil.rmtree(directory, ignore_errors=True)
+
+    # --------------------------------------------------------------------------
+    async def __work__(self) -> None:
+        while True:
+            job_id = await self.jobs.get()
+            try:
+                await self.__persist_job__(job_id)
+            except Exception as e:
+                logger.error(f"Write-behind job {job_id} could not be processed: {e}")
+            finally:
+                self.jobs.task_done()
+
+    # --------------------------------------------------------------------------
+    async def __persist_job__(self, job_id: str) -> None:
+        job_directory = os.path.join(self.worker_directory, job_id)
+        try:
+            entry, artifacts = await asyncio.to_thread(
+                self.__prepare_job__, job_directory
+            )
+        except Exception as e:
+            # Jobs that cannot be prepared would fail on every retry
+            logger.error(f"Preparing write-behind job {job_id} failed: {e}")
+            self.counters["failed"] += 1
+            await asyncio.to_thread(shutil.move, job_directory, self.failed_directory)
+            return
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.prediction_store.save_artifacts(artifacts)
+                await self.prediction_store.upsert(entry)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f"Persisting prediction {entry['id']} failed: {e}")
+                    self.counters["failed"] += 1
+                    await asyncio.to_thread(
+                        shutil.move, job_directory, self.failed_directory
+                    )
+                    return
+                self.counters["retries"] += 1
+                await asyncio.sleep(self.initial_backoff_s * 2**attempt)
+            else:
+                self.counters["persisted"] += 1
+                await asyncio.to_thread(shutil.rmtree, job_directory)
+                return
+
+    # --------------------------------------------------------------------------
+    def __prepare_job__(
+        self, job_directory: str
+    ) -> tuple[dict, list[tuple[str, str, bytes]]]:
+        """Reads the given job and returns its CosmosDB entry and artifacts."""
+        prediction = self.__read_job__(job_directory)
+        return prediction["entry"], prepare_prediction_artifacts(
+            prediction_id=prediction["entry"]["id"],
+            image_bytes=prediction["image_bytes"],
+            image=decode_image(prediction["image_bytes"]),
+            density=prediction["density"],
+            transformed_density=prediction["transformed_density"],
+            metadata=prediction["metadata"],
+        )
+
+    # --------------------------------------------------------------------------
+    def __write_jobs__(self, job_ids: list[str], predictions: list[dict]) -> None:
+        written = []
+        try:
+            for job_id, prediction in zip(job_ids, predictions):
+                self.__write_job__(job_id, prediction)
+                written.append(job_id)
+        except OSError:
+            # Jobs of a batch are only kept together
+            for job_id in written:
+                shutil.rmtree(
+                    os.path.join(self.worker_directory, job_id), ignore_errors=True
+                )
+            raise
+
+    # --------------------------------------------------------------------------
+    def __write_job__(self, job_id: str, prediction: dict) -> None:
+        # Write to a hidden directory first and rename it afterwards, so that
+        # incomplete jobs are never enqueued
+        temporary_directory = os.path.join(self.worker_directory, f".{job_id}")
+        try:
+            os.makedirs(temporary_directory)
+
+            with open(os.path.join(temporary_directory, "image"), "wb") as f:
+                f.write(prediction["image_bytes"])
+            np.save(
+                os.path.join(temporary_directory, "density.npy"),
+                prediction["density"],
+                allow_pickle=False,
+            )
+            if prediction["transformed_density"] is not None:
+                np.save(
+                    os.path.join(temporary_directory, "transformed_density.npy"),
+                    prediction["transformed_density"],
+                    allow_pickle=False,
+                )
+
+            with open(os.path.join(temporary_directory, "job.json"), "w") as f:
+                json.dump(
+                    {"entry": prediction["entry"], "metadata": prediction["metadata"]},
+                    f,
+                )
+
+            os.rename(
+                temporary_directory, os.path.join(self.worker_directory, job_id)
+            )
+        except OSError:
+            # E.g. a full disk, the incomplete job is not kept
+            shutil.rmtree(temporary_directory, ignore_errors=True)
+            raise
+
+    # --------------------------------------------------------------------------
+    def __read_job__(self, job_directory: str) -> dict:
+        with open(os.path.join(job_directory, "job.json")) as f:
+            job = json.load(f)
+
+        with open(os.path.join(job_directory, "image"), "rb") as f:
+            image_bytes = f.read()
+        transformed_density_path = os.path.join(
+            job_directory, "transformed_density.npy"
+        )
+
+        return {
+            "entry": job["entry"],
+            "image_bytes": image_bytes,
+            "density": np.load(
+                os.path.join(job_directory, "density.npy"), allow_pickle=False
+            ),
+            "transformed_density": (
+                np.load(transformed_density_path, allow_pickle=False)
+                if os.path.isfile(transformed_density_path)
+                else None
+            ),
+            "metadata": job["metadata"],
+        }
@@ -0,0 +1,15 @@
+import os
+
+# ------------------------------------------------------------------------------
+# gunicorn settings, see https://docs.gunicorn.org/en/stable/settings.html
+# ------------------------------------------------------------------------------
+bind = "0.0.0.0:8000"
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Loading models and project geometry can take a while
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "600"))
+
+# With PRELOAD_RESOURCES enabled, app.main loads models and geometry once in
+# the master process and all workers share them (see app.main)
+preload_app = os.getenv("PRELOAD_RESOURCES", "false").lower() in ["true", "1"]
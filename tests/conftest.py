@@ -0,0 +1,39 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app import main
+from app.utils import InFlightLimiter
+
+
+# ------------------------------------------------------------------------------
+class Projects:
+    """Stand-in for ProjectRegistry that knows no projects."""
+
+    async def get(self, project_id: str):
+        return None
+
+
+# ------------------------------------------------------------------------------
+@pytest.fixture
+def app_resources(monkeypatch) -> dict:
+    """Resources of app.main as set up by its lifespan, without models. Tests adjust them as needed."""
+    monkeypatch.setenv("API_KEY", "key")
+    resources = {
+        "projects": Projects(),
+        "limiter": InFlightLimiter(max_in_flight=2),
+        "max_upload_bytes": 1024,
+        "max_batch_upload_bytes": 4096,
+        "max_batch_entries": 3,
+        "batch_forward_size": 2,
+        "write_behind_queue": None,
+        "prediction_cache": None,
+    }
+    monkeypatch.setattr(main, "app_resources", resources)
+    return resources
+
+
+# ------------------------------------------------------------------------------
+@pytest.fixture
+def client(app_resources) -> TestClient:
+    """Client of the app that does not run its lifespan."""
+    return TestClient(main.app)
@@ -0,0 +1,83 @@
+import copy
+
+import pytest
+import torch
+
+from app.utils.model_prediction.backends import prepare_backend, quantize_static
+from app.utils.model_prediction.dm_count import DMCount
+
+
+# ------------------------------------------------------------------------------
+@pytest.fixture(scope="module")
+def model() -> DMCount:
+    torch.manual_seed(0)
+    return DMCount().eval()
+
+
+# ------------------------------------------------------------------------------
+@pytest.fixture(scope="module")
+def inputs() -> torch.Tensor:
+    return torch.rand(2, 3, 64, 96, generator=torch.Generator().manual_seed(0))
+
+
+# ------------------------------------------------------------------------------
+def predict(model, inputs: torch.Tensor) -> torch.Tensor:
+    with torch.no_grad():
+        return model(inputs)
+
+
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize("backend", ["channels_last", "bf16"])
+def test_channels_last_backends_match_fp32(model, inputs, backend):
+    expected = predict(model, inputs)
+
+    # Both convert the weights of the given model in place
+    outputs = predict(prepare_backend(copy.deepcopy(model), backend), inputs)
+
+    assert outputs.shape == expected.shape
+    assert outputs.dtype == torch.float32
+    tolerance = 1e-4 if backend == "channels_last" else 5e-2
+    assert float(outputs.sum()) == pytest.approx(float(expected.sum()), rel=tolerance)
+
+
+# ------------------------------------------------------------------------------
+def test_fp32_returns_model_and_unknown_backends_raise(model):
+    assert prepare_backend(model, "fp32") is model
+    with pytest.raises(ValueError):
+        prepare_backend(model, "fp16")
+
+
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize("calibration_inputs", [None, []])
+def test_int8_needs_calibration_inputs(model, calibration_inputs):
+    with pytest.raises(ValueError):
+        quantize_static(model, calibration_inputs)
+    with pytest.raises(ValueError):
+        prepare_backend(model, "int8", calibration_inputs)
+
+
+# ------------------------------------------------------------------------------
+def test_int8_keeps_density_layer_in_fp32(model, inputs):
+    quantized = quantize_static(model, [inputs[:1], inputs[1:]])
+
+    # Backbone and regression head run quantized convolutions
+    quantized_convolutions = [
+        module
+        for module in quantized.modules()
+        if isinstance(module, torch.ao.nn.quantized.Conv2d)
+    ]
+    assert len(quantized_convolutions) == 16 + 2
+    # The final 1x1 convolution is the original one
+    (convolution, _) = quantized.density_layer
+    assert type(convolution) is torch.nn.Conv2d
+    assert convolution.weight.dtype == torch.float32
+    assert torch.equal(convolution.weight, model.density_layer[0].weight)
+
+    outputs = predict(quantized, inputs)
+    assert outputs.shape == predict(model, inputs).shape
+    assert outputs.dtype == torch.float32
+    # The given model is left as it is
+    assert all(
+        type(module) is not torch.ao.nn.quantized.Conv2d
+        for module in model.modules()
+    )
@@ -0,0 +1,140 @@
+import os
+
+import numpy as np
+import pytest
+from shapely import Polygon
+
+from app.models.models import Mask
+from app.utils.startup import camera_geometry
+from app.utils.startup.camera_geometry import GeometryCache, camera_geometry_key
+from app.utils.startup.perspective.transformed_density_helper_functions import (
+    GriddedIndices,
+)
+from app.utils.startup.selective_idw_interpolator import SIDWInterpolator
+
+SETTINGS = {
+    "positions": {"standard": {"focal_length": 0.004, "rotation": [0.0, 0.5]}},
+    "resolution": [1920, 1080],
+}
+
+
+# ------------------------------------------------------------------------------
+def geometry() -> dict:
+    """Geometry of one camera position in the format of compute_camera_geometry()."""
+    return {
+        "masks": {
+            "c_standard": [
+                Mask(
+                    name="area",
+                    polygon=Polygon([(0, 0), (10, 0), (10, 5)]),
+                    interpolate=True,
+                    raster=np.eye(4, dtype=bool),
+                )
+            ]
+        },
+        "interpolators": {
+            "c_standard": SIDWInterpolator.from_proximity_weights(
+                proximity_weights=np.full((4, 4), 0.25),
+                interpolation_threshold=0.5,
+            )
+        },
+        "gridded_indices": {
+            "c_standard": GriddedIndices(
+                cell_centers=np.array([[0.5, 0.5], [1.5, 0.5]]),
+                pixel_indices=np.array([0, 1, 5], dtype=np.int64),
+                offsets=np.array([0, 2, 3], dtype=np.int64),
+            )
+        },
+        "roi_boxes": {"c_standard": (0, 0, 16, 32)},
+    }
+
+
+# ------------------------------------------------------------------------------
+@pytest.fixture
+def computations(monkeypatch) -> list:
+    computations = []
+
+    def compute_camera_geometry(camera_id: str, camera_data: dict) -> dict:
+        computations.append(camera_id)
+        return geometry()
+
+    monkeypatch.setattr(
+        camera_geometry, "compute_camera_geometry", compute_camera_geometry
+    )
+    return computations
+
+
+# ------------------------------------------------------------------------------
+def test_key_depends_on_settings_camera_and_version(monkeypatch):
+    key = camera_geometry_key("c", SETTINGS)
+    reordered = {"resolution": [1920, 1080], "positions": SETTINGS["positions"]}
+    changed = {
+        "positions": {"standard": {"focal_length": 0.004, "rotation": [0.0, 0.6]}},
+        "resolution": [1920, 1080],
+    }
+
+    assert camera_geometry_key("c", reordered) == key
+    assert camera_geometry_key("c", changed) != key
+    assert camera_geometry_key("d", SETTINGS) != key
+
+    monkeypatch.setattr(camera_geometry, "GEOMETRY_VERSION", "next")
+    assert camera_geometry_key("c", SETTINGS) != key
+
+
+# ------------------------------------------------------------------------------
+def test_cached_geometry_round_trip(tmp_path, computations):
+    cache = GeometryCache(str(tmp_path))
+    expected = geometry()
+
+    cache.get("c", SETTINGS)
+    loaded = GeometryCache(str(tmp_path)).get("c", SETTINGS)
+
+    assert computations == ["c"]
+    (mask,) = loaded["masks"]["c_standard"]
+    assert (mask.name, mask.interpolate) == ("area", True)
+    assert mask.polygon.equals(expected["masks"]["c_standard"][0].polygon)
+    np.testing.assert_array_equal(mask.raster, np.eye(4, dtype=bool))
+    interpolator = loaded["interpolators"]["c_standard"]
+    assert interpolator.interpolation_threshold == 0.5
+    np.testing.assert_array_equal(interpolator.proximity_weights, np.full((4, 4), 0.25))
+    indices = loaded["gridded_indices"]["c_standard"]
+    np.testing.assert_array_equal(indices.pixel_indices, [0, 1, 5])
+    np.testing.assert_array_equal(indices.offsets, [0, 2, 3])
+    assert loaded["roi_boxes"] == {"c_standard": (0, 0, 16, 32)}
+    # Arrays are shared read-only memory maps of the cached files
+    assert isinstance(mask.raster, np.memmap)
+    assert not mask.raster.flags.writeable
+
+
+# ------------------------------------------------------------------------------
+def test_changed_settings_and_versions_are_recomputed(
+    tmp_path, computations, monkeypatch
+):
+    cache = GeometryCache(str(tmp_path))
+    cache.get("c", SETTINGS)
+    cache.get("d", SETTINGS)
+
+    cache.get("c", SETTINGS | {"resolution": [1280, 720]})
+    assert computations == ["c", "d", "c"]
+    cache.get("d", SETTINGS)
+    assert computations == ["c", "d", "c"]
+
+    # All entries are invalid after the geometry code changed
+    monkeypatch.setattr(camera_geometry, "GEOMETRY_VERSION", "next")
+    cache.get("d", SETTINGS)
+    assert computations == ["c", "d", "c", "d"]
+    assert len(os.listdir(tmp_path)) == 4
+
+
+# ------------------------------------------------------------------------------
+def test_damaged_entries_are_recomputed(tmp_path, computations):
+    cache = GeometryCache(str(tmp_path))
+    cache.get("c", SETTINGS)
+    entry_directory = tmp_path / camera_geometry_key("c", SETTINGS)
+    (entry_directory / "manifest.json").write_text("{")
+
+    assert cache.load("c", SETTINGS) is None
+    assert not entry_directory.exists()
+    cache.get("c", SETTINGS)
+    assert computations == ["c", "c"]
+    assert cache.load("c", SETTINGS) is not None
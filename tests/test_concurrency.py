@@ -0,0 +1,82 @@
+import json
+import struct
+
+import pytest
+from fastapi import HTTPException
+
+from app.utils.concurrency import InFlightLimiter
+
+
+# ------------------------------------------------------------------------------
+def test_rejects_requests_beyond_limit_with_retry_after():
+    limiter = InFlightLimiter(max_in_flight=2)
+
+    with limiter, limiter:
+        with pytest.raises(HTTPException) as error:
+            with limiter:
+                pass
+        assert limiter.in_flight == 2
+
+    assert error.value.status_code == 503
+    assert error.value.headers == {"Retry-After": "1"}
+    assert limiter.in_flight == 0
+
+
+# ------------------------------------------------------------------------------
+def test_releases_slots_of_failed_requests():
+    limiter = InFlightLimiter(max_in_flight=3)
+
+    with pytest.raises(RuntimeError):
+        with limiter:
+            raise RuntimeError("prediction failed")
+    with pytest.raises(RuntimeError):
+        with limiter.slots(3):
+            raise RuntimeError("prediction failed")
+
+    assert limiter.in_flight == 0
+
+
+# ------------------------------------------------------------------------------
+def test_slots_count_as_several_requests():
+    limiter = InFlightLimiter(max_in_flight=3)
+
+    with limiter.slots(2):
+        assert limiter.in_flight == 2
+        with limiter:
+            with pytest.raises(HTTPException) as error:
+                with limiter.slots(1):
+                    pass
+            assert error.value.status_code == 503
+
+    # Batches that would never fit are rejected as too large instead
+    with pytest.raises(HTTPException) as error:
+        with limiter.slots(4):
+            pass
+    assert error.value.status_code == 413
+    assert limiter.in_flight == 0
+
+    with pytest.raises(ValueError):
+        InFlightLimiter(max_in_flight=0)
+
+
+# ------------------------------------------------------------------------------
+def test_endpoints_respond_busy_with_retry_after(client, app_resources):
+    class Projects:
+        async def get(self, project_id: str):
+            return object()
+
+    app_resources["projects"] = Projects()
+    header = json.dumps({"camera": "c"}).encode()
+    batch = struct.pack(">I", len(header)) + header + struct.pack(">I", 1) + b"x"
+    params = {"project": "P", "key": "key"}
+
+    with app_resources["limiter"].slots(2):
+        responses = [
+            client.post("/predict", params=params | {"camera": "c"}, content=b"x"),
+            client.post("/predict/batch", params=params, content=batch),
+        ]
+
+    for response in responses:
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "1"
+    assert app_resources["limiter"].in_flight == 0
@@ -0,0 +1,104 @@
+import io
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from app.utils.model_prediction.make_prediction import (
+    crop_to_content,
+    density_height,
+    density_width,
+    fixed_height,
+    fixed_width,
+    place_density,
+    prepare_inputs,
+    preprocess,
+)
+
+
+# ------------------------------------------------------------------------------
+def block_model(inputs: torch.Tensor) -> np.ndarray:
+    """Stand-in for DMCount with the same geometry: every 16 x 16 block of the input (rounding down) becomes 2 x 2 density pixels."""
+    blocks = torch.nn.functional.avg_pool2d(inputs.mean(dim=1, keepdim=True), 16)
+    return (
+        blocks.repeat_interleave(2, dim=2).repeat_interleave(2, dim=3)[0, 0].numpy()
+    )
+
+
+# ------------------------------------------------------------------------------
+def encode_image(width: int, height: int) -> bytes:
+    pixels = np.random.default_rng(0).integers(
+        0, 256, (height, width, 3), dtype=np.uint8
+    )
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format="PNG")
+    return output.getvalue()
+
+
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize(
+    "box",
+    [
+        (0, 460, 1080, 1460),
+        (0, 240, 1080, 1680),
+        (123, 0, 957, 1920),
+        (0, 0, fixed_height, fixed_width),
+        (5, 7, 11, 13),
+    ],
+)
+def test_crop_is_aligned_to_density_pixels(box):
+    inputs = torch.randn(1, 3, fixed_height, fixed_width)
+    cropped, offset = crop_to_content(inputs, box)
+
+    top, left = 8 * offset[0], 8 * offset[1]
+    bottom, right = top + cropped.shape[2], left + cropped.shape[3]
+    assert top % 16 == 0 and left % 16 == 0
+    assert bottom % 16 == 0 or bottom == fixed_height
+    assert right % 16 == 0 or right == fixed_width
+    assert top <= box[0] and left <= box[1]
+    assert bottom >= box[2] and right >= box[3]
+    assert cropped.data_ptr() == inputs[:, :, top, left].data_ptr()
+
+
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize("box", [(0, 460, 1080, 1460), (123, 0, 957, 1920)])
+def test_placed_density_matches_whole_input(box):
+    inputs = torch.randn(1, 3, fixed_height, fixed_width)
+    cropped, offset = crop_to_content(inputs, box)
+
+    density = place_density(block_model(cropped), offset)
+    whole_density = block_model(inputs)
+
+    assert density.shape == (density_height, density_width)
+    inside = np.zeros(density.shape, dtype=bool)
+    rows, columns = block_model(cropped).shape
+    inside[offset[0] : offset[0] + rows, offset[1] : offset[1] + columns] = True
+    np.testing.assert_array_equal(density[inside], whole_density[inside])
+    assert np.all(density[~inside] == 0)
+
+
+# ------------------------------------------------------------------------------
+def test_place_density_keeps_full_size_densities():
+    density = np.ones((density_height, density_width), dtype=np.float32)
+    assert place_density(density, (0, 0)) is density
+
+
+# ------------------------------------------------------------------------------
+def test_prepare_inputs_crops_letterbox():
+    image_bytes = encode_image(1000, 1080)
+
+    _, inputs, offset = prepare_inputs(image_bytes)
+    assert inputs.shape == (1, 3, fixed_height, fixed_width)
+    assert offset == (0, 0)
+
+    _, cropped, offset = prepare_inputs(image_bytes, crop_letterbox=True)
+    # The image region spans the columns 460 to 1460
+    assert offset == (0, 448 // 8)
+    assert cropped.shape == (1, 3, fixed_height, 1472 - 448)
+
+    # The inputs are only valid until the next call in the same thread
+    cropped = cropped.clone()
+    full_inputs, box = preprocess(Image.open(io.BytesIO(image_bytes)).convert("RGB"))
+    assert box == (0, 460, 1080, 1460)
+    torch.testing.assert_close(cropped, full_inputs[:, :, :, 448:1472])
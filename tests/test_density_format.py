@@ -0,0 +1,158 @@
+import io
+import json
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app.utils.database_helper_functions import prepare_prediction_artifacts
+from app.utils.density_format import (
+    DENSITY_COMPRESSIONS,
+    DENSITY_DTYPES,
+    decode_density,
+    encode_density,
+    get_density_storage_settings,
+)
+
+
+# ------------------------------------------------------------------------------
+@pytest.fixture
+def density() -> np.ndarray:
+    return np.random.default_rng(0).random((134, 240)).astype(np.float32)
+
+
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize("dtype", DENSITY_DTYPES)
+@pytest.mark.parametrize("compression", DENSITY_COMPRESSIONS)
+def test_tcd_round_trip(density, dtype, compression):
+    data = encode_density(
+        density,
+        {"model": "standard", "gridded_index_version": 2},
+        storage_format="tcd",
+        dtype=dtype,
+        compression=compression,
+    )
+
+    array, header = decode_density(data)
+
+    assert array.dtype == dtype
+    assert array.shape == density.shape
+    np.testing.assert_array_equal(array, density.astype(dtype))
+    assert header["model"] == "standard"
+    assert header["gridded_index_version"] == 2
+    assert header["compression"] == compression
+
+
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize("dtype", DENSITY_DTYPES)
+def test_npy_round_trip(density, dtype):
+    data = encode_density(density, {"model": "standard"}, "npy", dtype)
+
+    array, metadata = decode_density(data)
+
+    np.testing.assert_array_equal(array, density.astype(dtype))
+    assert metadata == {}
+
+
+# ------------------------------------------------------------------------------
+def test_npy_round_trip_of_fortran_order_arrays(density):
+    data = encode_density(np.asfortranarray(density), {}, "npy")
+
+    array, _ = decode_density(data)
+
+    np.testing.assert_array_equal(array, density)
+
+
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize("version", [(1, 0), (2, 0), (3, 0)])
+def test_decodes_all_npy_versions(density, version):
+    output = io.BytesIO()
+    np.lib.format.write_array(output, density, version=version)
+
+    array, _ = decode_density(output.getvalue())
+
+    np.testing.assert_array_equal(array, density)
+
+
+# ------------------------------------------------------------------------------
+def test_rejects_unknown_npy_versions(density):
+    data = bytearray(encode_density(density, {}, "npy"))
+    data[6] = 4
+
+    with pytest.raises(ValueError):
+        decode_density(bytes(data))
+
+
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize("key", ["shape", "dtype", "compression"])
+def test_metadata_cannot_replace_tcd_header(density, key):
+    with pytest.raises(ValueError, match=key):
+        encode_density(density, {"model": "standard", key: "x"}, "tcd")
+
+
+# ------------------------------------------------------------------------------
+def test_json_round_trip(density):
+    data = encode_density(density, {"model": "standard"}, "json")
+
+    array, metadata = decode_density(data)
+
+    # The legacy format stays readable as nested lists
+    assert json.loads(data)[1][2] == pytest.approx(float(density[1, 2]))
+    np.testing.assert_array_equal(array, density)
+    assert metadata == {}
+
+
+# ------------------------------------------------------------------------------
+def test_transformed_density_round_trip():
+    transformed_density = np.array([[0.5, 1.5, 0.25], [-3.5, 120.5, 1.75]])
+
+    array, _ = decode_density(
+        encode_density(transformed_density, {}, "tcd", "float32")
+    )
+
+    np.testing.assert_array_equal(array, transformed_density)
+
+
+# ------------------------------------------------------------------------------
+def test_storage_settings_from_environment(monkeypatch):
+    monkeypatch.setenv("DENSITY_STORAGE_FORMAT", "tcd")
+    monkeypatch.setenv("DENSITY_STORAGE_DTYPE", "float16")
+    monkeypatch.delenv("DENSITY_STORAGE_COMPRESSION", raising=False)
+    assert get_density_storage_settings() == {
+        "storage_format": "tcd",
+        "dtype": "float16",
+        "compression": "zlib",
+    }
+
+    monkeypatch.setenv("DENSITY_STORAGE_FORMAT", "png")
+    with pytest.raises(ValueError):
+        get_density_storage_settings()
+
+
+# ------------------------------------------------------------------------------
+def test_prediction_artifacts_round_trip(monkeypatch, density):
+    monkeypatch.setenv("DENSITY_STORAGE_FORMAT", "tcd")
+    monkeypatch.setenv("DENSITY_STORAGE_DTYPE", "float16")
+    transformed_density = np.array([[0.5, 1.5, 0.25]])
+
+    artifacts = {
+        file_name: data
+        for _, file_name, data in prepare_prediction_artifacts(
+            "id",
+            None,
+            Image.new("RGB", (1920, 1080)),
+            density,
+            transformed_density,
+            metadata={"model": "standard"},
+        )
+    }
+
+    array, header = decode_density(artifacts["id_density.tcd"])
+    np.testing.assert_array_equal(array, density.astype(np.float16))
+    assert header["model"] == "standard"
+
+    # Transformed densities are always saved as float32
+    array, header = decode_density(artifacts["id_transformed_density.tcd"])
+    assert header["dtype"] == "float32"
+    np.testing.assert_array_equal(array, transformed_density)
+    assert "id.jpg" not in artifacts
@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+
+from app.utils.model_prediction.make_prediction import (
+    density_height,
+    density_width,
+    fixed_height,
+    fixed_width,
+)
+from app.utils.startup.perspective.perspective_transformer import (
+    PerspectiveTransformer,
+)
+from app.utils.startup.perspective.transformed_density_helper_functions import (
+    calculate_gridded_indices,
+)
+
+CAMERA = {
+    "resolution": [1920, 1080],
+    "sensor_size": [0.036, 0.024],
+    "coordinates_3D": [0.0, 15.0, -10.0],
+    "position_settings": {
+        "p": {"focal_length": 0.035, "center_ground_plane": [0.0, 25.0]}
+    },
+}
+
+
+# ------------------------------------------------------------------------------
+@pytest.fixture(scope="module")
+def gridded_indices():
+    return calculate_gridded_indices({"c": CAMERA})["c_p"]
+
+
+# ------------------------------------------------------------------------------
+@pytest.fixture(scope="module")
+def real_world_coords() -> np.ndarray:
+    """Ground plane position of every pixel of the model input grid, computed independently of calculate_gridded_indices()."""
+    half_width, half_height = 0.5 * np.array(CAMERA["sensor_size"])
+    xx, yy = np.meshgrid(
+        np.linspace(-half_width, half_width, fixed_width // 8),
+        np.linspace(half_height, -half_height, fixed_height // 8),
+    )
+    settings = CAMERA["position_settings"]["p"]
+    return PerspectiveTransformer(
+        focal_length=settings["focal_length"],
+        cam_position=CAMERA["coordinates_3D"],
+        cam_center=settings["center_ground_plane"],
+    ).transform_points_to_ground_plane(np.column_stack((xx.ravel(), yy.ravel())))
+
+
+# ------------------------------------------------------------------------------
+def test_every_pixel_is_in_the_cell_around_its_position(
+    gridded_indices, real_world_coords
+):
+    for i, center in enumerate(gridded_indices.cell_centers):
+        pixels = gridded_indices.pixel_indices[
+            gridded_indices.offsets[i] : gridded_indices.offsets[i + 1]
+        ]
+        assert len(pixels) > 0
+        positions = real_world_coords[pixels]
+        assert np.all(positions >= center - 0.5)
+        assert np.all(positions < center + 0.5)
+
+
+# ------------------------------------------------------------------------------
+def test_assigns_every_valid_pixel_exactly_once(gridded_indices, real_world_coords):
+    valid = np.flatnonzero(np.all(np.isfinite(real_world_coords), axis=1))
+    valid = valid[valid < density_width * density_height]
+
+    # The model input grid has one row more than the density map
+    assert real_world_coords.shape[0] > density_width * density_height
+    assert gridded_indices.pixel_indices.dtype == np.int32
+    np.testing.assert_array_equal(np.sort(gridded_indices.pixel_indices), valid)
+    assert len(np.unique(gridded_indices.cell_centers, axis=0)) == len(
+        gridded_indices.cell_centers
+    )
+
+
+# ------------------------------------------------------------------------------
+def test_skips_uncalibrated_cameras():
+    camera = {key: CAMERA[key] for key in ["resolution", "position_settings"]}
+    assert calculate_gridded_indices({"c": camera}) == {}
+
+
+# ------------------------------------------------------------------------------
+def test_projection_matches_summation_per_cell(gridded_indices):
+    density = np.random.default_rng(0).random(
+        (density_height, density_width), dtype=np.float32
+    )
+
+    transformed_density = gridded_indices.transform(density)
+
+    expected = [
+        density.ravel()[
+            gridded_indices.pixel_indices[
+                gridded_indices.offsets[i] : gridded_indices.offsets[i + 1]
+            ]
+        ].sum(dtype=np.float64)
+        for i in range(len(gridded_indices.cell_centers))
+    ]
+    np.testing.assert_array_equal(
+        transformed_density[:, :2], gridded_indices.cell_centers
+    )
+    np.testing.assert_allclose(transformed_density[:, 2], expected, rtol=1e-6)
+    np.testing.assert_allclose(
+        transformed_density[:, 2].sum(),
+        density.ravel()[gridded_indices.pixel_indices].sum(dtype=np.float64),
+        rtol=1e-6,
+    )
+
+
+# ------------------------------------------------------------------------------
+def test_projection_matrix_layout(gridded_indices):
+    projection = gridded_indices.projection
+
+    assert projection.shape == (
+        len(gridded_indices.cell_centers),
+        density_width * density_height,
+    )
+    assert projection.nnz == len(gridded_indices.pixel_indices)
+    assert np.all(projection.data == 1)
+    # Every pixel belongs to at most one cell
+    assert projection.sum(axis=0).max() == 1
@@ -0,0 +1,138 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import torch
+
+from app.utils.model_prediction.inference_scheduler import InferenceScheduler
+
+
+# ------------------------------------------------------------------------------
+class Model:
+    """Doubles its inputs and records the batch size of every forward pass."""
+
+    def __init__(self, tuple_outputs: bool = False):
+        self.batch_sizes = []
+        self.tuple_outputs = tuple_outputs
+
+    def __call__(self, inputs: torch.Tensor):
+        self.batch_sizes.append(inputs.shape[0])
+        if self.tuple_outputs:
+            return inputs * 2, inputs.sum(dim=(1, 2, 3))
+        return inputs * 2
+
+
+# ------------------------------------------------------------------------------
+def run_concurrently(scheduler: InferenceScheduler, inputs: list) -> list:
+    with ThreadPoolExecutor(len(inputs)) as executor:
+        return list(executor.map(scheduler, inputs))
+
+
+# ------------------------------------------------------------------------------
+def test_batches_concurrent_inputs_and_splits_outputs():
+    model = Model()
+    # The batch is started as soon as it is full, long before the deadline
+    scheduler = InferenceScheduler(model, max_batch_size=4, max_wait_ms=10_000)
+    inputs = [torch.full((1, 3, 4, 4), float(i)) for i in range(3)]
+    inputs.append(torch.rand(1, 3, 4, 4))
+
+    outputs = run_concurrently(scheduler, inputs)
+    scheduler.close()
+
+    assert model.batch_sizes == [4]
+    for x, y in zip(inputs, outputs):
+        assert torch.equal(y, x * 2)
+
+
+# ------------------------------------------------------------------------------
+def test_splits_tuple_outputs_of_multi_image_inputs():
+    model = Model(tuple_outputs=True)
+    scheduler = InferenceScheduler(model, max_batch_size=3, max_wait_ms=10_000)
+    inputs = [torch.rand(2, 1, 2, 2), torch.rand(1, 1, 2, 2)]
+
+    outputs = run_concurrently(scheduler, inputs)
+    scheduler.close()
+
+    assert model.batch_sizes == [3]
+    for x, (doubled, sums) in zip(inputs, outputs):
+        assert torch.equal(doubled, x * 2)
+        assert torch.allclose(sums, x.sum(dim=(1, 2, 3)))
+
+
+# ------------------------------------------------------------------------------
+def test_runs_inputs_of_different_shapes_separately():
+    model = Model()
+    scheduler = InferenceScheduler(model, max_batch_size=3, max_wait_ms=10_000)
+    inputs = [torch.rand(1, 3, 4, 4), torch.rand(1, 3, 8, 8), torch.rand(1, 3, 4, 4)]
+
+    outputs = run_concurrently(scheduler, inputs)
+    scheduler.close()
+
+    assert sorted(model.batch_sizes) == [1, 2]
+    for x, y in zip(inputs, outputs):
+        assert torch.equal(y, x * 2)
+
+
+# ------------------------------------------------------------------------------
+def test_runs_single_inputs_after_deadline():
+    model = Model()
+    scheduler = InferenceScheduler(model, max_batch_size=4, max_wait_ms=1)
+    x = torch.rand(1, 3, 4, 4)
+
+    assert torch.equal(scheduler(x), x * 2)
+    scheduler.close()
+    assert model.batch_sizes == [1]
+
+
+# ------------------------------------------------------------------------------
+def test_errors_are_raised_for_every_input_of_the_batch():
+    def failing(inputs: torch.Tensor):
+        raise RuntimeError("forward failed")
+
+    scheduler = InferenceScheduler(failing, max_batch_size=2, max_wait_ms=10_000)
+
+    with ThreadPoolExecutor(2) as executor:
+        futures = [executor.submit(scheduler, torch.rand(1, 1)) for _ in range(2)]
+        for future in futures:
+            with pytest.raises(RuntimeError, match="forward failed"):
+                future.result()
+    scheduler.close()
+
+
+# ------------------------------------------------------------------------------
+def test_inputs_are_either_run_or_rejected_while_closing():
+    model = Model()
+    scheduler = InferenceScheduler(model, max_batch_size=2, max_wait_ms=1)
+    start = threading.Barrier(9)
+    results = []
+
+    def call() -> None:
+        start.wait()
+        try:
+            results.append(scheduler(torch.ones(1, 1)))
+        except RuntimeError:
+            results.append(None)
+
+    threads = [threading.Thread(target=call) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    scheduler.close()
+    for thread in threads:
+        # No input may be left waiting behind the end of the queue
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+
+    assert len(results) == 8
+    assert sum(model.batch_sizes) == sum(result is not None for result in results)
+    with pytest.raises(RuntimeError):
+        scheduler(torch.ones(1, 1))
+    scheduler.close()
+
+
+# ------------------------------------------------------------------------------
+def test_rejects_invalid_settings():
+    with pytest.raises(ValueError):
+        InferenceScheduler(Model(), max_batch_size=0)
+    with pytest.raises(ValueError):
+        InferenceScheduler(Model(), max_wait_ms=-1)
@@ -0,0 +1,111 @@
+import hashlib
+import os
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from app.utils import database_helper_functions
+from app.utils.database_helper_functions import download_model
+from app.utils.model_prediction.make_prediction import share_model_memory
+
+WEIGHTS = b"weights of the model" * 100
+
+
+# ------------------------------------------------------------------------------
+class BlobClient:
+    """Stand-in for the blob client of the weights that counts downloads."""
+
+    def __init__(self):
+        self.downloads = 0
+
+    def get_blob_properties(self):
+        return SimpleNamespace(
+            etag="etag",
+            size=len(WEIGHTS),
+            content_settings=SimpleNamespace(
+                content_md5=bytearray(hashlib.md5(WEIGHTS).digest())
+            ),
+        )
+
+    def download_blob(self, **kwargs):
+        self.downloads += 1
+        return SimpleNamespace(readinto=lambda f: f.write(WEIGHTS))
+
+
+# ------------------------------------------------------------------------------
+@pytest.fixture
+def blob_client(monkeypatch, tmp_path) -> BlobClient:
+    monkeypatch.setenv("MODEL_CACHE_DIRECTORY", str(tmp_path))
+    blob_client = BlobClient()
+    monkeypatch.setattr(
+        database_helper_functions,
+        "create_blob_client",
+        lambda blob_name, file_name: blob_client,
+    )
+    return blob_client
+
+
+# ------------------------------------------------------------------------------
+@pytest.fixture
+def hashed_files(monkeypatch) -> list:
+    hashed_files = []
+    file_md5 = database_helper_functions.file_md5
+
+    def counting_file_md5(file_path: str) -> bytes:
+        hashed_files.append(file_path)
+        return file_md5(file_path)
+
+    monkeypatch.setattr(database_helper_functions, "file_md5", counting_file_md5)
+    return hashed_files
+
+
+# ------------------------------------------------------------------------------
+def test_cached_weights_are_only_hashed_after_changes(blob_client, hashed_files):
+    path = download_model("model")
+    assert blob_client.downloads == 1
+    assert len(hashed_files) == 1
+
+    # Unchanged copies are neither downloaded nor hashed again
+    assert download_model("model") == path
+    assert blob_client.downloads == 1
+    assert len(hashed_files) == 1
+
+    # Touched copies are hashed once and then trusted again
+    os.utime(path, ns=(0, 10**9))
+    download_model("model")
+    download_model("model")
+    assert blob_client.downloads == 1
+    assert len(hashed_files) == 2
+
+
+# ------------------------------------------------------------------------------
+def test_corrupted_weights_are_downloaded_again(blob_client, hashed_files):
+    path = download_model("model")
+    with open(path, "r+b") as f:
+        f.write(b"X")
+
+    download_model("model")
+
+    assert blob_client.downloads == 2
+    with open(path, "rb") as f:
+        assert f.read() == WEIGHTS
+
+
+# ------------------------------------------------------------------------------
+def test_memory_mapped_weights_are_not_moved_to_shared_memory(tmp_path):
+    weights_path = str(tmp_path / "model.pth")
+    torch.save(torch.nn.Linear(64, 64).state_dict(), weights_path)
+    model = torch.nn.Linear(64, 64)
+    model.load_state_dict(
+        torch.load(weights_path, mmap=True, weights_only=True), assign=True
+    )
+    model.register_buffer("scale", torch.ones(64))
+    address = model.weight.data_ptr()
+
+    share_model_memory(model, weights_path)
+
+    assert model.weight.data_ptr() == address
+    assert not model.weight.is_shared()
+    assert not model.bias.is_shared()
+    assert model.scale.is_shared()
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from app.utils.startup.perspective.perspective_transformer import (
+    PerspectiveTransformer,
+)
+
+CAMERAS = [
+    (0.004, [0.0, 12.0, 0.0], (5.0, 30.0)),
+    (0.0035, [10.0, 6.5, -4.0], (-12.0, 18.0)),
+    (0.006, [-3.0, 25.0, 7.0], (40.0, -2.0)),
+]
+
+
+# ------------------------------------------------------------------------------
+def scalar_transform(
+    transformer: PerspectiveTransformer, point: tuple[float, float]
+) -> np.ndarray:
+    """The transformation of a single point as it was computed before it was vectorized, one 2x2 system at a time."""
+    rot_mat, transl_vec = transformer.rot_mat, transformer.transl_vec
+    u, v = point[0] / transformer.focal_length, point[1] / transformer.focal_length
+    rho = np.array(
+        [
+            [rot_mat[0, 0] - u * rot_mat[2, 0], rot_mat[0, 2] - u * rot_mat[2, 2]],
+            [rot_mat[1, 0] - v * rot_mat[2, 0], rot_mat[1, 2] - v * rot_mat[2, 2]],
+        ]
+    )
+    tau = np.array(
+        [u * transl_vec[2] - transl_vec[0], v * transl_vec[2] - transl_vec[1]]
+    )
+    return np.linalg.solve(rho, tau)
+
+
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize("focal_length, cam_position, cam_center", CAMERAS)
+def test_vectorized_transformation_matches_scalar(
+    focal_length, cam_position, cam_center
+):
+    transformer = PerspectiveTransformer(focal_length, cam_position, cam_center)
+    # Points on a sensor of 4 x 4 mm around the image center
+    points = np.random.default_rng(0).uniform(-0.002, 0.002, (500, 2))
+
+    vectorized = transformer.transform_points_to_ground_plane(points)
+
+    expected = np.array([scalar_transform(transformer, p) for p in points])
+    np.testing.assert_allclose(vectorized, expected, rtol=1e-9, atol=1e-9)
+
+
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize("focal_length, cam_position, cam_center", CAMERAS)
+def test_image_center_is_mapped_to_camera_center(
+    focal_length, cam_position, cam_center
+):
+    transformer = PerspectiveTransformer(focal_length, cam_position, cam_center)
+
+    assert transformer.transform_to_ground_plane((0.0, 0.0)) == pytest.approx(
+        cam_center
+    )
+
+
+# ------------------------------------------------------------------------------
+def test_points_and_lists_of_points():
+    transformer = PerspectiveTransformer(*CAMERAS[1])
+    points = [(0.001, -0.0005), (-0.0002, 0.0011)]
+
+    result = transformer.transform_to_ground_plane(points)
+
+    assert isinstance(result, list) and len(result) == 2
+    for point, ground_point in zip(points, result):
+        assert isinstance(ground_point, tuple)
+        assert transformer.transform_to_ground_plane(point) == ground_point
+        np.testing.assert_allclose(ground_point, scalar_transform(transformer, point))
+    assert transformer.transform_to_ground_plane([]) == []
+
+    with pytest.raises(ValueError):
+        PerspectiveTransformer(0.004, [0.0, 12.0], (5.0, 30.0))
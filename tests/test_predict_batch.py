@@ -0,0 +1,106 @@
+import asyncio
+import json
+import struct
+
+import pytest
+from fastapi import HTTPException
+
+from app.routes.predict_batch import (
+    parse_batch,
+    predict_batch_endpoint_implementation,
+)
+
+
+# ------------------------------------------------------------------------------
+def encode_entry(header: dict | bytes, image: bytes) -> bytes:
+    if not isinstance(header, bytes):
+        header = json.dumps(header).encode()
+    return (
+        struct.pack(">I", len(header))
+        + header
+        + struct.pack(">I", len(image))
+        + image
+    )
+
+
+# ------------------------------------------------------------------------------
+def test_parses_length_prefixed_entries():
+    body = (
+        encode_entry({"camera": "c", "position": "p"}, b"\xff\xd8first")
+        + encode_entry({"camera": "d"}, b"")
+        + encode_entry({"camera": "e"}, bytes(range(256)))
+    )
+
+    assert parse_batch(body) == [
+        ("c", "p", b"\xff\xd8first"),
+        ("d", "standard", b""),
+        ("e", "standard", bytes(range(256))),
+    ]
+    assert parse_batch(b"") == []
+
+
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize("length", [29, 31, 32, 40, 52, 55])
+def test_rejects_truncated_streams(length):
+    # Every entry has 28 bytes, truncated are the length of the header, the
+    # header, the length of the image and the image of the second one
+    body = encode_entry({"camera": "c"}, b"image") + encode_entry(
+        {"camera": "d"}, b"image"
+    )
+    assert len(body) == 56
+
+    with pytest.raises(ValueError, match="Truncated"):
+        parse_batch(body[:length])
+
+
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize(
+    "header", [{"position": "p"}, {"camera": 1}, [1, 2], b"{not json"]
+)
+def test_rejects_invalid_headers(header):
+    with pytest.raises(ValueError):
+        parse_batch(encode_entry(header, b"image"))
+
+
+# ------------------------------------------------------------------------------
+def test_rejects_duplicate_camera_positions():
+    entries = [("c", "p", b"first"), ("d", "p", b"other"), ("c", "p", b"second")]
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(
+            predict_batch_endpoint_implementation(
+                project="P",
+                entries=entries,
+                save_predictions=False,
+                models={},
+                prediction_store=None,
+                interpolators={},
+                masks={},
+                gridded_indices={},
+                roi_boxes={},
+                model_schedules={},
+                executor=None,
+            )
+        )
+
+    assert error.value.status_code == 400
+
+
+# ------------------------------------------------------------------------------
+def test_endpoint_rejects_invalid_batches(client):
+    def post(body: bytes):
+        return client.post(
+            "/predict/batch", params={"project": "P", "key": "key"}, content=body
+        )
+
+    assert post(b"").status_code == 400
+    assert post(encode_entry({"camera": "c"}, b"image")[:-1]).status_code == 400
+
+    # BATCH_MAX_ENTRIES is 3
+    entries = [encode_entry({"camera": str(i)}, b"image") for i in range(4)]
+    response = post(b"".join(entries))
+    assert response.status_code == 413
+    assert "at most 3 images" in response.json()["detail"]
+
+    # Valid batches get as far as looking up the project
+    assert post(b"".join(entries[:3])).status_code == 404
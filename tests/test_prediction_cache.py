@@ -0,0 +1,286 @@
+import asyncio
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from app.models.models import PredictReturnParams
+from app.routes.predict import predict_endpoint_implementation
+from app.utils import prediction_cache
+from app.utils.prediction_cache import (
+    PredictionCache,
+    cached_prediction,
+    perceptual_hash,
+)
+from app.utils.prediction_store import LocalPredictionStore
+
+
+# ------------------------------------------------------------------------------
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+# ------------------------------------------------------------------------------
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(prediction_cache.time, "monotonic", clock)
+    return clock
+
+
+# ------------------------------------------------------------------------------
+def encode_image(pixels: np.ndarray) -> bytes:
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format="PNG")
+    return output.getvalue()
+
+
+# ------------------------------------------------------------------------------
+def gradient_image(noise: int = 0, flip: bool = False, seed: int = 0) -> bytes:
+    values = np.tile(np.linspace(0, 200, 320), (180, 1))
+    if flip:
+        values = values[:, ::-1]
+    values += np.random.default_rng(seed).integers(0, noise + 1, values.shape)
+    return encode_image(np.repeat(values[..., None], 3, axis=2).astype(np.uint8))
+
+
+# ------------------------------------------------------------------------------
+def store(
+    cache: PredictionCache,
+    image_bytes: bytes,
+    project: str = "P",
+    prediction_id: str = "id",
+    reused: dict | None = None,
+) -> None:
+    prediction = PredictReturnParams(
+        id=prediction_id,
+        camera="c",
+        position="p",
+        project=project,
+        timestamp="2026-10-17T00:00:00",
+        counts={"total": 3},
+        cache="miss",
+    )
+    results = {
+        "prediction": np.ones((2, 2), dtype=np.float32),
+        "transformed_density": np.array([[0.5, 0.5, 3.0]]),
+    }
+    cache.store(
+        project,
+        "c_p",
+        "standard",
+        cache.fingerprint(image_bytes),
+        prediction,
+        results,
+        saved=True,
+        reused=reused,
+    )
+
+
+# ------------------------------------------------------------------------------
+def lookup(
+    cache: PredictionCache, image_bytes: bytes, project: str = "P"
+) -> tuple[str, dict | None]:
+    return cache.lookup(project, "c_p", "standard", cache.fingerprint(image_bytes))
+
+
+# ------------------------------------------------------------------------------
+def test_exact_hits_expire_after_ttl(clock):
+    cache = PredictionCache(ttl_s=10)
+    image_bytes = gradient_image()
+    assert lookup(cache, image_bytes)[0] == "miss"
+
+    store(cache, image_bytes)
+    clock.now += 10
+    status, entry = lookup(cache, image_bytes)
+    assert status == "hit"
+    assert entry["prediction"].cache is None
+
+    clock.now += 0.5
+    assert lookup(cache, image_bytes) == ("miss", None)
+    assert cache.metrics() == {
+        "entries": 0,
+        "hits": 1,
+        "similar_hits": 0,
+        "misses": 2,
+        "evictions": 0,
+        "in_flight_waits": 0,
+    }
+
+
+# ------------------------------------------------------------------------------
+def test_evicts_least_recently_used_entries(clock):
+    cache = PredictionCache(max_entries=2)
+    images = [gradient_image(noise=1, seed=seed) for seed in range(3)]
+
+    store(cache, images[0])
+    store(cache, images[1])
+    # A hit makes the first image the most recently used one
+    assert lookup(cache, images[0])[0] == "hit"
+    store(cache, images[2])
+
+    assert lookup(cache, images[0])[0] == "hit"
+    assert lookup(cache, images[1])[0] == "miss"
+    assert lookup(cache, images[2])[0] == "hit"
+    assert cache.metrics()["evictions"] == 1
+    assert cache.metrics()["entries"] == 2
+
+    with pytest.raises(ValueError):
+        PredictionCache(max_entries=0)
+
+
+# ------------------------------------------------------------------------------
+def test_entries_are_separated_by_project(clock):
+    cache = PredictionCache(similar_window_s=60)
+    image_bytes = gradient_image()
+    store(cache, image_bytes, project="P")
+    store(cache, image_bytes, project="Q")
+
+    assert lookup(cache, image_bytes, project="R")[0] == "miss"
+
+    cache.clear_project("P")
+    assert lookup(cache, image_bytes, project="P")[0] == "miss"
+    assert lookup(cache, image_bytes, project="Q")[0] == "hit"
+
+
+# ------------------------------------------------------------------------------
+def test_similar_frames_reuse_prediction_within_window(clock):
+    cache = PredictionCache(similar_window_s=60, max_hash_distance=8)
+    reference, similar = gradient_image(), gradient_image(noise=2, seed=1)
+    assert (
+        perceptual_hash(reference) ^ perceptual_hash(similar)
+    ).bit_count() <= 8
+
+    store(cache, reference)
+    clock.now += 30
+    status, entry = lookup(cache, similar)
+    assert status == "similar"
+    assert entry["predicted_at"] == 1000.0
+
+    # Reused predictions are stored for exact hits, but do not extend the
+    # window of the frame they were taken from
+    store(cache, similar, prediction_id="other", reused=entry)
+    clock.now += 31
+    assert lookup(cache, similar)[0] == "hit"
+    assert lookup(cache, gradient_image(noise=2, seed=2))[0] == "miss"
+
+
+# ------------------------------------------------------------------------------
+def test_different_frames_are_not_similar(clock):
+    cache = PredictionCache(similar_window_s=60, max_hash_distance=8)
+    store(cache, gradient_image())
+
+    assert lookup(cache, gradient_image(flip=True))[0] == "miss"
+
+
+# ------------------------------------------------------------------------------
+def test_similar_mode_is_disabled_without_window(clock):
+    cache = PredictionCache()
+    store(cache, gradient_image())
+
+    assert cache.fingerprint(gradient_image())[1] is None
+    assert lookup(cache, gradient_image(noise=2, seed=1))[0] == "miss"
+
+
+# ------------------------------------------------------------------------------
+def test_cached_prediction_is_marked_as_hit(clock):
+    cache = PredictionCache()
+    store(cache, gradient_image())
+    _, entry = lookup(cache, gradient_image())
+
+    prediction = cached_prediction(entry, return_ground_plane_density=True)
+
+    assert prediction.cache == "hit"
+    assert prediction.id == "id"
+    assert prediction.ground_plane_density == [[0.5, 0.5, 3.0]]
+    assert cached_prediction(entry).ground_plane_density is None
+
+
+# ------------------------------------------------------------------------------
+def test_retries_wait_for_the_original_request():
+    calls = []
+
+    def slow_model(inputs: torch.Tensor) -> torch.Tensor:
+        calls.append(1)
+        time.sleep(0.2)
+        blocks = torch.nn.functional.avg_pool2d(inputs.mean(1, keepdim=True), 16)
+        return blocks.abs().repeat_interleave(2, -1).repeat_interleave(2, -2)
+
+    async def run() -> list[PredictReturnParams]:
+        prediction_store = LocalPredictionStore()
+        resources = {
+            "models": {"standard": slow_model},
+            "prediction_store": prediction_store,
+            "interpolators": {},
+            "masks": {},
+            "gridded_indices": {},
+            "roi_boxes": {},
+            "model_schedules": {},
+            "executor": ThreadPoolExecutor(2),
+            "prediction_cache": PredictionCache(),
+        }
+        predictions = await asyncio.gather(
+            *[
+                predict_endpoint_implementation(
+                    camera="c",
+                    position="p",
+                    project="P",
+                    save_predictions=True,
+                    image_bytes=gradient_image(),
+                    **resources,
+                )
+                for _ in range(3)
+            ]
+        )
+        assert len(prediction_store.entries) == 1
+        assert resources["prediction_cache"].metrics()["in_flight_waits"] == 2
+        assert resources["prediction_cache"].in_flight == {}
+        return predictions
+
+    predictions = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert [prediction.cache for prediction in predictions] == [
+        "miss",
+        "hit",
+        "hit",
+    ]
+    assert len({prediction.id for prediction in predictions}) == 1
+
+
+# ------------------------------------------------------------------------------
+def test_waiting_requests_take_over_after_failures():
+    cache = PredictionCache()
+    image = ("P", "c_p", "standard", cache.fingerprint(gradient_image()))
+
+    async def failing() -> None:
+        cache.begin([image])
+        try:
+            await asyncio.sleep(0.01)
+            raise RuntimeError("prediction failed")
+        finally:
+            cache.finish([image])
+
+    async def retry() -> str:
+        await asyncio.sleep(0)
+        await cache.wait_in_flight([image])
+        status, _ = cache.lookup(*image)
+        cache.begin([image])
+        return status
+
+    async def run() -> list:
+        return await asyncio.gather(failing(), retry(), return_exceptions=True)
+
+    failure, status = asyncio.run(run())
+
+    assert isinstance(failure, RuntimeError)
+    assert status == "miss"
+    assert image[:3] + (image[3][0],) in cache.in_flight
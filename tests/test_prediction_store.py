@@ -0,0 +1,143 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+from PIL import Image
+
+from app.routes.predict import persist_predictions, start_original_image_uploads
+from app.utils.prediction_store import (
+    LocalPredictionStore,
+    PredictionStore,
+    create_prediction_store,
+)
+
+
+# ------------------------------------------------------------------------------
+class SlowStore(LocalPredictionStore):
+    """Local store whose uploads take some time and that records how many of them ran at the same time and when entries were saved."""
+
+    def __init__(self, fail: str | None = None):
+        super().__init__()
+        self.fail = fail
+        self.running = 0
+        self.max_running = 0
+        self.events = []
+
+    async def upload(self, container: str, file_name: str, data: bytes) -> None:
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(0.05)
+            if container == self.fail:
+                raise RuntimeError(f"Could not upload to {container}.")
+            await super().upload(container, file_name, data)
+            self.events.append(("upload", container))
+        finally:
+            self.running -= 1
+
+    async def upsert(self, entry: dict) -> None:
+        await super().upsert(entry)
+        self.events.append(("upsert", entry["id"]))
+
+
+# ------------------------------------------------------------------------------
+def prediction(prediction_id: str) -> dict:
+    return {
+        "entry": {"id": prediction_id},
+        "image_bytes": b"original",
+        "image": Image.new("RGB", (64, 36)),
+        "density": np.ones((4, 8), dtype=np.float32),
+        "transformed_density": None,
+        "metadata": {"model": "standard"},
+    }
+
+
+# ------------------------------------------------------------------------------
+def persist(store: SlowStore, prediction_ids: list[str]) -> None:
+    async def run() -> None:
+        uploads = start_original_image_uploads(
+            [(prediction_id, b"original") for prediction_id in prediction_ids],
+            store,
+        )
+        await persist_predictions(
+            predictions=[prediction(prediction_id) for prediction_id in prediction_ids],
+            prediction_store=store,
+            executor=executor,
+            uploads=uploads,
+        )
+
+    with ThreadPoolExecutor(2) as executor:
+        asyncio.run(run())
+
+
+# ------------------------------------------------------------------------------
+def test_save_artifacts_uploads_concurrently():
+    store = SlowStore()
+    artifacts = [("heatmaps", f"{i}.png", b"data") for i in range(5)]
+
+    asyncio.run(store.save_artifacts(artifacts))
+
+    assert store.max_running == 5
+    assert set(store.blobs) == {(container, name) for container, name, _ in artifacts}
+
+
+# ------------------------------------------------------------------------------
+def test_entries_are_saved_after_all_artifacts():
+    store = SlowStore()
+
+    persist(store, ["a", "b"])
+
+    # The artifacts of both predictions are uploaded at the same time, the
+    # original images were uploaded separately beforehand
+    assert ("images", "a.jpg") in store.blobs
+    assert store.max_running >= len(store.blobs) - 2
+    uploads = [i for i, (event, _) in enumerate(store.events) if event == "upload"]
+    upserts = [i for i, (event, _) in enumerate(store.events) if event == "upsert"]
+    assert max(uploads) < min(upserts)
+    assert set(store.entries) == {"a", "b"}
+
+
+# ------------------------------------------------------------------------------
+def test_entries_are_not_saved_if_an_upload_fails():
+    store = SlowStore(fail="images")
+
+    with pytest.raises(HTTPException) as error:
+        persist(store, ["a"])
+
+    assert error.value.status_code == 500
+    assert store.entries == {}
+
+
+# ------------------------------------------------------------------------------
+def test_local_store_writes_to_directory(tmp_path):
+    store = LocalPredictionStore(str(tmp_path))
+
+    async def run() -> None:
+        await asyncio.gather(
+            store.save_artifacts(
+                [("images", "a.jpg", b"image"), ("heatmaps", "a.png", b"heatmap")]
+            ),
+            store.upsert({"id": "a", "counts": {"total": 1}}),
+        )
+
+    asyncio.run(run())
+
+    assert (tmp_path / "images" / "a.jpg").read_bytes() == b"image"
+    assert (tmp_path / "heatmaps" / "a.png").read_bytes() == b"heatmap"
+    entry = json.loads((tmp_path / "cosmosdb" / "a.json").read_bytes())
+    assert entry == {"id": "a", "counts": {"total": 1}}
+
+
+# ------------------------------------------------------------------------------
+def test_store_is_selected_by_environment(monkeypatch):
+    monkeypatch.setenv("PREDICTION_STORE", "local")
+    assert isinstance(create_prediction_store(), LocalPredictionStore)
+
+    monkeypatch.setenv("PREDICTION_STORE", "s3")
+    with pytest.raises(ValueError):
+        create_prediction_store()
+
+    assert issubclass(LocalPredictionStore, PredictionStore)
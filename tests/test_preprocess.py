@@ -0,0 +1,96 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app.utils.model_prediction.make_prediction import (
+    decode_image,
+    fixed_height,
+    fixed_width,
+    preprocess,
+)
+
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32).reshape(3, 1, 1)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32).reshape(3, 1, 1)
+
+
+# ------------------------------------------------------------------------------
+def encode_image(width: int, height: int, image_format: str) -> bytes:
+    """Returns a noisy gradient image of the given size in the given format."""
+    rows = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    columns = np.linspace(0, 255, width, dtype=np.float32)[None, :]
+    pixels = np.stack(
+        np.broadcast_arrays(columns, rows, (columns + rows) / 4), axis=-1
+    )
+    pixels += np.random.default_rng(0).normal(0, 8, pixels.shape)
+    output = io.BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(
+        output, format=image_format, quality=95, compress_level=1
+    )
+    return output.getvalue()
+
+
+# ------------------------------------------------------------------------------
+def previous_preprocess(
+    image_bytes: bytes,
+) -> tuple[np.ndarray, tuple[int, int, int, int]]:
+    """The model input as it was computed before, i.e. decoding at full size, Image.thumbnail() onto a black canvas and ToTensor() + Normalize(), and the box of the image within it."""
+    image = Image.open(io.BytesIO(image_bytes))
+    image.thumbnail((fixed_width, fixed_height), Image.LANCZOS)
+    canvas = Image.new("RGB", (fixed_width, fixed_height))
+    left = (fixed_width - image.width) // 2
+    top = (fixed_height - image.height) // 2
+    canvas.paste(image, (left, top))
+    pixels = np.asarray(canvas, dtype=np.float32).transpose(2, 0, 1) / 255
+    box = (top, left, top + image.height, left + image.width)
+    return (pixels - MEAN) / STD, box
+
+
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize(
+    "width, height, image_format",
+    [
+        (1920, 1080, "PNG"),
+        (1920, 1080, "JPEG"),
+        (1600, 1200, "PNG"),
+        (900, 1600, "PNG"),
+        (640, 360, "PNG"),
+    ],
+)
+def test_matches_previous_preprocessing(width, height, image_format):
+    image_bytes = encode_image(width, height, image_format)
+
+    inputs, box = preprocess(decode_image(image_bytes))
+
+    expected, expected_box = previous_preprocess(image_bytes)
+    np.testing.assert_allclose(inputs[0].numpy(), expected, atol=1e-5)
+    assert box == expected_box
+
+
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize("width, height", [(3840, 2160), (4000, 3000)])
+def test_draft_decoding_stays_close_to_previous_preprocessing(width, height):
+    image_bytes = encode_image(width, height, "JPEG")
+
+    image = decode_image(image_bytes)
+    inputs, _ = preprocess(image)
+
+    # Large JPEGs are decoded at half their size instead of in full
+    assert image.size == (width // 2, height // 2)
+    expected, _ = previous_preprocess(image_bytes)
+    difference = np.abs(inputs[0].numpy() - expected)
+    assert difference.mean() < 0.05
+    assert difference.max() < 0.5
+    assert inputs.sum().item() == pytest.approx(expected.sum(), rel=1e-3)
+
+
+# ------------------------------------------------------------------------------
+def test_input_buffer_is_reused_and_image_left_unchanged():
+    image = decode_image(encode_image(2400, 1350, "JPEG"))
+
+    first, _ = preprocess(image)
+    second, _ = preprocess(decode_image(encode_image(640, 360, "PNG")))
+
+    assert first is second
+    assert image.size == (2400, 1350)
@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from app.utils.startup.project_refresher import ProjectRefresher
+
+
+# ------------------------------------------------------------------------------
+class Source:
+    """Stand-in for a project source without changes that counts its polls."""
+
+    def __init__(self, deleted: list[str]):
+        self.deleted = deleted
+        self.polls = {"changes": 0, "deletions": 0}
+
+    def load_all(self) -> list[dict]:
+        return []
+
+    def poll_changes(self) -> list[dict]:
+        self.polls["changes"] += 1
+        return []
+
+    def poll_deletions(self) -> list[str]:
+        self.polls["deletions"] += 1
+        deleted, self.deleted = self.deleted, []
+        return deleted
+
+
+# ------------------------------------------------------------------------------
+class Projects:
+    """Stand-in for ProjectRegistry that records removed projects."""
+
+    def __init__(self):
+        self.removed = []
+
+    def remove(self, project_id: str) -> None:
+        self.removed.append(project_id)
+
+
+# ------------------------------------------------------------------------------
+def test_deletions_are_polled_less_often_than_changes():
+    source, projects = Source(deleted=["P"]), Projects()
+
+    async def run() -> None:
+        refresher = ProjectRefresher(
+            projects, source, interval_s=0.01, deletion_interval_s=0.1
+        )
+        await refresher.start()
+        await asyncio.sleep(0.35)
+        await refresher.close()
+
+    asyncio.run(run())
+
+    # Roughly every tenth poll for changes is followed by one for deletions
+    assert 1 <= source.polls["deletions"] <= 3
+    assert source.polls["changes"] >= 3 * source.polls["deletions"]
+    assert projects.removed == ["P"]
+
+
+# ------------------------------------------------------------------------------
+def test_rejects_invalid_intervals():
+    with pytest.raises(ValueError):
+        ProjectRefresher(Projects(), Source([]), interval_s=0)
+    with pytest.raises(ValueError):
+        ProjectRefresher(Projects(), Source([]), deletion_interval_s=0)
@@ -0,0 +1,137 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from app.utils.startup import project_registry
+from app.utils.startup.project_registry import ProjectRegistry
+
+
+# ------------------------------------------------------------------------------
+class Resources:
+    """Stand-in for ProjectResources of the given size."""
+
+    def __init__(self, project_id: str, nbytes: int = 100):
+        self.project_id = project_id
+        self.size = nbytes
+        self.camera_errors = {}
+
+    def nbytes(self) -> int:
+        return self.size
+
+
+# ------------------------------------------------------------------------------
+class Source:
+    """Stand-in for a project source that knows the given projects, takes some time to load them and counts how often every id was loaded."""
+
+    def __init__(self, project_ids: list[str], delay_s: float = 0):
+        self.project_ids = project_ids
+        self.delay_s = delay_s
+        self.loads = {}
+        self.lock = threading.Lock()
+
+    def load(self, project_id: str) -> dict | None:
+        with self.lock:
+            self.loads[project_id] = self.loads.get(project_id, 0) + 1
+        time.sleep(self.delay_s)
+        return {"id": project_id} if project_id in self.project_ids else None
+
+
+# ------------------------------------------------------------------------------
+@pytest.fixture(autouse=True)
+def process_project(monkeypatch) -> None:
+    monkeypatch.setattr(
+        project_registry,
+        "process_project",
+        lambda project, geometry_cache: Resources(project["id"]),
+    )
+
+
+# ------------------------------------------------------------------------------
+def registry(source: Source, **kwargs) -> ProjectRegistry:
+    return ProjectRegistry(lazy=True, source_factory=lambda: source, **kwargs)
+
+
+# ------------------------------------------------------------------------------
+def test_concurrent_first_requests_load_once():
+    source = Source(["A", "B"], delay_s=0.1)
+    projects = registry(source)
+
+    async def run() -> list:
+        return await asyncio.gather(
+            *[projects.get(project_id) for project_id in ["A", "B", "A", "A", "B"]]
+        )
+
+    results = asyncio.run(run())
+
+    assert source.loads == {"A": 1, "B": 1}
+    assert results[0] is results[2] is results[3]
+    assert results[1] is results[4]
+    assert projects.metrics()["loads"] == 2
+    assert projects.locks == {}
+
+
+# ------------------------------------------------------------------------------
+def test_evicts_least_recently_used_projects():
+    source = Source(["A", "B", "C", "D"])
+    projects = registry(source, max_bytes=250)
+    projects.pinned.add("P")
+    projects.replace("P", Resources("P", nbytes=50))
+
+    async def run() -> None:
+        await projects.get("A")
+        await projects.get("B")
+        # A is used more recently than B now
+        await projects.get("A")
+        await projects.get("C")
+
+    asyncio.run(run())
+
+    # Pinned projects are never evicted
+    assert list(projects.entries) == ["P", "A", "C"]
+    assert projects.metrics()["bytes"] == 250
+    assert projects.metrics()["evictions"] == 1
+
+    # The most recently used project is kept even if it is too large on its
+    # own
+    projects.replace("D", Resources("D", nbytes=1000))
+    assert list(projects.entries) == ["P", "D"]
+
+
+# ------------------------------------------------------------------------------
+def test_missing_projects_are_remembered_for_ttl():
+    source = Source(["A"])
+    projects = registry(source, missing_ttl_s=0.2)
+
+    async def run() -> list:
+        results = [await projects.get("X") for _ in range(3)]
+        await asyncio.gather(*[projects.get("Y") for _ in range(3)])
+        await asyncio.sleep(0.3)
+        results.append(await projects.get("X"))
+        return results
+
+    assert asyncio.run(run()) == [None] * 4
+    assert source.loads == {"X": 2, "Y": 1}
+
+
+# ------------------------------------------------------------------------------
+def test_eager_registries_only_know_preloaded_projects(monkeypatch):
+    source = Source(["A"])
+    projects = ProjectRegistry(source_factory=lambda: source)
+    monkeypatch.setattr(
+        project_registry,
+        "process_projects",
+        lambda projects, geometry_cache, max_workers: {
+            project["id"]: Resources(project["id"]) for project in projects
+        },
+    )
+
+    projects.preload([{"id": "B"}])
+
+    assert asyncio.run(projects.get("A")) is None
+    assert asyncio.run(projects.get("B")).project_id == "B"
+    assert source.loads == {}
+    projects.remove("B")
+    assert projects.loaded("B") is None
+    assert projects.pinned == set()
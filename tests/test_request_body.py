@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException, Request
+
+from app.utils.request_body import read_body
+
+
+# ------------------------------------------------------------------------------
+def make_request(chunks: list[bytes], content_length: int | None = None) -> Request:
+    """Returns a request whose body arrives in the given chunks. Records how many of them were received in request.received."""
+    headers = []
+    if content_length is not None:
+        headers.append((b"content-length", str(content_length).encode()))
+
+    messages = [
+        {"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1}
+        for i, chunk in enumerate(chunks)
+    ]
+
+    async def receive() -> dict:
+        request.received += 1
+        return messages.pop(0)
+
+    request = Request(
+        {"type": "http", "method": "POST", "path": "/", "headers": headers},
+        receive,
+    )
+    request.received = 0
+    return request
+
+
+# ------------------------------------------------------------------------------
+def test_returns_body_within_limit():
+    request = make_request([b"ab", b"cd", b"e"], content_length=5)
+    assert asyncio.run(read_body(request, max_bytes=5)) == b"abcde"
+
+
+# ------------------------------------------------------------------------------
+def test_rejects_content_length_above_limit_before_reading():
+    request = make_request([b"abcdef"], content_length=6)
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(read_body(request, max_bytes=5))
+
+    assert error.value.status_code == 413
+    assert request.received == 0
+
+
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize("content_length", [None, 4])
+def test_rejects_streamed_body_above_limit(content_length):
+    # Clients without or with a wrong Content-Length are stopped as soon as
+    # the limit is exceeded
+    request = make_request([b"abc", b"def", b"ghi"], content_length=content_length)
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(read_body(request, max_bytes=5))
+
+    assert error.value.status_code == 413
+    assert request.received == 2
+
+
+# ------------------------------------------------------------------------------
+def test_predict_reads_body_before_taking_a_slot(client, app_resources):
+    class Projects:
+        async def get(self, project_id: str):
+            return object()
+
+    app_resources["projects"] = Projects()
+
+    def post(body: bytes):
+        return client.post(
+            "/predict",
+            params={"camera": "c", "project": "P", "key": "key"},
+            content=body,
+        )
+
+    # With all slots taken, oversized bodies are still rejected by their
+    # size, and only complete bodies wait for a slot
+    with app_resources["limiter"].slots(2):
+        assert post(bytes(1025)).status_code == 413
+        assert post(bytes(1024)).status_code == 503
+    assert app_resources["limiter"].in_flight == 0
@@ -0,0 +1,107 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app.utils.model_prediction.make_prediction import (
+    fixed_height,
+    fixed_width,
+    intersect_boxes,
+    prepare_inputs,
+)
+from app.utils.startup.create_masks import ROI_MARGIN, create_masks, create_roi_boxes
+from app.utils.startup.selective_idw_interpolator import SIDWInterpolator
+
+
+# ------------------------------------------------------------------------------
+def camera(edges: list[list[int]] | None, roi_only: bool = True) -> dict:
+    area_metadata = (
+        {"a": {"interpolate": True, "edges": edges}} if edges is not None else {}
+    )
+    return {
+        "resolution": [1920, 1080],
+        "roi_only": roi_only,
+        "position_settings": {"p": {"area_metadata": area_metadata}},
+    }
+
+
+# ------------------------------------------------------------------------------
+def test_box_covers_masks_with_margin():
+    cameras = {"c": camera([[800, 400], [1200, 400], [1200, 700], [800, 700]])}
+    masks = create_masks(cameras)
+
+    top, left, bottom, right = create_roi_boxes(cameras, masks, {})["c_p"]
+
+    rows, columns = np.nonzero(masks["c_p"][0].raster)
+    assert top == 8 * (rows.min() - ROI_MARGIN)
+    assert left == 8 * (columns.min() - ROI_MARGIN)
+    assert bottom == 8 * (rows.max() + 1 + ROI_MARGIN)
+    assert right == 8 * (columns.max() + 1 + ROI_MARGIN)
+
+
+# ------------------------------------------------------------------------------
+def test_margin_covers_interpolation_radius():
+    cameras = {"c": camera([[800, 400], [1200, 400], [1200, 700], [800, 700]])}
+    masks = create_masks(cameras)
+    radius = ROI_MARGIN + 5
+
+    box = create_roi_boxes(cameras, masks, {"c_p": SIDWInterpolator(radius=radius)})
+
+    rows, _ = np.nonzero(masks["c_p"][0].raster)
+    assert box["c_p"][0] == 8 * (rows.min() - radius)
+
+
+# ------------------------------------------------------------------------------
+def test_box_is_clipped_to_model_input():
+    cameras = {"c": camera([[0, 0], [1919, 0], [1919, 1079], [0, 1079]])}
+
+    box = create_roi_boxes(cameras, create_masks(cameras), {})
+
+    assert box["c_p"] == (0, 0, fixed_height, fixed_width)
+
+
+# ------------------------------------------------------------------------------
+def test_only_roi_only_cameras_have_boxes():
+    cameras = {
+        "c": camera([[0, 0], [900, 0], [900, 900]], roi_only=False),
+        "d": camera([[0, 0], [900, 0], [900, 900]]),
+        "e": camera(None),
+    }
+
+    boxes = create_roi_boxes(cameras, create_masks(cameras), {})
+
+    assert list(boxes.keys()) == ["d_p"]
+
+
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize(
+    "box, other, expected",
+    [
+        ((0, 0, 10, 10), (5, 5, 20, 20), (5, 5, 10, 10)),
+        ((0, 0, 10, 10), (0, 0, 10, 10), (0, 0, 10, 10)),
+        ((0, 0, 10, 10), (10, 0, 20, 10), None),
+        ((0, 0, 10, 10), (20, 20, 30, 30), None),
+    ],
+)
+def test_intersect_boxes(box, other, expected):
+    assert intersect_boxes(box, other) == expected
+    assert intersect_boxes(other, box) == expected
+
+
+# ------------------------------------------------------------------------------
+def test_prepare_inputs_crops_to_roi_inside_image_region():
+    output = io.BytesIO()
+    Image.new("RGB", (1000, 1080), (128, 128, 128)).save(output, format="PNG")
+    image_bytes = output.getvalue()
+
+    # Only the part of the region of interest inside the image is predicted
+    _, inputs, offset = prepare_inputs(image_bytes, roi=(100, 0, 300, 600))
+    assert offset == (96 // 8, 448 // 8)
+    assert inputs.shape == (1, 3, 304 - 96, 608 - 448)
+
+    # Regions of interest that only cover the background fall back to the
+    # image region
+    _, inputs, offset = prepare_inputs(image_bytes, roi=(0, 0, 1080, 400))
+    assert offset == (0, 448 // 8)
+    assert inputs.shape == (1, 3, fixed_height, 1472 - 448)
@@ -0,0 +1,127 @@
+import io
+import logging
+import os
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from app.utils.model_prediction.make_prediction import check_parity
+from app.utils.model_prediction.runtimes import (
+    prepare_runtime,
+    relative_count_error,
+)
+
+
+# ------------------------------------------------------------------------------
+def small_model() -> torch.nn.Module:
+    """A density model like DMCount, small enough to be exported in tests."""
+    torch.manual_seed(0)
+    return torch.nn.Sequential(
+        torch.nn.Conv2d(3, 4, 3, padding=1),
+        torch.nn.ReLU(),
+        torch.nn.MaxPool2d(2),
+        torch.nn.Conv2d(4, 1, 1),
+        torch.nn.ReLU(),
+    ).eval()
+
+
+# ------------------------------------------------------------------------------
+@pytest.fixture
+def weights_path(tmp_path) -> str:
+    path = tmp_path / "model.pth"
+    path.write_bytes(b"weights")
+    return str(path)
+
+
+# ------------------------------------------------------------------------------
+def test_relative_count_error():
+    inputs = torch.ones(1, 2, 2)
+
+    def scaled(factor: float):
+        return lambda x: x * factor
+
+    error = relative_count_error(scaled(1), scaled(1.01), inputs)
+    assert error == pytest.approx(0.01)
+    assert relative_count_error(scaled(1), scaled(0.5), inputs) == 0.5
+    # Empty references do not divide by zero
+    assert relative_count_error(scaled(0), scaled(1), inputs) == pytest.approx(4e6)
+
+
+# ------------------------------------------------------------------------------
+def test_torchscript_matches_eager_model(weights_path):
+    model = small_model()
+
+    traced = prepare_runtime(model, "torchscript", weights_path)
+
+    assert os.path.isfile(f"{weights_path}.ts")
+    inputs = torch.rand(2, 3, 64, 96)
+    with torch.no_grad():
+        # Height and width are dynamic
+        assert traced(inputs).shape == model(inputs).shape
+    assert relative_count_error(model, traced, inputs) < 1e-5
+
+
+# ------------------------------------------------------------------------------
+def test_exports_are_rebuilt_when_weights_change(weights_path):
+    prepare_runtime(small_model(), "torchscript", weights_path)
+    export_path = f"{weights_path}.ts"
+    os.utime(export_path, (1000, 1000))
+    os.utime(weights_path, (500, 500))
+
+    # Exports newer than the weights are reused
+    prepare_runtime(small_model(), "torchscript", weights_path)
+    assert os.path.getmtime(export_path) == 1000
+
+    os.utime(weights_path, (2000, 2000))
+    prepare_runtime(small_model(), "torchscript", weights_path)
+    assert os.path.getmtime(export_path) > 2000
+    temporary = [
+        name
+        for name in os.listdir(os.path.dirname(weights_path))
+        if name.endswith(".tmp")
+    ]
+    assert not temporary
+
+
+# ------------------------------------------------------------------------------
+def test_eager_runtime_returns_model_and_unknown_runtimes_raise(weights_path):
+    model = small_model()
+
+    assert prepare_runtime(model, "eager", weights_path) is model
+    with pytest.raises(ValueError):
+        prepare_runtime(model, "tensorrt", weights_path)
+
+
+# ------------------------------------------------------------------------------
+def test_onnxruntime_matches_eager_model(weights_path):
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnxscript")
+    model = small_model()
+
+    session = prepare_runtime(model, "onnxruntime", weights_path)
+
+    inputs = torch.rand(1, 3, 64, 96)
+    assert relative_count_error(model, session, inputs) < 1e-5
+
+
+# ------------------------------------------------------------------------------
+def test_check_parity_against_loaded_model(weights_path, caplog):
+    model = small_model()
+    traced = prepare_runtime(model, "torchscript", weights_path)
+    output = io.BytesIO()
+    pixels = np.random.default_rng(0).integers(0, 256, (90, 160, 3), np.uint8)
+    Image.fromarray(pixels).save(output, format="PNG")
+
+    with caplog.at_level(logging.WARNING):
+        assert check_parity(model, traced, output.getvalue()) < 1e-5
+    assert not caplog.records
+
+    def doubled(inputs: torch.Tensor) -> torch.Tensor:
+        return model(inputs) * 2
+
+    # Without a reference image, random noise is used and the fallback logged
+    with caplog.at_level(logging.WARNING):
+        assert check_parity(model, doubled) == pytest.approx(1)
+    assert "random noise" in caplog.text
@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+from shapely import Polygon
+
+from app.models.models import Mask
+from app.utils.startup.selective_idw_interpolator import SIDWInterpolator
+
+
+# ------------------------------------------------------------------------------
+def full_mask(shape: tuple[int, int], interpolate: bool = True) -> Mask:
+    return Mask(
+        name="all",
+        polygon=Polygon([(0, 0), (shape[1], 0), (shape[1], shape[0])]),
+        interpolate=interpolate,
+        raster=np.ones(shape, dtype=bool),
+    )
+
+
+# ------------------------------------------------------------------------------
+def reference_interpolation(
+    density_map: np.ndarray,
+    raster: np.ndarray,
+    radius: int,
+    p: float,
+    threshold: float,
+) -> np.ndarray:
+    """Point by point SIDW: max(center value, weighted mean of the nonzero neighbours within the radius), neighbours outside of the map are ignored."""
+    result = density_map.astype(np.float64)
+    height, width = density_map.shape
+    for i in range(height):
+        for j in range(width):
+            if density_map[i, j] > threshold or not raster[i, j]:
+                continue
+            weights, values = [], []
+            for di in range(-radius, radius + 1):
+                for dj in range(-radius, radius + 1):
+                    distance = np.hypot(di, dj)
+                    y, x = i + di, j + dj
+                    if not 0 < distance <= radius:
+                        continue
+                    if not (0 <= y < height and 0 <= x < width):
+                        continue
+                    if density_map[y, x] == 0:
+                        continue
+                    weights.append(1 / distance**p)
+                    values.append(density_map[y, x])
+            if weights:
+                result[i, j] = max(
+                    density_map[i, j], np.dot(weights, values) / np.sum(weights)
+                )
+    return result
+
+
+# ------------------------------------------------------------------------------
+@pytest.mark.parametrize("radius, p", [(1, 1), (3, 2), (5, 1)])
+def test_matches_point_by_point_reference(radius, p):
+    rng = np.random.default_rng(radius)
+    density_map = rng.random((20, 30)).astype(np.float32)
+    density_map[rng.random(density_map.shape) < 0.5] = 0
+    raster = rng.random(density_map.shape) < 0.7
+    mask = Mask(
+        name="m",
+        polygon=Polygon([(0, 0), (30, 0), (30, 20)]),
+        interpolate=True,
+        raster=raster,
+    )
+
+    result = SIDWInterpolator(radius=radius, p=p, interpolation_threshold=0.3)(
+        density_map, [mask]
+    )
+
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(
+        result,
+        reference_interpolation(density_map, raster, radius, p, 0.3),
+        rtol=1e-6,
+    )
+
+
+# ------------------------------------------------------------------------------
+def test_keeps_center_value_above_neighbour_mean():
+    density_map = np.zeros((5, 5), dtype=np.float32)
+    density_map[2, 2] = 0.4
+    density_map[2, 3] = 0.1
+
+    result = SIDWInterpolator(radius=1, interpolation_threshold=0.5)(
+        density_map, [full_mask(density_map.shape)]
+    )
+
+    # The center is below the threshold, but higher than the mean of its only
+    # nonzero neighbour, so it is kept rather than replaced by that neighbour
+    assert result[2, 2] == pytest.approx(0.4)
+    assert result[2, 1] == pytest.approx(0.4)
+    assert result[2, 3] == pytest.approx(0.4)
+
+
+# ------------------------------------------------------------------------------
+def test_ignores_neighbours_outside_of_the_map():
+    density_map = np.zeros((4, 4), dtype=np.float32)
+    density_map[0, 3] = 1.0
+
+    result = SIDWInterpolator(radius=1, interpolation_threshold=0.5)(
+        density_map, [full_mask(density_map.shape)]
+    )
+
+    # Negative indices must not wrap around to the opposite border
+    assert result[0, 0] == 0
+    assert result[3, 3] == 0
+    assert result[0, 2] == pytest.approx(1.0)
+
+
+# ------------------------------------------------------------------------------
+def test_only_interpolates_inside_interpolating_masks():
+    density_map = np.zeros((5, 5), dtype=np.float32)
+    density_map[2, 2] = 1.0
+
+    interpolator = SIDWInterpolator(radius=1, interpolation_threshold=0.5)
+    assert interpolator(density_map, []) is density_map
+    assert interpolator(
+        density_map, [full_mask(density_map.shape, interpolate=False)]
+    ) is density_map
+
+    raster = np.zeros(density_map.shape, dtype=bool)
+    raster[2, 1] = True
+    mask = Mask(
+        name="m",
+        polygon=Polygon([(0, 0), (5, 0), (5, 5)]),
+        interpolate=True,
+        raster=raster,
+    )
+    result = interpolator(density_map, [mask])
+    assert result[2, 1] == pytest.approx(1.0)
+    assert np.count_nonzero(result) == 2
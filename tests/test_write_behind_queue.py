@@ -0,0 +1,143 @@
+import asyncio
+import io
+import os
+
+import numpy as np
+from PIL import Image
+
+from app.utils.prediction_store import LocalPredictionStore
+from app.utils.write_behind_queue import WriteBehindQueue
+
+
+# ------------------------------------------------------------------------------
+def prediction(prediction_id: str) -> dict:
+    output = io.BytesIO()
+    Image.new("RGB", (64, 48)).save(output, format="JPEG")
+    return {
+        "entry": {"id": prediction_id},
+        "image_bytes": output.getvalue(),
+        "density": np.ones((134, 240), dtype=np.float32),
+        "transformed_density": np.array([[0.5, 0.5, 1.0]]),
+        "metadata": {"model": "standard"},
+    }
+
+
+# ------------------------------------------------------------------------------
+def test_prepares_and_persists_jobs(tmp_path):
+    async def run() -> LocalPredictionStore:
+        store = LocalPredictionStore()
+        queue = WriteBehindQueue(store, str(tmp_path))
+        await queue.start()
+        assert await queue.put([prediction("p")])
+        await queue.close()
+        assert queue.metrics()["persisted"] == 1
+        return store
+
+    store = asyncio.run(run())
+
+    assert list(store.entries.keys()) == ["p"]
+    assert sorted(file_name for _, file_name in store.blobs.keys()) == [
+        "p.jpg",
+        "p_density.json",
+        "p_heatmap.jpg",
+        "p_small.jpg",
+        "p_transformed_density.json",
+    ]
+    # Drained directories of stopped processes are removed
+    assert os.listdir(tmp_path) == ["failed"]
+
+
+# ------------------------------------------------------------------------------
+def test_processes_only_take_over_jobs_of_processes_that_are_gone(tmp_path):
+    async def run():
+        # Workers that never persist anything, like a process that hangs
+        blocked = asyncio.Event()
+        store = LocalPredictionStore()
+        store.save_artifacts = lambda artifacts: blocked.wait()
+        first = WriteBehindQueue(store, str(tmp_path), num_workers=1)
+        await first.start()
+        assert await first.put([prediction("a"), prediction("b")])
+        assert await first.put([prediction("c")])
+        os.makedirs(os.path.join(first.worker_directory, ".being-written"))
+
+        second = WriteBehindQueue(LocalPredictionStore(), str(tmp_path))
+        await second.start()
+        assert second.jobs.qsize() == 0
+        assert os.path.isdir(os.path.join(first.worker_directory, ".being-written"))
+
+        # The first process dies without cleaning up
+        for worker in first.workers:
+            worker.cancel()
+        first.lock_file.close()
+
+        third_store = LocalPredictionStore()
+        third = WriteBehindQueue(third_store, str(tmp_path))
+        await third.start()
+        assert not os.path.exists(first.worker_directory)
+        await asyncio.gather(second.close(), third.close())
+        return third_store
+
+    store = asyncio.run(run())
+
+    assert sorted(store.entries.keys()) == ["a", "b", "c"]
+    assert os.listdir(tmp_path) == ["failed"]
+
+
+# ------------------------------------------------------------------------------
+def test_drops_jobs_beyond_max_size(tmp_path):
+    async def run() -> WriteBehindQueue:
+        queue = WriteBehindQueue(LocalPredictionStore(), str(tmp_path), max_size=2)
+        await queue.start()
+        for worker in queue.workers:
+            worker.cancel()
+        accepted = await asyncio.gather(
+            *[queue.put([prediction(str(i))]) for i in range(4)]
+        )
+        assert accepted.count(True) == 2
+        return queue
+
+    queue = asyncio.run(run())
+
+    assert queue.metrics()["dropped"] == 2
+    assert queue.jobs.qsize() == 2
+
+
+# ------------------------------------------------------------------------------
+def test_accepts_batches_as_a_whole(tmp_path):
+    async def run() -> WriteBehindQueue:
+        queue = WriteBehindQueue(LocalPredictionStore(), str(tmp_path), max_size=3)
+        await queue.start()
+        for worker in queue.workers:
+            worker.cancel()
+        assert await queue.put([prediction("a"), prediction("b")])
+        assert not await queue.put([prediction("c"), prediction("d")])
+        return queue
+
+    queue = asyncio.run(run())
+
+    assert queue.jobs.qsize() == 2
+    assert queue.metrics()["dropped"] == 2
+    assert len(os.listdir(queue.worker_directory)) == 3
+
+
+# ------------------------------------------------------------------------------
+def test_removes_written_jobs_of_batches_that_cannot_be_written(tmp_path):
+    async def run() -> WriteBehindQueue:
+        queue = WriteBehindQueue(LocalPredictionStore(), str(tmp_path))
+        await queue.start()
+        write_job = queue.__write_job__
+
+        def failing_write_job(job_id: str, prediction: dict) -> None:
+            if prediction["entry"]["id"] == "c":
+                raise OSError("No space left on device")
+            write_job(job_id, prediction)
+
+        queue.__write_job__ = failing_write_job
+        assert not await queue.put([prediction(i) for i in ["a", "b", "c"]])
+        return queue
+
+    queue = asyncio.run(run())
+
+    assert queue.jobs.qsize() == 0
+    assert queue.metrics()["dropped"] == 3
+    assert os.listdir(queue.worker_directory) == [".lock"]